@@ -54,10 +54,8 @@ def main(args):
 
     # load source and target embeddings
     if args.pickle:
-        with open(args.source_embedding, 'rb') as fin:
-            src_wv = pickle.load(fin)
-        with open(args.target_embedding, 'rb') as fin:
-            trg_wv = pickle.load(fin)
+        src_wv = load_wordvecs(args.source_embedding)
+        trg_wv = load_wordvecs(args.target_embedding)
     else:
         src_wv = WordVecs(args.source_embedding, emb_format=args.format).normalize(args.normalize)
         trg_wv = WordVecs(args.target_embedding, emb_format=args.format).normalize(args.normalize)
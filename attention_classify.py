@@ -9,6 +9,8 @@ from utils.math import *
 from utils.bdi import *
 import logging
 
+PREDICT_BATCH_SIZE = 1000
+
 
 class AttenAverage(object):
     """
@@ -28,17 +30,25 @@ class AttenAverage(object):
         self.sess.run(tf.global_variables_initializer())
 
     def _build_graph(self):
-        self.inputs = tf.placeholder(tf.float32, shape=(None, self.pad, self.vec_dim))
+        self.inputs = tf.placeholder(tf.float32, shape=(None, None, self.vec_dim))  # padded to the batch bucket, at most self.pad
         self.labels = tf.placeholder(tf.int32, shape=(None,))
         self.batch_weights = tf.placeholder(tf.float32, shape=(None,))
 
         W1 = tf.get_variable('W1', (self.vec_dim, self.num_atten), tf.float32, initializer=tf.random_uniform_initializer(-1., 1.))
         b1 = tf.get_variable('b1', (self.num_atten), tf.float32, initializer=tf.zeros_initializer())
         atten = tf.reshape(self.inputs, (-1, self.vec_dim)) @ W1 + b1
-        atten_norm = tf.nn.softmax(tf.reduce_max(tf.reshape(atten, (-1, self.pad, self.num_atten)), axis=-1), axis=-1)  # shape (batch_size, self.pad)
+        atten = tf.reduce_max(tf.reshape(atten, (-1, tf.shape(self.inputs)[1], self.num_atten)), axis=-1)  # shape (batch_size, length)
+
+        # the positions from length to self.pad would be zero vectors scoring max(b1) each,
+        # they are added to the softmax normalizer to get the weights of padding to self.pad
+        pad_atten = tf.reduce_max(b1)
+        num_pad = tf.cast(self.pad - tf.shape(self.inputs)[1], tf.float32)
+        atten_max = tf.maximum(tf.reduce_max(atten, axis=-1, keepdims=True), pad_atten)
+        atten_exp = tf.exp(atten - atten_max)
+        atten_norm = atten_exp / (tf.reduce_sum(atten_exp, axis=-1, keepdims=True) + num_pad * tf.exp(pad_atten - atten_max))
         self.atten_norm = atten_norm
 
-        L1 = tf.expand_dims(atten_norm, axis=-1) * self.inputs  # shape (batch_size, self.pad, 300)
+        L1 = tf.expand_dims(atten_norm, axis=-1) * self.inputs  # shape (batch_size, length, 300)
         L1 = tf.reduce_sum(L1, axis=1)  # shape (batch_size, 300)
 
         self.L1 = L1
@@ -52,54 +62,72 @@ class AttenAverage(object):
         self.loss = tf.losses.softmax_cross_entropy(tf.one_hot(self.labels, self.nclasses), logits, weights=self.batch_weights)
         self.optimizer = tf.train.AdamOptimizer(self.learning_rate).minimize(self.loss)
 
-    def fit(self, train_x, train_y, test_x=None, test_y=None, weights=None):
+    def fit(self, train_x, train_y, emb, test_x=None, test_y=None, weights=None):
+        """
+        train_x: RaggedArray
+            word indices of the sentences, truncated to self.pad
+        emb: np.ndarray of shape (vocab_size, vec_dim)
+
+        Each batch is padded to the length bucket of its longest sentence.
+        """
         nsample = len(train_x)
         if weights is None:
-            weights = np.ones(train_x.shape[0])
+            weights = np.ones(nsample)
 
         for epoch in range(self.num_epoch):
             loss = 0.
             pred = np.zeros(nsample)
-            for index, offset in enumerate(range(0, nsample, self.batch_size)):
-                xs = train_x[offset:offset + self.batch_size]
-                ys = train_y[offset:offset + self.batch_size]
-                ws = weights[offset:offset + self.batch_size]
+            for idx, length in length_batches(train_x, self.batch_size, self.pad):
+                xs = train_x[idx].to_dense(emb, length)
+                ys = train_y[idx]
+                ws = weights[idx]
                 _, loss_, pred_, = self.sess.run([self.optimizer, self.loss, self.pred],
                                                  {self.inputs: xs, self.labels: ys, self.batch_weights: ws})
                 loss += loss_ * len(xs)
-                pred[offset:offset + self.batch_size] = pred_
+                pred[idx] = pred_
             loss /= nsample
             fscore = f1_score(train_y, pred, average='macro')
 
             if test_x is not None and test_y is not None:
-                print('\repoch: {}   f1: {:.4f}   loss: {:.6f}   test_f1: {:.4f}'.format(epoch, fscore, loss, self.score(test_x, test_y)), end='')
+                print('\repoch: {}   f1: {:.4f}   loss: {:.6f}   test_f1: {:.4f}'.format(epoch, fscore, loss, self.score(test_x, test_y, emb)), end='')
             else:
                 print('\repoch: {}   f1: {:.4f}   loss: {:.6f}   test_f1: {:.4f}'.format(epoch, fscore, loss), end='')
         print()
 
-    def predict(self, test_x):
-        pred = self.sess.run(self.pred, {self.inputs: test_x})
-        return pred
+    def _run(self, tensor, X, emb):
+        """
+        Evaluate tensor on batches of sentences of similar length.
+
+        Returns: list[np.ndarray]
+            the result for each sentence of X
+        """
+        result = [None] * len(X)
+        for idx, length in length_batches(X, PREDICT_BATCH_SIZE, self.pad, sort=True):
+            for i, r in zip(idx, self.sess.run(tensor, {self.inputs: X[idx].to_dense(emb, length)})):
+                result[i] = r
+        return result
 
-    def score(self, test_x, test_y, scorer='f1_macro'):
+    def predict(self, test_x, emb):
+        return np.array(self._run(self.pred, test_x, emb))
+
+    def score(self, test_x, test_y, emb, scorer='f1_macro'):
         if scorer == 'f1_macro':
-            return f1_score(test_y, self.predict(test_x), average='macro')
+            return f1_score(test_y, self.predict(test_x, emb), average='macro')
         else:
             raise NotImplementedError()
 
-    def predict_attention_scores(self, test_x):
-        atten_ = self.sess.run(self.atten_norm, {self.inputs: test_x})
-        return atten_
+    def predict_attention_scores(self, test_x, emb):
+        return [atten[:len(test_x[i])] for i, atten in enumerate(self._run(self.atten_norm, test_x, emb))]
 
-    def get_senti_x(self, X):
-        return self.sess.run(self.L1, {self.inputs: X})
+    def get_senti_x(self, X, emb):
+        return np.array(self._run(self.L1, X, emb))
 
 
-def make_data(X, y, embedding, vec_dim, binary, pad_id, shuffle=True):
-    X = tf.keras.preprocessing.sequence.pad_sequences(X, maxlen=args.pad, padding='post', value=pad_id)
-    X = embedding[X]  # shape (nsamples, args.pad, vec_dim)
+def make_data(X, y, binary, shuffle=True):
+    # keep the last args.pad words, as pad_sequences truncates
+    X = RaggedArray.from_lists([x[-args.pad:] for x in X])
     if shuffle:
-        perm = np.random.permutation(X.shape[0])
+        perm = np.random.permutation(len(X))
         X, y = X[perm], y[perm]
     if binary:
         y = (y >= 2).astype(np.int32)
@@ -117,43 +145,42 @@ def print_examples_with_attention(X, y, pred, wordvecs, attention):
 
 def main(args):
     print(str(args))
-    with open(args.source_embedding, 'rb') as fin:
-        src_wv = pickle.load(fin)
+    src_wv = load_wordvecs(args.source_embedding)
     vec_dim = src_wv.embedding.shape[1]
-    src_pad_id = src_wv.add_word('<PAD>', np.zeros(vec_dim))
-    src_ds = SentimentDataset(args.source_dataset).to_index(src_wv)
-    train_x, train_y = make_data(*src_ds.train, src_wv.embedding, vec_dim, args.binary, src_pad_id)
-    test_x, test_y = make_data(*src_ds.test, src_wv.embedding, vec_dim, args.binary, src_pad_id)
+    emb = src_wv.embedding
+    src_ds = SentimentDataset(args.source_dataset).to_index(src_wv, cache_dir=args.index_cache)
+    train_x, train_y = make_data(*src_ds.train, args.binary)
+    test_x, test_y = make_data(*src_ds.test, args.binary)
 
     if args.balanced:
         class_weight = compute_class_weight('balanced', np.unique(train_y), train_y)
-        weights = np.zeros(train_x.shape[0], dtype=np.float32)
+        weights = np.zeros(len(train_x), dtype=np.float32)
         for t, w in enumerate(class_weight):
             weights[train_y == t] = w
     else:
-        weights = np.ones(train_x.shape[0], dtype=np.float32)
+        weights = np.ones(len(train_x), dtype=np.float32)
 
     with tf.Session() as sess:
         model = AttenAverage(sess, vec_dim, (2 if args.binary else 4),
                              args.learning_rate, args.batch_size, args.epochs, num_atten=args.hidden_size, pad=args.pad)
-        model.fit(train_x, train_y, test_x, test_y, weights)
-        print('test f1_macro: %.4f' % model.score(test_x, test_y))
+        model.fit(train_x, train_y, emb, test_x, test_y, weights)
+        print('test f1_macro: %.4f' % model.score(test_x, test_y, emb))
 
-        pred = model.predict(test_x)
+        pred = model.predict(test_x, emb)
         print('confusion matrix:', confusion_matrix(test_y, pred))
 
-        train_x, train_y = make_data(*src_ds.train, src_wv.embedding, vec_dim, args.binary, src_pad_id, shuffle=False)
-        test_x, test_y = make_data(*src_ds.test, src_wv.embedding, vec_dim, args.binary, src_pad_id, shuffle=False)
+        train_x, train_y = make_data(*src_ds.train, args.binary, shuffle=False)
+        test_x, test_y = make_data(*src_ds.test, args.binary, shuffle=False)
 
-        xsenti = model.get_senti_x(train_x)
+        xsenti = model.get_senti_x(train_x, emb)
         ysenti = train_y * 2 if args.binary else train_y
         with open(args.save_path, 'wb') as fout:
             pickle.dump((xsenti, ysenti), fout)
 
         # print_examples_with_attention(src_ds.test[0][:50], src_ds.test[1][:50],
-        #                   model.predict(test_x[:50]), src_wv, model.predict_attention_scores(test_x[:50]))
+        #                   model.predict(test_x[:50], emb), src_wv, model.predict_attention_scores(test_x[:50], emb))
         # print_examples_with_attention(src_ds.train[0][:50], src_ds.train[1][:50],
-        #                   model.predict(train_x[:50]), src_wv, model.predict_attention_scores(train_x[:50]))
+        #                   model.predict(train_x[:50], emb), src_wv, model.predict_attention_scores(train_x[:50], emb))
 
 
 if __name__ == '__main__':
@@ -193,6 +220,14 @@ if __name__ == '__main__':
                         type=int,
                         default=4,
                         help='size of hidden units')
+    parser.add_argument('--index_cache',
+                        help='directory of the cached indexed sentiment datasets (default: %s)' % INDEX_CACHE_DIR,
+                        default=INDEX_CACHE_DIR)
+    parser.add_argument('--no_index_cache',
+                        help='index the sentiment datasets instead of loading them from the cache',
+                        action='store_const',
+                        const=None,
+                        dest='index_cache')
     parser.add_argument('--debug',
                         help='print debug info',
                         action='store_const',
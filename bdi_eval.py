@@ -9,6 +9,35 @@ from utils.cupy_utils import *
 from utils.model import *
 
 
+def get_target_indices(xw, zw, vbs, scorer):
+    """
+    Nearest target word of each projected source word.
+
+    xw: ndarray of shape (m, vec_dim)
+    zw: ndarray / QuantizedArray of shape (trg_size, vec_dim)
+    vbs: int
+    scorer: str
+
+    Returns: ndarray of shape (m,)
+    """
+    m = xw.shape[0]
+    quantized = isinstance(zw, QuantizedArray)
+    s = xp.empty((vbs, zw.shape[0]), dtype=xp.float32)
+    tidx = xp.empty(m, dtype=xp.int32)
+    if scorer in ('euclidean',):
+        t = zw.sqr_norm() if quantized else l2norm(zw)**2
+    for i in range(0, m, vbs):
+        j = min(m, i + vbs)
+        if quantized:
+            zw.tdot(xw[i:j], out=s[:j - i])
+        else:
+            xw[i:j].dot(zw.T, out=s[:j - i])
+        if scorer in ('euclidean',):
+            s[:j - i] -= t / 2
+        xp.argmax(s[:j - i], axis=1, out=tidx[i:j])
+    return tidx
+
+
 def main(args):
     print(str(args))
 
@@ -19,10 +48,8 @@ def main(args):
         src_lang = dic['source_lang']
         trg_lang = dic['target_lang']
         model = dic['model']
-        with open('pickle/%s.bin' % src_lang, 'rb') as fin:
-            src_wv = pickle.load(fin)
-        with open('pickle/%s.bin' % trg_lang, 'rb') as fin:
-            trg_wv = pickle.load(fin)
+        src_wv = load_wordvecs('pickle/%s.bin' % src_lang)
+        trg_wv = load_wordvecs('pickle/%s.bin' % trg_lang)
 
         word_pairs = BilingualDict('lexicons/muse/{}-{}.0-5000.txt'.format(src_lang, trg_lang)).get_indexed_dictionary(src_wv, trg_wv)
         gold_dict = collections.defaultdict(set)
@@ -38,22 +65,15 @@ def main(args):
             length_normalize(xw, inplace=True)
             length_normalize(zw, inplace=True)
 
-        m = xw.shape[0]
-        vbs = args.val_batch_size
-        s = xp.empty((vbs, zw.shape[0]), dtype=xp.float32)
-        tidx = xp.empty(m, dtype=xp.int32)
-        if args.scorer in ('euclidean',):
-            t = l2norm(zw)**2
-        for i in range(0, m, vbs):
-            j = min(m, i + vbs)
-            xw[i:j].dot(zw.T, out=s[:j - i])
-            if args.scorer in ('euclidean',):
-                s[:j - i] -= t / 2
-            xp.argmax(s[:j - i], axis=1, out=tidx[i:j])
-
+        tidx = get_target_indices(xw, zw, args.val_batch_size, args.scorer)
         accuracy = sum([1 for s, t in zip(sidx, tidx) if t in gold_dict[s]]) / len(gold_dict)
         print('file: {}   acc: {}'.format(infile, accuracy))
 
+        if args.storage != 'float32':
+            tidx = get_target_indices(xw, QuantizedArray(zw, args.storage), args.val_batch_size, args.scorer)
+            q_accuracy = sum([1 for s, t in zip(sidx, tidx) if t in gold_dict[s]]) / len(gold_dict)
+            print('file: {}   {} acc: {}   delta: {:+.4f}'.format(infile, args.storage, q_accuracy, q_accuracy - accuracy))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -70,6 +90,10 @@ if __name__ == '__main__':
                         default=300,
                         type=int,
                         help='training batch size (default: 300)')
+    parser.add_argument('--storage',
+                        choices=['float32', 'float16', 'int8'],
+                        default='float32',
+                        help='also evaluate with target embeddings stored in reduced precision')
     parser.add_argument('--cuda',
                         action='store_true',
                         help='use cuda to accelerate')
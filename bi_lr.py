@@ -216,8 +216,8 @@ def main(args):
     trg_wv = WordVecs(args.target_embedding, normalize=args.normalize)
     src_pad_id = src_wv.add_word('<PAD>', np.zeros(300))
     trg_pad_id = trg_wv.add_word('<PAD>', np.zeros(300))
-    src_dataset = SentimentDataset(args.source_dataset).to_index(src_wv)
-    trg_dataset = SentimentDataset(args.target_dataset).to_index(trg_wv)
+    src_dataset = SentimentDataset(args.source_dataset).to_index(src_wv, cache_dir=args.index_cache)
+    trg_dataset = SentimentDataset(args.target_dataset).to_index(trg_wv, cache_dir=args.index_cache)
     src_x, src_y = make_data(*src_dataset.train, src_wv.embedding, args.vector_dim, args.binary, src_pad_id)
     src_test_x, src_test_y = make_data(*src_dataset.test, src_wv.embedding, args.vector_dim, args.binary, src_pad_id)
     trg_x, trg_y = make_data(*trg_dataset.train, trg_wv.embedding, args.vector_dim, args.binary, trg_pad_id)
@@ -266,6 +266,8 @@ if __name__ == '__main__':
     parser.add_argument('--cuda', action='store_true', help='use cuda for BDI')
     parser.add_argument('--save_path', type=str, default='./checkpoints/bilr.ckpt', help='file to save the trained parameters')
     parser.add_argument('--summaries_dir', type=str, default='./log', help='dir to save summaries')
+    parser.add_argument('--index_cache', default=INDEX_CACHE_DIR, help='directory of the cached indexed sentiment datasets (default: %s)' % INDEX_CACHE_DIR)
+    parser.add_argument('--no_index_cache', action='store_const', const=None, dest='index_cache', help='index the sentiment datasets instead of loading them from the cache')
     parser.add_argument('--debug', action='store_const', dest='loglevel', default=logging.INFO, const=logging.DEBUG, help='print debug info')
 
     parser.set_defaults(normalize=True, orthogonal=True, binary=True, cuda=True)
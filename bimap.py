@@ -4,6 +4,7 @@ import logging
 import sys
 import os
 import re
+import time
 import numpy as np
 from utils.dataset import *
 from utils.math import *
@@ -46,13 +47,13 @@ def main(args):
         sys.exit(0)
 
     if args.pickle:
-        with open(args.source_embedding, 'rb') as fin:
-            src_wv = pickle.load(fin)
-        with open(args.target_embedding, 'rb') as fin:
-            trg_wv = pickle.load(fin)
+        src_wv = load_wordvecs(args.source_embedding)
+        trg_wv = load_wordvecs(args.target_embedding)
     else:
-        src_wv = WordVecs(args.source_embedding, emb_format=args.format).normalize(args.normalize)
-        trg_wv = WordVecs(args.target_embedding, emb_format=args.format).normalize(args.normalize)
+        src_wv = WordVecs(args.source_embedding, emb_format=args.format, workers=args.workers).normalize(args.normalize)
+        trg_wv = WordVecs(args.target_embedding, emb_format=args.format, workers=args.workers).normalize(args.normalize)
+    src_wv.quantize(args.storage)
+    trg_wv.quantize(args.storage)
 
     gold_dict = xp.array(BilingualDict(args.gold_dictionary).get_indexed_dictionary(src_wv, trg_wv), dtype=xp.int32)
     keep_prob = args.dropout_init
@@ -60,8 +61,13 @@ def main(args):
     if args.init_num:
         init_dict = get_numeral_init_dict(src_wv, trg_wv)
     elif args.init_unsupervised:
-        init_dict = get_unsupervised_init_dict(src_wv.embedding, trg_wv.embedding, args.vocab_cutoff, args.csls, args.normalize, args.direction)
+        t0 = time.time()
+        init_dict = get_unsupervised_init_dict(src_wv.embedding, trg_wv.embedding, args.vocab_cutoff, args.csls, args.normalize, args.direction,
+                                               block_size=args.init_block_size, method=args.init_unsupervised,
+                                               cache_dir=None if args.no_init_cache else INIT_CACHE_DIR)
         init_dict = xp.array(init_dict)
+        logging.info('init dict (%s): %d pairs  time: %.2fs  precision: %.4f' % (args.init_unsupervised, init_dict.shape[0],
+                                                                               time.time() - t0, dict_precision(init_dict, gold_dict)))
     else:
         init_dict = xp.array(BilingualDict(args.init_dictionary).get_indexed_dictionary(src_wv, trg_wv), dtype=xp.int32)
     curr_dict = init_dict
@@ -69,7 +75,10 @@ def main(args):
     bdi_obj = BDI(src_wv.embedding, trg_wv.embedding, batch_size=args.batch_size,
                   cutoff_size=args.vocab_cutoff, cutoff_type='both', direction=args.direction,
                   csls=args.csls, batch_size_val=args.val_batch_size,
-                  src_val_ind=gold_dict[:, 0], trg_val_ind=gold_dict[:, 1])
+                  src_val_ind=gold_dict[:, 0], trg_val_ind=gold_dict[:, 1], storage=args.storage,
+                  ann_probes=args.ann_probes, num_threads=args.num_threads, fused=args.fused,
+                  knn_refresh=args.knn_refresh, knn_drift=args.knn_drift, candidates=args.candidates,
+                  coarse_storage=args.coarse_storage, coarse_candidates=args.coarse_candidates)
     bdi_obj.project(xp.identity(args.vector_dim, dtype=xp.float32), 'forward')
     bdi_obj.project(xp.identity(args.vector_dim, dtype=xp.float32), 'backward')
 
@@ -126,11 +135,12 @@ if __name__ == '__main__':
     parser.add_argument('--log', default='./log/init100.csv', type=str, help='file to print log')
     parser.add_argument('--plot', action='store_true', help='plot results')
     parser.add_argument('--pickle', action='store_true', help='load from pickled objects')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to parse fasttext embeddings')
 
     init_group = parser.add_mutually_exclusive_group()
     init_group.add_argument('-d', '--init_dictionary', default='./init_dict/init100.txt', help='bilingual dictionary for learning bilingual mapping (default: ./init_dict/init100.txt)')
     init_group.add_argument('--init_num', action='store_true', help='use numerals as initial dictionary')
-    init_group.add_argument('--init_unsupervised', action='store_true', help='use unsupervised init')
+    init_group.add_argument('--init_unsupervised', nargs='?', const='exact', choices=['exact', 'sketch'], help='use unsupervised init, comparing the full sorted similarity profiles (exact) or quantile sketches of them (sketch)')
 
     mapping_group = parser.add_argument_group()
     mapping_group.add_argument('--orthogonal', action='store_true', help='restrict projection matrix to be orthogonal')
@@ -138,11 +148,22 @@ if __name__ == '__main__':
 
     induction_group = parser.add_argument_group()
     induction_group.add_argument('-vc', '--vocab_cutoff', default=10000, type=int, help='restrict the vocabulary to k most frequent words')
+    induction_group.add_argument('--init_block_size', type=int, default=0, help='compute the unsupervised init dictionary out of core in blocks of this many rows (0 = in memory)')
+    induction_group.add_argument('--no_init_cache', action='store_true', help='recompute the unsupervised init dictionary instead of loading it from %s' % INIT_CACHE_DIR)
     induction_group.add_argument('--csls', type=int, default=10, help='number of csls neighbours')
     induction_group.add_argument('--dropout_init', type=float, default=0.1, help='initial keep prob of the dropout machanism')
     induction_group.add_argument('--dropout_interval', type=int, default=30, help='increase keep_prob every m steps')
     induction_group.add_argument('--dropout_step', type=float, default=0.1, help='increase keep_prob by a small step')
     induction_group.add_argument('--direction', choices=['forward', 'backward', 'union'], default='union', help='direction of dictionary induction')
+    induction_group.add_argument('--storage', choices=['float32', 'float16', 'int8'], default='float32', help='precision of the stored embeddings')
+    induction_group.add_argument('--ann_probes', type=int, default=0, help='search IVF indices scanning this many lists per query instead of brute force (0 = exact search)')
+    induction_group.add_argument('--num_threads', type=int, default=1, help='threads running the batches of dictionary induction concurrently')
+    induction_group.add_argument('--fused', action='store_true', help='compute the cutoff x cutoff similarity matrix once for union induction (needs --direction union)')
+    induction_group.add_argument('--knn_refresh', type=int, default=1, help='recompute the CSLS neighbourhoods every this many inductions, rescoring the cached neighbours in between')
+    induction_group.add_argument('--knn_drift', type=float, default=0.05, help='recompute the CSLS neighbourhoods when W moved by more than this relative distance')
+    induction_group.add_argument('--candidates', type=int, default=0, help='between refreshes (see --knn_refresh, which must be above 1), only rescore this many candidates per word kept from the last full induction')
+    induction_group.add_argument('--coarse_storage', choices=['float16'], default=None, help='find candidates with a float16 copy of the projected embeddings and rescore them in float32 (two-stage retrieval, requires --cuda)')
+    induction_group.add_argument('--coarse_candidates', type=int, default=10, help='candidates per word of the two-stage retrieval')
 
     recommend_group = parser.add_mutually_exclusive_group()
     recommend_group.add_argument('-u', '--unsupervised', action='store_true', help='use unsupervised settings')
@@ -160,11 +181,11 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
     if args.unsupervised:
-        parser.set_defaults(init_unsupervised=True, csls=10, direction='union', cuda=False, normalize=[
+        parser.set_defaults(init_unsupervised='exact', csls=10, direction='union', cuda=False, normalize=[
                             'center', 'unit'], vocab_cutoff=10000, orthogonal=True, log='./log/unsupervised.csv',
                             dropout_init=0.2, dropout_interval=40, batch_size=3000, val_batch_size=500)
     elif args.unconstrained:
-        parser.set_defaults(init_unsupervised=True, csls=10, direction='union', cuda=True, normalize=['center', 'unit'], vocab_cutoff=10000, orthogonal=False, log='./log/unconstrained.csv')
+        parser.set_defaults(init_unsupervised='exact', csls=10, direction='union', cuda=True, normalize=['center', 'unit'], vocab_cutoff=10000, orthogonal=False, log='./log/unconstrained.csv')
     elif args.supervised5000:
         parser.set_defaults(init_dictionary='./init_dict/init5000.txt', csls=10, direction='union', cuda=True,
                             normalize=['center', 'unit'], vocab_cutoff=10000, orthogonal=True, log='./log/supervised5000.csv')
@@ -175,13 +175,11 @@ def load_data(binary=False):
     Return the data in numpy arrays.
     """
     def lookup_and_shuffle(X, y, emb, binary=False):
-        X_new = np.zeros((len(X), emb.shape[1]))
-        for i, line in enumerate(X):
-            if len(line) == 0:
-                logging.warning('ZERO LENGTH EXAMPLE')
-                continue
-            X_new[i] = np.mean(emb[line], axis=0)
-        X = X_new
+        S = pooling_matrix(X, emb.shape[0], 'mean')
+        nempty = int((S.getnnz(axis=1) == 0).sum())
+        if nempty > 0:
+            logging.warning('%d ZERO LENGTH EXAMPLES' % nempty)
+        X = pool(S, emb)
 
         perm = np.random.permutation(X.shape[0])
         X, y = X[perm], y[perm]
@@ -190,10 +188,8 @@ def load_data(binary=False):
         return X, y
 
     if args.pickle:
-        with open(args.source_embedding, 'rb') as fin:
-            source_wordvecs = pickle.load(fin)
-        with open(args.target_embedding, 'rb') as fin:
-            target_wordvecs = pickle.load(fin)
+        source_wordvecs = load_wordvecs(args.source_embedding)
+        target_wordvecs = load_wordvecs(args.target_embedding)
     else:
         source_wordvecs = WordVecs(args.source_embedding, emb_format=args.format)
         target_wordvecs = WordVecs(args.target_embedding, emb_format=args.format)
@@ -203,8 +199,8 @@ def load_data(binary=False):
     source_words = source_wordvecs.embedding[dict_obj[:, 0]]
     target_words = target_wordvecs.embedding[dict_obj[:, 1]]
 
-    source_dataset = SentimentDataset(args.source_dataset).to_index(source_wordvecs)
-    target_dataset = SentimentDataset(args.target_dataset).to_index(target_wordvecs)
+    source_dataset = SentimentDataset(args.source_dataset).to_index(source_wordvecs, cache_dir=args.index_cache)
+    target_dataset = SentimentDataset(args.target_dataset).to_index(target_wordvecs, cache_dir=args.index_cache)
 
     train_x, train_y = lookup_and_shuffle(*source_dataset.train, source_wordvecs.embedding, binary)
     test_x, test_y = lookup_and_shuffle(*target_dataset.test, target_wordvecs.embedding, binary)
@@ -297,6 +293,14 @@ if __name__ == '__main__':
                         help='dimension of each word vector (default: 300)',
                         default=300,
                         type=int)
+    parser.add_argument('--index_cache',
+                        help='directory of the cached indexed sentiment datasets (default: %s)' % INDEX_CACHE_DIR,
+                        default=INDEX_CACHE_DIR)
+    parser.add_argument('--no_index_cache',
+                        help='index the sentiment datasets instead of loading them from the cache',
+                        action='store_const',
+                        const=None,
+                        dest='index_cache')
     parser.add_argument('--debug',
                         help='print debug info',
                         action='store_const',
@@ -108,7 +108,7 @@ def main(args):
     logging.info(str(args))
     source_wordvecs = WordVecs(args.source_embedding, normalize=args.normalize)
     source_pad_id = source_wordvecs.add_word('<PAD>', np.zeros(300))
-    source_dataset = SentimentDataset(args.source_dataset).to_index(source_wordvecs)
+    source_dataset = SentimentDataset(args.source_dataset).to_index(source_wordvecs, cache_dir=args.index_cache)
     train_x, train_y = make_data(*source_dataset.train, source_wordvecs.embedding, args.vector_dim, args.binary, source_pad_id)
     test_x, test_y = make_data(*source_dataset.test, source_wordvecs.embedding, args.vector_dim, args.binary, source_pad_id)
     with tf.Session() as sess:
@@ -164,6 +164,14 @@ if __name__ == '__main__':
     parser.add_argument('--normalize',
                         help='mean center and normalize word vectors',
                         action='store_true')
+    parser.add_argument('--index_cache',
+                        help='directory of the cached indexed sentiment datasets (default: %s)' % INDEX_CACHE_DIR,
+                        default=INDEX_CACHE_DIR)
+    parser.add_argument('--no_index_cache',
+                        help='index the sentiment datasets instead of loading them from the cache',
+                        action='store_const',
+                        const=None,
+                        dest='index_cache')
     parser.add_argument('--debug',
                         help='print debug info',
                         action='store_const',
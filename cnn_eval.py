@@ -14,6 +14,7 @@ import logging
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1'
 
 MAX_LEN = 64
+MAX_WIDTH = 3  # widest convolution, in words
 TMP_FILE = 'tmp/cnn{:d}.ckpt'.format(np.random.randint(0, 1e10))
 
 
@@ -48,7 +49,7 @@ class SentiCNN(object):
 
     def _build_graph(self):
         self.keep_prob = tf.placeholder(tf.float32)
-        self.inputs = tf.placeholder(tf.float32, shape=(None, MAX_LEN * self.vec_dim, 1))
+        self.inputs = tf.placeholder(tf.float32, shape=(None, None, 1))  # shape (batch_size, length * vec_dim, 1)
         self.batch_weights = tf.placeholder(tf.float32, shape=(None,))
         self.labels = tf.placeholder(tf.int32, shape=(None,))
 
@@ -97,20 +98,39 @@ class SentiCNN(object):
         if self.clip:
             self.sess.run(self.assigns)
 
-    def fit(self, train_x, train_y, dev_x=None, dev_y=None, weights=None):
+    def _inputs(self, X, emb, length):
+        """
+        Padded batch of word vectors, flattened for the strided convolutions.
+        """
+        return X.to_dense(emb, length).reshape((len(X), length * self.vec_dim, 1))
+
+    def fit(self, train_x, train_y, emb, dev_x=None, dev_y=None, weights=None, dev_emb=None):
+        """
+        train_x: RaggedArray
+            word indices of the sentences, truncated to MAX_LEN
+        emb: np.ndarray of shape (vocab_size, vec_dim)
+        dev_emb: np.ndarray, optional (default emb)
+            embedding indexed by dev_x
+
+        Batches are padded to the length bucket of their longest sentence plus the
+        widest convolution, which gives the same scores as padding to MAX_LEN (zero
+        vectors after the end of a sentence only feed windows that exist in both).
+        """
         max_f1 = 0
         self.saver.save(self.sess, TMP_FILE)
         self.best_W1_ = self.best_W2_ = self.best_b2_ = None
         nsample = len(train_x)
         if weights is None:
-            weights = np.ones(train_x.shape[0])
+            weights = np.ones(nsample)
+        if dev_emb is None:
+            dev_emb = emb
         for epoch in range(self.num_epoch):
             loss = 0.
             pred = np.zeros(nsample)
-            for index, offset in enumerate(range(0, nsample, self.batch_size)):
-                xs = train_x[offset:offset + self.batch_size]
-                ys = train_y[offset:offset + self.batch_size]
-                ws = weights[offset:offset + self.batch_size]
+            for idx, length in length_batches(train_x, self.batch_size, MAX_LEN, MAX_WIDTH):
+                xs = self._inputs(train_x[idx], emb, length)
+                ys = train_y[idx]
+                ws = weights[idx]
                 _, loss_, pred_, relu1_ = self.sess.run([self.optimizer, self.loss, self.pred, self.relu1],
                                                         {self.inputs: xs,
                                                          self.labels: ys,
@@ -119,12 +139,12 @@ class SentiCNN(object):
                 if self.clip:
                     self.sess.run(self.assigns)
                 loss += loss_ * len(xs)
-                pred[offset:offset + self.batch_size] = pred_
+                pred[idx] = pred_
             loss /= nsample
             fscore = f1_score(train_y, pred, average='macro')
 
             if dev_x is not None and dev_y is not None:
-                dev_f1 = self.score(dev_x, dev_y)
+                dev_f1 = self.score(dev_x, dev_y, dev_emb)
                 print('epoch: {:d}  f1: {:.4f}  loss: {:.6f}  dev_f1: {:.4f}\r'.format(epoch, fscore, loss, dev_f1), end='', flush=True)
                 if dev_f1 > max_f1:
                     max_f1 = dev_f1
@@ -139,13 +159,15 @@ class SentiCNN(object):
         else:
             self.saver.restore(self.sess, TMP_FILE)
 
-    def predict(self, test_x):
-        pred = self.sess.run(self.pred, {self.inputs: test_x, self.keep_prob: 1.})
+    def predict(self, test_x, emb):
+        pred = np.zeros(len(test_x), dtype=np.int64)
+        for idx, length in length_batches(test_x, self.batch_size, MAX_LEN, MAX_WIDTH, sort=True):
+            pred[idx] = self.sess.run(self.pred, {self.inputs: self._inputs(test_x[idx], emb, length), self.keep_prob: 1.})
         return pred
 
-    def score(self, test_x, test_y, scorer='f1_macro'):
+    def score(self, test_x, test_y, emb, scorer='f1_macro'):
         if scorer == 'f1_macro':
-            return f1_score(test_y, self.predict(test_x), average='macro')
+            return f1_score(test_y, self.predict(test_x, emb), average='macro')
         else:
             raise NotImplementedError()
 
@@ -177,12 +199,8 @@ def main(args):
         src_lang = dic['source_lang']
         trg_lang = dic['target_lang']
         model = dic['model']
-        with open('pickle/%s.bin' % src_lang, 'rb') as fin:
-            src_wv = pickle.load(fin)
-        with open('pickle/%s.bin' % trg_lang, 'rb') as fin:
-            trg_wv = pickle.load(fin)
-        src_pad_id = src_wv.add_word('<pad>', np.zeros(src_wv.vec_dim, dtype=np.float32))
-        trg_pad_id = trg_wv.add_word('<pad>', np.zeros(trg_wv.vec_dim, dtype=np.float32))
+        src_wv = load_wordvecs('pickle/%s.bin' % src_lang)
+        trg_wv = load_wordvecs('pickle/%s.bin' % trg_lang)
         src_proj_emb = np.empty(src_wv.embedding.shape, dtype=np.float32)
         trg_proj_emb = np.empty(trg_wv.embedding.shape, dtype=np.float32)
         if model == 'ubise':
@@ -201,20 +219,21 @@ def main(args):
             trg_wv.embedding.dot(W_trg, out=trg_proj_emb)
 
         for is_binary in settings:
-            src_ds = SentimentDataset('datasets/%s/opener_sents/' % src_lang).to_index(src_wv, binary=is_binary).pad(src_pad_id, MAX_LEN).to_vecs(src_proj_emb, True)
-            trg_ds = SentimentDataset('datasets/%s/opener_sents/' % trg_lang).to_index(trg_wv, binary=is_binary).pad(trg_pad_id, MAX_LEN).to_vecs(trg_proj_emb, True)
+            src_ds = SentimentDataset('datasets/%s/opener_sents/' % src_lang).to_index(src_wv, binary=is_binary, cache_dir=args.index_cache).to_ragged(MAX_LEN)
+            trg_ds = SentimentDataset('datasets/%s/opener_sents/' % trg_lang).to_index(trg_wv, binary=is_binary, cache_dir=args.index_cache)
             vec_dim = src_proj_emb.shape[1]
 
-            train_x = src_ds.train[0].reshape((-1, MAX_LEN * vec_dim, 1))
-            train_y = src_ds.train[1]
-            dev_x = np.concatenate((trg_ds.train[0], trg_ds.dev[0]), axis=0).reshape((-1, MAX_LEN * vec_dim, 1))
+            train_x, train_y = src_ds.train
+            perm = np.random.permutation(len(train_x))
+            train_x, train_y = train_x[perm], train_y[perm]
+            dev_x = RaggedArray.from_lists(trg_ds.train[0] + trg_ds.dev[0], MAX_LEN)
             dev_y = np.concatenate((trg_ds.train[1], trg_ds.dev[1]), axis=0)
-            test_x = trg_ds.test[0].reshape((-1, MAX_LEN * vec_dim, 1))
+            test_x = RaggedArray.from_lists(trg_ds.test[0], MAX_LEN)
             test_y = trg_ds.test[1]
 
             class_weight = compute_class_weight('balanced', np.unique(train_y), train_y)
             # print('class weights: {}'.format(class_weight))
-            weights = np.zeros(train_x.shape[0], dtype=np.float32)
+            weights = np.zeros(len(train_x), dtype=np.float32)
             for t, w in enumerate(class_weight):
                 weights[train_y == t] = w
             # if is_binary:
@@ -233,8 +252,8 @@ def main(args):
                         cnn = SentiCNN(sess, vec_dim, (2 if is_binary else 4),
                                        args.learning_rate, args.batch_size, args.epochs, args.filters, args.dropout, C, args.clip)
                         cnn.initialize()
-                        cnn.fit(train_x, train_y, dev_x, dev_y, weights)
-                        pred = cnn.predict(test_x)
+                        cnn.fit(train_x, train_y, src_proj_emb, dev_x, dev_y, weights, trg_proj_emb)
+                        pred = cnn.predict(test_x, trg_proj_emb)
                         score = f1_score(test_y, pred, average='macro')
                         if cnn.best_score_ > best_dev:
                             best_dev = cnn.best_score_
@@ -304,6 +323,14 @@ if __name__ == '__main__':
                         action='store_true',)
     parser.add_argument('-o', '--output',
                         help='output file')
+    parser.add_argument('--index_cache',
+                        help='directory of the cached indexed sentiment datasets (default: %s)' % INDEX_CACHE_DIR,
+                        default=INDEX_CACHE_DIR)
+    parser.add_argument('--no_index_cache',
+                        help='index the sentiment datasets instead of loading them from the cache',
+                        action='store_const',
+                        const=None,
+                        dest='index_cache')
     parser.add_argument('--debug',
                         help='print debug info',
                         action='store_const',
@@ -4,6 +4,7 @@ import logging
 import sys
 import os
 import re
+import time
 import numpy as np
 from utils.dataset import *
 from utils.math import *
@@ -84,29 +85,33 @@ def main(args):
     is_binary = args.loss not in (10, 11)
 
     if args.pickle:
-        with open(args.source_embedding, 'rb') as fin:
-            src_wv = pickle.load(fin)
-        with open(args.target_embedding, 'rb') as fin:
-            trg_wv = pickle.load(fin)
+        src_wv = load_wordvecs(args.source_embedding)
+        trg_wv = load_wordvecs(args.target_embedding)
     else:
-        src_wv = WordVecs(args.source_embedding, emb_format=args.format).normalize(args.normalize)
-        trg_wv = WordVecs(args.target_embedding, emb_format=args.format).normalize(args.normalize)
+        src_wv = WordVecs(args.source_embedding, emb_format=args.format, workers=args.workers).normalize(args.normalize)
+        trg_wv = WordVecs(args.target_embedding, emb_format=args.format, workers=args.workers).normalize(args.normalize)
 
-    pad_id = src_wv.add_word('<pad>', np.zeros(args.vector_dim, dtype=np.float32))
-    src_ds = SentimentDataset(args.source_dataset).to_index(src_wv, binary=is_binary).pad(pad_id)
-    xsenti = xp.array(src_ds.train[0])
+    src_ds = SentimentDataset(args.source_dataset).to_index(src_wv, binary=is_binary, cache_dir=args.index_cache).to_ragged(64)
+    xsenti = RaggedArray(xp.array(src_ds.train[0].indices), xp.array(src_ds.train[0].offsets))
     ysenti = xp.array(src_ds.train[1])
-    lsenti = xp.array(src_ds.train[2])
+    src_wv.quantize(args.storage)
+    trg_wv.quantize(args.storage)
 
     gold_dict = xp.array(BilingualDict(args.gold_dictionary).get_indexed_dictionary(src_wv, trg_wv), dtype=xp.int32)
     keep_prob = args.dropout_init
     alpha = max(args.alpha, args.alpha_init) if args.alpha_dec else min(args.alpha, args.alpha_init)
     threshold = min(args.threshold, args.threshold_init)
-    init_dict = get_unsupervised_init_dict(src_wv.embedding, trg_wv.embedding, args.vocab_cutoff, args.csls, args.normalize, args.direction)
+    t0 = time.time()
+    init_dict = get_unsupervised_init_dict(src_wv.embedding, trg_wv.embedding, args.vocab_cutoff, args.csls, args.normalize, args.direction,
+                                           block_size=args.init_block_size, method=args.init_unsupervised,
+                                           cache_dir=None if args.no_init_cache else INIT_CACHE_DIR)
     init_dict = xp.array(init_dict)
+    init_time = time.time() - t0
     I = xp.identity(args.vector_dim, dtype=xp.float32)
 
     logging.info('gold dict shape' + str(gold_dict.shape))
+    logging.info('init dict (%s): %d pairs  time: %.2fs  precision: %.4f' % (args.init_unsupervised, init_dict.shape[0],
+                                                                           init_time, dict_precision(init_dict, gold_dict)))
 
     if args.load is not None:
         dic = load_model(args.load)
@@ -123,10 +128,13 @@ def main(args):
         p = xp.zeros(())
         C = args.C
 
-    src_val_ind = xp.array(np.union1d(asnumpy(gold_dict[:, 0]), asnumpy(xsenti)))
+    src_val_ind = xp.array(np.union1d(asnumpy(gold_dict[:, 0]), asnumpy(xsenti.indices)))
     bdi_obj = BDI(src_wv.embedding, trg_wv.embedding, batch_size=args.batch_size, cutoff_size=args.vocab_cutoff, cutoff_type='both',
                   direction=args.direction, csls=args.csls, batch_size_val=args.val_batch_size, scorer='dot',
-                  src_val_ind=src_val_ind, trg_val_ind=gold_dict[:, 1])
+                  src_val_ind=src_val_ind, trg_val_ind=gold_dict[:, 1], storage=args.storage,
+                  ann_probes=args.ann_probes, num_threads=args.num_threads, fused=args.fused,
+                  knn_refresh=args.knn_refresh, knn_drift=args.knn_drift, candidates=args.candidates,
+                  coarse_storage=args.coarse_storage, coarse_candidates=args.coarse_candidates)
     bdi_obj.project(W_src, 'forward', unit_norm=args.normalize_projection)
     bdi_obj.project(W_trg, 'backward', unit_norm=args.normalize_projection)
     curr_dict = init_dict if args.load is None else bdi_obj.get_bilingual_dict_with_cutoff(keep_prob=keep_prob)
@@ -147,8 +155,8 @@ def main(args):
                     lr = args.learning_rate
                     X_src = bdi_obj.src_emb[curr_dict[:, 0]]
                     X_trg = bdi_obj.trg_proj_emb[curr_dict[:, 1]]
-                    ssrc = xp.random.randint(0, xsenti.shape[0], m)
-                    strg = xp.random.randint(0, xsenti.shape[0], m)
+                    ssrc = xp.random.randint(0, len(xsenti), m)
+                    strg = xp.random.randint(0, len(xsenti), m)
                     if args.sample_type == 'full':
                         mask = (ysenti[ssrc] == ysenti[strg]).astype(xp.float32) * 2 - 1
                     elif args.sample_type == 'same':
@@ -156,8 +164,8 @@ def main(args):
                     elif args.sample_type == 'pos-neg':
                         mask = (ysenti[ssrc] == ysenti[strg]).astype(xp.float32) - 1
 
-                    U_src = bdi_obj.src_emb[xsenti[ssrc]].sum(axis=1) / lsenti[ssrc][:, xp.newaxis]
-                    U_trg = bdi_obj.src_proj_emb[xsenti[strg]].sum(axis=1) / lsenti[strg][:, xp.newaxis]
+                    U_src = xsenti[ssrc].mean(bdi_obj.src_emb)
+                    U_trg = xsenti[strg].mean(bdi_obj.src_proj_emb)
                     U_src *= mask[:, xp.newaxis]
                     logging.debug('number of samples: {0:d}'.format(U_src.shape[0]))
                     prev_loss, loss = float('inf'), float('inf')
@@ -177,13 +185,13 @@ def main(args):
                     lr = args.learning_rate
                     X_src = bdi_obj.src_emb[curr_dict[:, 0]]
                     X_trg = bdi_obj.trg_proj_emb[curr_dict[:, 1]]
-                    ssrc = xp.random.randint(0, xsenti.shape[0], m)
-                    strg = xp.random.randint(0, xsenti.shape[0], m)
+                    ssrc = xp.random.randint(0, len(xsenti), m)
+                    strg = xp.random.randint(0, len(xsenti), m)
                     mask = ysenti[ssrc] == ysenti[strg]
                     ssrc = ssrc[mask]
                     strg = strg[mask]
-                    U_src = bdi_obj.src_emb[xsenti[ssrc]].sum(axis=1) / lsenti[ssrc][:, xp.newaxis]
-                    U_trg = bdi_obj.src_emb[xsenti[strg]].sum(axis=1) / lsenti[strg][:, xp.newaxis]
+                    U_src = xsenti[ssrc].mean(bdi_obj.src_emb)
+                    U_trg = xsenti[strg].mean(bdi_obj.src_emb)
                     Z = U_src - U_trg
                     logging.debug('number of samples: {0:d}'.format(Z.shape[0]))
                     prev_loss, loss = float('inf'), float('inf')
@@ -211,13 +219,13 @@ def main(args):
                     lr = args.learning_rate
                     X_src = bdi_obj.src_emb[curr_dict[:, 0]]
                     X_trg = bdi_obj.trg_proj_emb[curr_dict[:, 1]]
-                    ssrc = xp.random.randint(0, xsenti.shape[0], m)
-                    strg = xp.random.randint(0, xsenti.shape[0], m)
+                    ssrc = xp.random.randint(0, len(xsenti), m)
+                    strg = xp.random.randint(0, len(xsenti), m)
                     mask = ysenti[ssrc] == ysenti[strg]
                     ssrc = ssrc[mask]
                     strg = strg[mask]
-                    U_src = bdi_obj.src_emb[xsenti[ssrc]].sum(axis=1) / lsenti[ssrc][:, xp.newaxis]
-                    U_trg = bdi_obj.src_emb[xsenti[strg]].sum(axis=1) / lsenti[strg][:, xp.newaxis]
+                    U_src = xsenti[ssrc].mean(bdi_obj.src_emb)
+                    U_trg = xsenti[strg].mean(bdi_obj.src_emb)
                     Z = U_src - U_trg
                     logging.debug('number of samples: {0:d}'.format(Z.shape[0]))
                     prev_loss, loss = float('inf'), float('inf')
@@ -244,13 +252,13 @@ def main(args):
                     m = args.senti_nsample
                     X_src = bdi_obj.src_emb[curr_dict[:, 0]]
                     X_trg = bdi_obj.trg_proj_emb[curr_dict[:, 1]]
-                    ssrc = xp.random.randint(0, xsenti.shape[0], m)
-                    strg = xp.random.randint(0, xsenti.shape[0], m)
+                    ssrc = xp.random.randint(0, len(xsenti), m)
+                    strg = xp.random.randint(0, len(xsenti), m)
                     mask = ysenti[ssrc] == ysenti[strg]
                     ssrc = ssrc[mask]
                     strg = strg[mask]
-                    U_src = bdi_obj.src_emb[xsenti[ssrc]].sum(axis=1) / lsenti[ssrc][:, xp.newaxis]
-                    U_trg = bdi_obj.src_emb[xsenti[strg]].sum(axis=1) / lsenti[strg][:, xp.newaxis]
+                    U_src = xsenti[ssrc].mean(bdi_obj.src_emb)
+                    U_trg = xsenti[strg].mean(bdi_obj.src_emb)
                     Z = U_src - U_trg
                     logging.debug('number of samples: {0:d}'.format(Z.shape[0]))
                     W_src = xp.linalg.pinv((2 * alpha / m) * Z.T.dot(Z) + (2 * args.beta) * I).dot(X_src.T.dot(X_trg))
@@ -261,18 +269,18 @@ def main(args):
                     lr = args.learning_rate
                     X_src = bdi_obj.src_emb[curr_dict[:, 0]]
                     X_trg = bdi_obj.trg_proj_emb[curr_dict[:, 1]]
-                    pmean = (bdi_obj.src_proj_emb[xsenti[ysenti == 0]].sum(axis=1) / lsenti[ysenti == 0][:, xp.newaxis]).mean(axis=0)
-                    nmean = (bdi_obj.src_proj_emb[xsenti[ysenti == 1]].sum(axis=1) / lsenti[ysenti == 1][:, xp.newaxis]).mean(axis=0)
-                    sind = xp.random.randint(0, xsenti.shape[0], m)
+                    pmean = xsenti[ysenti == 0].mean(bdi_obj.src_proj_emb).mean(axis=0)
+                    nmean = xsenti[ysenti == 1].mean(bdi_obj.src_proj_emb).mean(axis=0)
+                    sind = xp.random.randint(0, len(xsenti), m)
                     pind = sind[ysenti[sind] == 0]
                     nind = sind[ysenti[sind] == 1]
                     nmean = -pmean
                     pmean /= xp.linalg.norm(pmean)
                     nmean /= xp.linalg.norm(nmean)
-                    # DEBUG(bdi_obj.src_emb[xsenti[pind]])
-                    # DEBUG(bdi_obj.src_emb[xsenti[nind]])
-                    xpos = bdi_obj.src_emb[xsenti[pind]].sum(axis=1) / lsenti[pind, xp.newaxis]
-                    xneg = bdi_obj.src_emb[xsenti[nind]].sum(axis=1) / lsenti[nind, xp.newaxis]
+                    # DEBUG(bdi_obj.src_emb[xsenti[pind].indices])
+                    # DEBUG(bdi_obj.src_emb[xsenti[nind].indices])
+                    xpos = xsenti[pind].mean(bdi_obj.src_emb)
+                    xneg = xsenti[nind].mean(bdi_obj.src_emb)
                     # DEBUG(xpos.shape)
                     # DEBUG(xneg.shape)
                     DEBUG(xp.linalg.norm(xpos, axis=1))
@@ -304,18 +312,18 @@ def main(args):
                     lr = args.learning_rate
                     X_src = bdi_obj.src_emb[curr_dict[:, 0]]
                     X_trg = bdi_obj.trg_proj_emb[curr_dict[:, 1]]
-                    pmean = (bdi_obj.src_proj_emb[xsenti[ysenti == 0]].sum(axis=1) / lsenti[ysenti == 0][:, xp.newaxis]).mean(axis=0)
-                    nmean = (bdi_obj.src_proj_emb[xsenti[ysenti == 1]].sum(axis=1) / lsenti[ysenti == 1][:, xp.newaxis]).mean(axis=0)
-                    sind = xp.random.randint(0, xsenti.shape[0], m)
+                    pmean = xsenti[ysenti == 0].mean(bdi_obj.src_proj_emb).mean(axis=0)
+                    nmean = xsenti[ysenti == 1].mean(bdi_obj.src_proj_emb).mean(axis=0)
+                    sind = xp.random.randint(0, len(xsenti), m)
                     pind = sind[ysenti[sind] == 0]
                     nind = sind[ysenti[sind] == 1]
                     nmean = -pmean
                     pmean /= xp.linalg.norm(pmean)
                     nmean /= xp.linalg.norm(nmean)
-                    # DEBUG(bdi_obj.src_emb[xsenti[pind]])
-                    # DEBUG(bdi_obj.src_emb[xsenti[nind]])
-                    xpos = bdi_obj.src_emb[xsenti[pind]].sum(axis=1) / lsenti[pind, xp.newaxis]
-                    xneg = bdi_obj.src_emb[xsenti[nind]].sum(axis=1) / lsenti[nind, xp.newaxis]
+                    # DEBUG(bdi_obj.src_emb[xsenti[pind].indices])
+                    # DEBUG(bdi_obj.src_emb[xsenti[nind].indices])
+                    xpos = xsenti[pind].mean(bdi_obj.src_emb)
+                    xneg = xsenti[nind].mean(bdi_obj.src_emb)
                     length_normalize(xpos, inplace=True)
                     length_normalize(xneg, inplace=True)
                     # DEBUG(xpos.shape)
@@ -354,12 +362,12 @@ def main(args):
                     lr = args.learning_rate
                     X_src = bdi_obj.src_emb[curr_dict[:, 0]]
                     X_trg = bdi_obj.trg_proj_emb[curr_dict[:, 1]]
-                    sind = xp.random.randint(0, xsenti.shape[0], m)
-                    Xs = bdi_obj.src_emb[xsenti[sind]].sum(axis=1) / lsenti[sind, xp.newaxis]
+                    sind = xp.random.randint(0, len(xsenti), m)
+                    Xs = xsenti[sind].mean(bdi_obj.src_emb)
                     ys = ysenti[sind] * (-2) + 1  # 1 = positive, -1 = negative
                     DEBUG(ys)
-                    DEBUG(bdi_obj.src_emb[xsenti[sind]].shape)
-                    DEBUG(bdi_obj.src_emb[xsenti[sind]].sum(axis=1).shape)
+                    DEBUG(xsenti[sind].indices.shape)
+                    DEBUG(xsenti[sind].sum(bdi_obj.src_emb).shape)
                     DEBUG(Xs.shape)
                     DEBUG(sind)
                     # loss = -2 * (X_src.dot(W_src) * X_trg).sum() + (alpha / m) * xp.maximum(0, 1 - (Xs.dot(W_src.dot(u)) + b) * ys).sum() + C * xp.linalg.norm(W_src)**2
@@ -404,12 +412,12 @@ def main(args):
                     lr = args.learning_rate
                     X_src = bdi_obj.src_emb[curr_dict[:, 0]]
                     X_trg = bdi_obj.trg_proj_emb[curr_dict[:, 1]]
-                    sind = xp.random.randint(0, xsenti.shape[0], m)
-                    Xs = bdi_obj.src_emb[xsenti[sind]].sum(axis=1) / lsenti[sind, xp.newaxis]
+                    sind = xp.random.randint(0, len(xsenti), m)
+                    Xs = xsenti[sind].mean(bdi_obj.src_emb)
                     ys = ysenti[sind] * (-2) + 1  # 1 = positive, -1 = negative
                     DEBUG(ys)
-                    DEBUG(bdi_obj.src_emb[xsenti[sind]].shape)
-                    DEBUG(bdi_obj.src_emb[xsenti[sind]].sum(axis=1).shape)
+                    DEBUG(xsenti[sind].indices.shape)
+                    DEBUG(xsenti[sind].sum(bdi_obj.src_emb).shape)
                     DEBUG(Xs.shape)
                     DEBUG(sind)
                     loss = xp.linalg.norm(X_src.dot(W_src) - X_trg)**2 + (alpha / m) * xp.maximum(0, 1 - (Xs.dot(W_src.dot(u - v)) + b) * ys).sum()
@@ -449,8 +457,8 @@ def main(args):
                     lr = args.learning_rate
                     X_src = bdi_obj.src_emb[curr_dict[:, 0]]
                     X_trg = bdi_obj.trg_proj_emb[curr_dict[:, 1]]
-                    sind = xp.random.randint(0, xsenti.shape[0], m)
-                    Xs = bdi_obj.src_emb[xsenti[sind]].sum(axis=1) / lsenti[sind, xp.newaxis]
+                    sind = xp.random.randint(0, len(xsenti), m)
+                    Xs = xsenti[sind].mean(bdi_obj.src_emb)
                     ys = ysenti[sind] * (-2) + 1  # 1 = positive, -1 = negative
                     # loss = -2 * (X_src.dot(W_src) * X_trg).sum() + (alpha / m) * xp.maximum(0, 1 - (Xs.dot(W_src.dot(u)) + b) * ys).sum() + C * xp.linalg.norm(W_src)**2
                     loss = (alpha / m) * xp.maximum(0, 1 - (Xs.dot(W_src.dot(u)) + b) * ys).sum()
@@ -495,8 +503,8 @@ def main(args):
                     lr = args.learning_rate
                     X_src = bdi_obj.src_emb[curr_dict[:, 0]]
                     X_trg = bdi_obj.trg_proj_emb[curr_dict[:, 1]]
-                    sind = xp.random.randint(0, xsenti.shape[0], m)
-                    Xs = bdi_obj.src_emb[xsenti[sind]].sum(axis=1) / lsenti[sind, xp.newaxis]
+                    sind = xp.random.randint(0, len(xsenti), m)
+                    Xs = xsenti[sind].mean(bdi_obj.src_emb)
                     ys = ysenti[sind] * (-2) + 1  # 1 = positive, -1 = negative
                     # loss = -2 * (X_src.dot(W_src) * X_trg).sum() + (alpha / m) * xp.maximum(0, 1 - (Xs.dot(W_src.dot(u)) + b) * ys).sum() + C * xp.linalg.norm(W_src)**2
                     loss = (alpha / m) * xp.maximum(0, 1 - (Xs.dot(W_src.dot(u)) + b) * ys).sum()
@@ -541,8 +549,8 @@ def main(args):
                     lr = args.learning_rate
                     X_src = bdi_obj.src_emb[curr_dict[:, 0]]
                     X_trg = bdi_obj.trg_proj_emb[curr_dict[:, 1]]
-                    sind = xp.random.randint(0, xsenti.shape[0], m)
-                    Xs = bdi_obj.src_emb[xsenti[sind]].sum(axis=1) / lsenti[sind, xp.newaxis]
+                    sind = xp.random.randint(0, len(xsenti), m)
+                    Xs = xsenti[sind].mean(bdi_obj.src_emb)
                     # DEBUG(ysenti[sind])
                     ys = (ysenti[sind] >= 2).astype(xp.float32) * (-2) + 1  # 1 = positive, -1 = negative
                     ts = ((ysenti[sind] == 1) | (ysenti[sind] == 3)).astype(xp.float32) + 1  # 1 = pos/neg, 2 = strpos/strneg
@@ -591,8 +599,8 @@ def main(args):
                     lr = args.learning_rate
                     X_src = bdi_obj.src_emb[curr_dict[:, 0]]
                     X_trg = bdi_obj.trg_proj_emb[curr_dict[:, 1]]
-                    sind = xp.random.randint(0, xsenti.shape[0], m)
-                    Xs = bdi_obj.src_emb[xsenti[sind]].sum(axis=1) / lsenti[sind, xp.newaxis]
+                    sind = xp.random.randint(0, len(xsenti), m)
+                    Xs = xsenti[sind].mean(bdi_obj.src_emb)
                     ys = (ysenti[sind] >= 2).astype(xp.float32) * (-2) + 1  # 1 = positive, -1 = negative
                     ts = ((ysenti[sind] == 1) | (ysenti[sind] == 3)).astype(xp.float32) + 1  # 1 = pos/neg, 2 = strpos/strneg
                     loss = (alpha / m) * xp.maximum(0, 1 - (Xs.dot(W_src.dot(u)) + b) * ys).dot(ts).sum()
@@ -810,14 +818,17 @@ if __name__ == '__main__':
     dataset_group.add_argument('--format', choices=['word2vec_bin', 'fasttext_text'], default='word2vec_bin', help='word embedding format')
     dataset_group.add_argument('-sd', '--source_dataset', default='./datasets/en/opener_sents/', help='source sentiment dataset')
     dataset_group.add_argument('-gd', '--gold_dictionary', default='./lexicons/apertium/en-es.txt', help='gold bilingual dictionary for evaluation(default: ./lexicons/apertium/en-es.txt)')
+    dataset_group.add_argument('--index_cache', default=INDEX_CACHE_DIR, help='directory of the cached indexed sentiment datasets (default: %s)' % INDEX_CACHE_DIR)
+    dataset_group.add_argument('--no_index_cache', action='store_const', const=None, dest='index_cache', help='index the sentiment datasets instead of loading them from the cache')
 
     io_group = parser.add_argument_group()
     io_group.add_argument('--load', help='restore W_src and W_trg from a file')
     io_group.add_argument('--pickle', action='store_true', help='load from pickled objects')
+    io_group.add_argument('--workers', type=int, default=1, help='number of processes used to parse fasttext embeddings')
     io_group.add_argument('--save_path', default='./checkpoints/senti.bin', help='file to save W_src and W_trg')
 
     init_group = parser.add_mutually_exclusive_group()
-    init_group.add_argument('--init_unsupervised', action='store_true', help='use unsupervised init')
+    init_group.add_argument('--init_unsupervised', nargs='?', const='exact', choices=['exact', 'sketch'], help='use unsupervised init, comparing the full sorted similarity profiles (exact) or quantile sketches of them (sketch)')
 
     mapping_group = parser.add_argument_group()
     mapping_group.add_argument('--normalize', choices=['unit', 'center', 'unitdim', 'centeremb', 'none'], nargs='*', default=['center', 'unit'], help='normalization actions')
@@ -847,11 +858,22 @@ if __name__ == '__main__':
 
     induction_group = parser.add_argument_group()
     induction_group.add_argument('-vc', '--vocab_cutoff', default=10000, type=int, help='restrict the vocabulary to k most frequent words')
+    induction_group.add_argument('--init_block_size', type=int, default=0, help='compute the unsupervised init dictionary out of core in blocks of this many rows (0 = in memory)')
+    induction_group.add_argument('--no_init_cache', action='store_true', help='recompute the unsupervised init dictionary instead of loading it from %s' % INIT_CACHE_DIR)
     induction_group.add_argument('--csls', type=int, default=10, help='number of csls neighbours')
     induction_group.add_argument('--dropout_init', type=float, default=0.1, help='initial keep prob of the dropout machanism')
     induction_group.add_argument('--dropout_interval', type=int, default=50, help='increase keep_prob every m steps')
     induction_group.add_argument('--dropout_step', type=float, default=0.1, help='increase keep_prob by a small step')
     induction_group.add_argument('--direction', choices=['forward', 'backward', 'union'], default='union', help='direction of dictionary induction')
+    induction_group.add_argument('--storage', choices=['float32', 'float16', 'int8'], default='float32', help='precision of the stored embeddings')
+    induction_group.add_argument('--ann_probes', type=int, default=0, help='search IVF indices scanning this many lists per query instead of brute force (0 = exact search)')
+    induction_group.add_argument('--num_threads', type=int, default=1, help='threads running the batches of dictionary induction concurrently')
+    induction_group.add_argument('--fused', action='store_true', help='compute the cutoff x cutoff similarity matrix once for union induction (needs --direction union)')
+    induction_group.add_argument('--knn_refresh', type=int, default=1, help='recompute the CSLS neighbourhoods every this many inductions, rescoring the cached neighbours in between')
+    induction_group.add_argument('--knn_drift', type=float, default=0.05, help='recompute the CSLS neighbourhoods when W moved by more than this relative distance')
+    induction_group.add_argument('--candidates', type=int, default=0, help='between refreshes (see --knn_refresh, which must be above 1), only rescore this many candidates per word kept from the last full induction')
+    induction_group.add_argument('--coarse_storage', choices=['float16'], default=None, help='find candidates with a float16 copy of the projected embeddings and rescore them in float32 (two-stage retrieval, requires --cuda)')
+    induction_group.add_argument('--coarse_candidates', type=int, default=10, help='candidates per word of the two-stage retrieval')
 
     recommend_group = parser.add_mutually_exclusive_group()
     recommend_group.add_argument('-u', '--unsupervised', action='store_true', help='use recommended settings')
@@ -862,7 +884,7 @@ if __name__ == '__main__':
     lang_group.add_argument('--en_eu', action='store_true', help='train english-basque embedding')
 
     args = parser.parse_args()
-    parser.set_defaults(init_unsupervised=True, csls=10, direction='union', cuda=False, normalize=['center', 'unit'],
+    parser.set_defaults(init_unsupervised='exact', csls=10, direction='union', cuda=False, normalize=['center', 'unit'],
                         vocab_cutoff=10000, alpha=5000, senti_nsample=50, spectral=True,
                         learning_rate=0.01, alpha_init=5000, alpha_step=0.01, alpha_inc=True,
                         no_proj_error=False, save_path='checkpoints/cvxse.bin',
@@ -68,28 +68,29 @@ class SentiDAN(object):
     def initialize(self):
         self.sess.run(tf.global_variables_initializer())
 
-    def fit(self, train_x, train_y, train_l, dev_x=None, dev_y=None, weights=None):
+    def fit(self, train_x, train_y, emb, dev_x=None, dev_y=None, weights=None):
+        """
+        train_x: RaggedArray
+            word indices of the training sentences
+        emb: np.ndarray
+            (projected) word embeddings
+        """
         max_f1 = 0
         self.saver.save(self.sess, TMP_FILE)
         nsample = len(train_x)
         if weights is None:
-            weights = np.ones(train_x.shape[0])
-
-        lmask = np.zeros(train_x.shape[:2])
-        for i, l in enumerate(train_l):
-            lmask[i][:l] = 1
+            weights = np.ones(nsample)
 
         for epoch in range(self.num_epoch):
             loss = 0.
             pred = np.zeros(nsample)
             for index, offset in enumerate(range(0, nsample, self.batch_size)):
-                xs = train_x[offset:offset + self.batch_size]
+                sents = train_x[offset:offset + self.batch_size]
                 ys = train_y[offset:offset + self.batch_size]
                 ws = weights[offset:offset + self.batch_size]
-                mask = np.random.rand(*xs.shape[:2]) > self.dropout
-                xs = xs * mask[:, :, np.newaxis]
-                ls = (lmask[offset:offset + self.batch_size] * mask).sum(1)
-                xs = xs.sum(1) / (ls[:, np.newaxis] + 1e-8)
+                mask = (np.random.rand(sents.indices.shape[0]) > self.dropout).astype(np.float32)
+                ls = segment_sum(mask, sents.offsets)
+                xs = segment_sum(emb[sents.indices] * mask[:, np.newaxis], sents.offsets) / (ls[:, np.newaxis] + 1e-8)
                 _, loss_, pred_ = self.sess.run([self.optimizer, self.loss, self.pred],
                                                 {self.inputs: xs,
                                                  self.labels: ys,
@@ -150,12 +151,14 @@ def main(args):
         src_lang = dic['source_lang']
         trg_lang = dic['target_lang']
         model = dic['model']
-        with open('pickle/%s.bin' % src_lang, 'rb') as fin:
-            src_wv = pickle.load(fin)
-        with open('pickle/%s.bin' % trg_lang, 'rb') as fin:
-            trg_wv = pickle.load(fin)
-        src_pad_id = src_wv.add_word('<pad>', np.zeros(src_wv.vec_dim, dtype=np.float32))
-        trg_pad_id = trg_wv.add_word('<pad>', np.zeros(trg_wv.vec_dim, dtype=np.float32))
+        if args.required_words:
+            src_wv = load_wordvecs('pickle/%s.bin' % src_lang, max_vocab=args.max_vocab,
+                                   keep=load_word_list('pickle/%s.words' % src_lang))
+            trg_wv = load_wordvecs('pickle/%s.bin' % trg_lang, max_vocab=args.max_vocab,
+                                   keep=load_word_list('pickle/%s.words' % trg_lang))
+        else:
+            src_wv = load_wordvecs('pickle/%s.bin' % src_lang)
+            trg_wv = load_wordvecs('pickle/%s.bin' % trg_lang)
         src_proj_emb = np.empty(src_wv.embedding.shape, dtype=np.float32)
         trg_proj_emb = np.empty(trg_wv.embedding.shape, dtype=np.float32)
         if model == 'ubise':
@@ -174,22 +177,21 @@ def main(args):
             trg_wv.embedding.dot(W_trg, out=trg_proj_emb)
 
         for is_binary in settings:
-            src_ds = SentimentDataset('datasets/%s/opener_sents/' % src_lang).to_index(src_wv, binary=is_binary).pad(src_pad_id, MAX_LEN)
-            trg_ds = SentimentDataset('datasets/%s/opener_sents/' % trg_lang).to_index(trg_wv, binary=is_binary).to_vecs(trg_proj_emb, shuffle=True)
+            src_ds = SentimentDataset('datasets/%s/opener_sents/' % src_lang).to_index(src_wv, binary=is_binary, cache_dir=args.index_cache).to_ragged(MAX_LEN)
+            trg_ds = SentimentDataset('datasets/%s/opener_sents/' % trg_lang).to_index(trg_wv, binary=is_binary, cache_dir=args.index_cache).to_vecs(trg_proj_emb, shuffle=True)
             vec_dim = src_proj_emb.shape[1]
 
-            train_x = src_proj_emb[src_ds.train[0]]
+            train_x = src_ds.train[0]
             train_y = src_ds.train[1]
-            train_l = src_ds.train[2]
-            perm = np.random.permutation(train_x.shape[0])
-            train_x, train_y, train_l = train_x[perm], train_y[perm], train_l[perm]
+            perm = np.random.permutation(len(train_x))
+            train_x, train_y = train_x[perm], train_y[perm]
             dev_x = np.concatenate((trg_ds.train[0], trg_ds.dev[0]), axis=0)
             dev_y = np.concatenate((trg_ds.train[1], trg_ds.dev[1]), axis=0)
             test_x = trg_ds.test[0]
             test_y = trg_ds.test[1]
 
             class_weight = compute_class_weight('balanced', np.unique(train_y), train_y)
-            weights = np.zeros(train_x.shape[0], dtype=np.float32)
+            weights = np.zeros(len(train_x), dtype=np.float32)
             for t, w in enumerate(class_weight):
                 weights[train_y == t] = w
             # if is_binary:
@@ -208,7 +210,7 @@ def main(args):
                         cnn = SentiDAN(sess, vec_dim, (2 if is_binary else 4),
                                        args.learning_rate, args.batch_size, args.epochs, args.dropout, C)
                         cnn.initialize()
-                        cnn.fit(train_x, train_y, train_l, dev_x, dev_y, weights)
+                        cnn.fit(train_x, train_y, src_proj_emb, dev_x, dev_y, weights)
                         pred = cnn.predict(test_x)
                         score = f1_score(test_y, pred, average='macro')
                         if cnn.best_score_ > best_dev:
@@ -271,6 +273,22 @@ if __name__ == '__main__':
                         help='regularization parameter')
     parser.add_argument('-o', '--output',
                         help='output file')
+    parser.add_argument('--required_words',
+                        action='store_true',
+                        help='only load the words listed in pickle/<lang>.words (see required_words.py) '
+                             'from memory-mapped embedding stores')
+    parser.add_argument('--max_vocab',
+                        type=int,
+                        default=0,
+                        help='with --required_words, also load the first max_vocab words (default: 0)')
+    parser.add_argument('--index_cache',
+                        help='directory of the cached indexed sentiment datasets (default: %s)' % INDEX_CACHE_DIR,
+                        default=INDEX_CACHE_DIR)
+    parser.add_argument('--no_index_cache',
+                        help='index the sentiment datasets instead of loading them from the cache',
+                        action='store_const',
+                        const=None,
+                        dest='index_cache')
     parser.add_argument('--debug',
                         help='print debug info',
                         action='store_const',
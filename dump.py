@@ -1,3 +1,4 @@
+import argparse
 import pickle
 import os
 from utils.dataset import *
@@ -9,14 +10,29 @@ FORMAT = 'fasttext_text'
 NORMALIZE = ('unit', 'center', 'unit',)
 LANGS = ('en', 'es', 'ca', 'eu')
 
-def main():
+
+def main(args):
     if not os.path.exists('pickle'):
         os.mkdir('pickle')
     for lang in LANGS:
-        wv = WordVecs(TARGET % lang, emb_format=FORMAT).normalize(NORMALIZE)
-        with open('pickle/%s.bin' % lang, 'wb') as fout:
-            pickle.dump(wv, fout)
+        wv = WordVecs(TARGET % lang, emb_format=FORMAT, workers=args.workers).normalize(NORMALIZE)
+        if args.output_format == 'mmap':
+            wv.save('pickle/%s' % lang)
+        else:
+            with open('pickle/%s.bin' % lang, 'wb') as fout:
+                pickle.dump(wv, fout)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_format',
+                        choices=['pickle', 'mmap'],
+                        default='pickle',
+                        help='pickled WordVecs objects or memory-mapped binary stores (default: pickle)')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='number of processes used to parse fasttext embeddings (default: 1)')
+
+    args = parser.parse_args()
+    main(args)
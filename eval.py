@@ -1,6 +1,6 @@
 import numpy as np
 from sklearn import svm
-from sklearn.model_selection import GridSearchCV, PredefinedSplit
+from sklearn.model_selection import PredefinedSplit
 from sklearn.metrics import f1_score, confusion_matrix
 from sklearn.exceptions import UndefinedMetricWarning, ConvergenceWarning
 from sklearn.utils.testing import ignore_warnings
@@ -14,6 +14,7 @@ from utils.math import *
 from utils.bdi import *
 from utils.cupy_utils import *
 from utils.model import *
+from utils.sklearn_utils import *
 
 
 @ignore_warnings(category=ConvergenceWarning)
@@ -40,38 +41,37 @@ def main(args):
         src_lang = dic['source_lang']
         trg_lang = dic['target_lang']
         model = dic['model']
-        with open('pickle/%s.bin' % src_lang, 'rb') as fin:
-            src_wv = pickle.load(fin)
-        with open('pickle/%s.bin' % trg_lang, 'rb') as fin:
-            trg_wv = pickle.load(fin)
-        src_proj_emb = np.empty(src_wv.embedding.shape, dtype=np.float32)
-        trg_proj_emb = np.empty(trg_wv.embedding.shape, dtype=np.float32)
+        if args.required_words:
+            src_wv = load_wordvecs('pickle/%s.bin' % src_lang, max_vocab=args.max_vocab,
+                                   keep=load_word_list('pickle/%s.words' % src_lang))
+            trg_wv = load_wordvecs('pickle/%s.bin' % trg_lang, max_vocab=args.max_vocab,
+                                   keep=load_word_list('pickle/%s.words' % trg_lang))
+        else:
+            src_wv = load_wordvecs('pickle/%s.bin' % src_lang)
+            trg_wv = load_wordvecs('pickle/%s.bin' % trg_lang)
         if model == 'ubise':
+            src_proj_emb = np.empty(src_wv.embedding.shape, dtype=np.float32)
+            trg_proj_emb = np.empty(trg_wv.embedding.shape, dtype=np.float32)
             src_wv.embedding.dot(W_src, out=src_proj_emb)
             length_normalize(src_proj_emb, inplace=True)
             trg_wv.embedding.dot(W_trg, out=trg_proj_emb)
             length_normalize(trg_proj_emb, inplace=True)
-        elif model == 'ubi':
-            src_wv.embedding.dot(W_src, out=src_proj_emb)
-            trg_wv.embedding.dot(W_trg, out=trg_proj_emb)
-        elif model == 'blse':
-            src_wv.embedding.dot(W_src, out=src_proj_emb)
-            trg_wv.embedding.dot(W_trg, out=trg_proj_emb)
+            W_src = W_trg = None
         else:
-            src_wv.embedding.dot(W_src, out=src_proj_emb)
-            trg_wv.embedding.dot(W_trg, out=trg_proj_emb)
+            # linear projection: pool the sentences first and project the sentence vectors
+            src_proj_emb, trg_proj_emb = src_wv.embedding, trg_wv.embedding
 
         for is_binary in (True, False):
             if trg_lang in ('es', 'ca', 'eu'):
-                src_ds = SentimentDataset('datasets/%s/opener_sents/' % src_lang).to_index(src_wv, binary=is_binary).to_vecs(src_proj_emb, shuffle=True)
-                trg_ds = SentimentDataset('datasets/%s/opener_sents/' % trg_lang).to_index(trg_wv, binary=is_binary).to_vecs(trg_proj_emb, shuffle=True)
+                src_ds = SentimentDataset('datasets/%s/opener_sents/' % src_lang).to_index(src_wv, binary=is_binary, cache_dir=args.index_cache).to_vecs(src_proj_emb, shuffle=True, W=W_src)
+                trg_ds = SentimentDataset('datasets/%s/opener_sents/' % trg_lang).to_index(trg_wv, binary=is_binary, cache_dir=args.index_cache).to_vecs(trg_proj_emb, shuffle=True, W=W_trg)
             else:
                 if not is_binary:
                     continue  # only binary setting for fr/de/ja
 
                 dom = dic.get('domain', 'books')
-                src_ds = SentimentDataset('datasets/cls10/%s/%s/' % (src_lang, dom)).to_index(src_wv, binary=is_binary).to_vecs(src_proj_emb, shuffle=True)
-                trg_ds = SentimentDataset('datasets/cls10/%s/%s/' % ('jp' if trg_lang =='ja' else trg_lang, dom)).to_index(trg_wv, binary=is_binary).to_vecs(trg_proj_emb, shuffle=True)
+                src_ds = SentimentDataset('datasets/cls10/%s/%s/' % (src_lang, dom)).to_index(src_wv, binary=is_binary, cache_dir=args.index_cache).to_vecs(src_proj_emb, shuffle=True, W=W_src)
+                trg_ds = SentimentDataset('datasets/cls10/%s/%s/' % ('jp' if trg_lang =='ja' else trg_lang, dom)).to_index(trg_wv, binary=is_binary, cache_dir=args.index_cache).to_vecs(trg_proj_emb, shuffle=True, W=W_trg)
             train_dev_x = np.concatenate((src_ds.train[0], trg_ds.train[0], trg_ds.dev[0]), axis=0)
             train_dev_y = np.concatenate((src_ds.train[1], trg_ds.train[1], trg_ds.dev[1]), axis=0)
             train_test_x = np.concatenate((src_ds.train[0], trg_ds.test[0]), axis=0)
@@ -89,15 +89,17 @@ def main(args):
                 cv_fold[:train_x.shape[0]] = -1
                 cv_split = PredefinedSplit(cv_fold)
 
-                clf = GridSearchCV(svc, param_grid, scoring='f1_macro', n_jobs=cpu_count(), cv=cv_split)
-                clf.fit(train_dev_x, train_dev_y)
-                best_C = clf.best_params_['C']
+                # the workers attach to one shared copy of the sentence vectors
+                clf = shared_grid_search(svc, param_grid, train_dev_x, train_dev_y, scoring='f1_macro',
+                                         n_jobs=cpu_count(), cv=cv_split, refit=False)
+                best_C = clf.best_params_['estimator__C']
                 pred = svc.set_params(C=best_C).fit(train_x, train_y).predict(test_x)
             test_score = f1_score(test_y, pred, average='macro')
-            best_clf = GridSearchCV(svc, param_grid, scoring='f1_macro', n_jobs=cpu_count(),
-                                    cv=PredefinedSplit([-1] * train_x.shape[0] + [0] * test_x.shape[0])).fit(train_test_x, train_test_y)
+            best_clf = shared_grid_search(svc, param_grid, train_test_x, train_test_y, scoring='f1_macro',
+                                          n_jobs=cpu_count(), refit=False,
+                                          cv=PredefinedSplit([-1] * train_x.shape[0] + [0] * test_x.shape[0]))
             best_test_f1 = best_clf.best_score_
-            best_C = best_clf.best_params_['C']
+            best_C = best_clf.best_params_['estimator__C']
             print('------------------------------------------------------')
             print('Is binary: {0}'.format(is_binary))
             print('Result for {0}:'.format(infile))
@@ -129,6 +131,22 @@ if __name__ == '__main__':
                         help='multi-class strategy (default: ovr)')
     parser.add_argument('-o', '--output',
                         help='output file')
+    parser.add_argument('--required_words',
+                        action='store_true',
+                        help='only load the words listed in pickle/<lang>.words (see required_words.py) '
+                             'from memory-mapped embedding stores')
+    parser.add_argument('--max_vocab',
+                        type=int,
+                        default=0,
+                        help='with --required_words, also load the first max_vocab words (default: 0)')
+    parser.add_argument('--index_cache',
+                        default=INDEX_CACHE_DIR,
+                        help='directory of the cached indexed sentiment datasets (default: %s)' % INDEX_CACHE_DIR)
+    parser.add_argument('--no_index_cache',
+                        action='store_const',
+                        const=None,
+                        dest='index_cache',
+                        help='index the sentiment datasets instead of loading them from the cache')
     parser.add_argument('--debug',
                         action='store_const',
                         dest='loglevel',
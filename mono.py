@@ -2,21 +2,20 @@ import numpy as np
 import logging
 import argparse
 from sklearn import svm
-from sklearn.model_selection import GridSearchCV
+from sklearn.metrics import f1_score
 from multiprocessing import cpu_count
 from utils.dataset import *
 from utils.math import *
 from utils.bdi import *
+from utils.sklearn_utils import *
 
 
 def lookup_and_shuffle(X, y, emb, binary=False):
-    X_new = np.zeros((len(X), emb.shape[1]))
-    for i, line in enumerate(X):
-        if len(line) == 0:
-            logging.warning('ZERO LENGTH EXAMPLE')
-            continue
-        X_new[i] = np.mean(emb[line], axis=0)
-    X = X_new
+    S = pooling_matrix(X, emb.shape[0], 'mean')
+    nempty = int((S.getnnz(axis=1) == 0).sum())
+    if nempty > 0:
+        logging.warning('%d ZERO LENGTH EXAMPLES' % nempty)
+    X = pool(S, emb)
 
     perm = np.random.permutation(X.shape[0])
     X, y = X[perm], y[perm]
@@ -31,7 +30,7 @@ def main(args):
     # load word embedding
     target_wordvec = WordVecs(args.target_embedding, normalize=args.normalize)
 
-    target_dataset = SentimentDataset(args.target_dataset).to_index(target_wordvec)
+    target_dataset = SentimentDataset(args.target_dataset).to_index(target_wordvec, cache_dir=args.index_cache)
 
     # embedding lookup and prepare traning data
 
@@ -43,11 +42,11 @@ def main(args):
         'C': [0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100],
     }
     svc = svm.LinearSVC()
-    clf = GridSearchCV(svc, param_grid, scoring='f1_macro', n_jobs=cpu_count())
+    # the workers attach to one shared copy of the sentence vectors
+    clf = shared_grid_search(svc, param_grid, train_x, train_y, scoring='f1_macro', n_jobs=cpu_count())
 
-    clf.fit(train_x, train_y)
-
-    print('Test F1_macro: %.4f' % clf.score(test_x, test_y))
+    pred = clf.best_estimator_.estimator_.predict(test_x)
+    print('Test F1_macro: %.4f' % f1_score(test_y, pred, average='macro'))
     print('Best params: ', clf.best_params_)
     print('CV result:', clf.cv_results_)
 
@@ -69,6 +68,14 @@ if __name__ == '__main__':
     parser.add_argument('--normalize',
                         help='mean center and normalize word vectors',
                         action='store_true')
+    parser.add_argument('--index_cache',
+                        help='directory of the cached indexed sentiment datasets (default: %s)' % INDEX_CACHE_DIR,
+                        default=INDEX_CACHE_DIR)
+    parser.add_argument('--no_index_cache',
+                        help='index the sentiment datasets instead of loading them from the cache',
+                        action='store_const',
+                        const=None,
+                        dest='index_cache')
     parser.add_argument('--debug',
                         help='print debug info',
                         action='store_const',
@@ -39,10 +39,8 @@ def main(args):
         src_lang = dic['source_lang']
         trg_lang = dic['target_lang']
         model = dic['model']
-        with open(EMB_PATH % src_lang, 'rb') as fin:
-            src_wv = pickle.load(fin)
-        with open(EMB_PATH % trg_lang, 'rb') as fin:
-            trg_wv = pickle.load(fin)
+        src_wv = load_wordvecs(EMB_PATH % src_lang)
+        trg_wv = load_wordvecs(EMB_PATH % trg_lang)
         src_senti_words = SentiWordSet(SENTI_PATH % src_lang).to_index(src_wv)
         trg_senti_words = SentiWordSet(SENTI_PATH % trg_lang).to_index(trg_wv)
         src_offsets = [0] + list(accumulate([len(t) for t in src_senti_words.wordsets]))
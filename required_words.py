@@ -0,0 +1,30 @@
+import argparse
+import os
+from utils.dataset import *
+
+LANGS = ('en', 'es', 'ca', 'eu')
+
+
+def main(args):
+    if not os.path.exists(os.path.dirname(args.output) or '.'):
+        os.makedirs(os.path.dirname(args.output))
+    for lang in args.langs:
+        words = sorted(required_words(lang))
+        with open(args.output % lang, 'w', encoding='utf-8', newline='\n') as fout:
+            fout.write('\n'.join(words))
+        print('%s: %d words' % (lang, len(words)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='write the words of each language needed by the experiments, '
+                                                 'so that evaluation scripts only load these embeddings')
+    parser.add_argument('--langs',
+                        nargs='+',
+                        default=LANGS,
+                        help='languages (default: en es ca eu)')
+    parser.add_argument('-o', '--output',
+                        default='pickle/%s.words',
+                        help='output file pattern (default: pickle/%%s.words)')
+
+    args = parser.parse_args()
+    main(args)
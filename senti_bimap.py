@@ -107,15 +107,13 @@ def main(args):
     log_file = open(args.log, 'w', encoding='utf-8')
 
     if args.pickle:
-        with open(args.source_embedding, 'rb') as fin:
-            src_wv = pickle.load(fin)
-        with open(args.target_embedding, 'rb') as fin:
-            trg_wv = pickle.load(fin)
+        src_wv = load_wordvecs(args.source_embedding)
+        trg_wv = load_wordvecs(args.target_embedding)
     else:
         src_wv = WordVecs(args.source_embedding, emb_format=args.format).normalize(args.normalize)
         trg_wv = WordVecs(args.target_embedding, emb_format=args.format).normalize(args.normalize)
-    src_ds = SentimentDataset(args.source_dataset).to_index(src_wv).to_vecs(src_wv.embedding)
-    trg_ds = SentimentDataset(args.target_dataset).to_index(trg_wv).to_vecs(trg_wv.embedding)
+    src_ds = SentimentDataset(args.source_dataset).to_index(src_wv, cache_dir=args.index_cache).to_vecs(src_wv.embedding)
+    trg_ds = SentimentDataset(args.target_dataset).to_index(trg_wv, cache_dir=args.index_cache).to_vecs(trg_wv.embedding)
     src_pos, src_neg = get_pos_neg_vecs(xp.array(src_ds.train[0]), xp.array(src_ds.train[1]))
     trg_pos, trg_neg = get_pos_neg_vecs(xp.array(trg_ds.train[0]), xp.array(trg_ds.train[1]))
     gold_dict = xp.array(BilingualDict(args.gold_dictionary).get_indexed_dictionary(src_wv, trg_wv), dtype=xp.int32)
@@ -127,7 +125,8 @@ def main(args):
     if args.init_num:
         init_dict = get_numeral_init_dict(src_wv, trg_wv)
     elif args.init_unsupervised:
-        init_dict = get_unsupervised_init_dict(src_wv.embedding, trg_wv.embedding, args.vocab_cutoff, args.csls, args.normalize, args.direction)
+        init_dict = get_unsupervised_init_dict(src_wv.embedding, trg_wv.embedding, args.vocab_cutoff, args.csls, args.normalize, args.direction,
+                                               block_size=args.init_block_size, cache_dir=None if args.no_init_cache else INIT_CACHE_DIR)
         init_dict = xp.array(init_dict)
     elif args.init_random:
         size = args.vocab_cutoff * 2 if args.direction == 'both' else args.vocab_cutoff
@@ -236,6 +235,8 @@ if __name__ == '__main__':
     dataset_group.add_argument('-sd', '--source_dataset', default='./datasets/en/opener_sents/', help='source sentiment dataset')
     dataset_group.add_argument('-td', '--target_dataset', default='./datasets/es/opener_sents/', help='target sentiment dataset')
     dataset_group.add_argument('-gd', '--gold_dictionary', default='./lexicons/apertium/en-es.txt', help='gold bilingual dictionary for evaluation(default: ./lexicons/apertium/en-es.txt)')
+    dataset_group.add_argument('--index_cache', default=INDEX_CACHE_DIR, help='directory of the cached indexed sentiment datasets (default: %s)' % INDEX_CACHE_DIR)
+    dataset_group.add_argument('--no_index_cache', action='store_const', const=None, dest='index_cache', help='index the sentiment datasets instead of loading them from the cache')
 
     io_group = parser.add_argument_group()
     io_group.add_argument('--load', help='restore W_src and W_trg from a file')
@@ -277,6 +278,8 @@ if __name__ == '__main__':
 
     induction_group = parser.add_argument_group()
     induction_group.add_argument('-vc', '--vocab_cutoff', default=10000, type=int, help='restrict the vocabulary to k most frequent words')
+    induction_group.add_argument('--init_block_size', type=int, default=0, help='compute the unsupervised init dictionary out of core in blocks of this many rows (0 = in memory)')
+    induction_group.add_argument('--no_init_cache', action='store_true', help='recompute the unsupervised init dictionary instead of loading it from %s' % INIT_CACHE_DIR)
     induction_group.add_argument('--csls', type=int, default=10, help='number of csls neighbours')
     induction_group.add_argument('--dropout_init', type=float, default=0.1, help='initial keep prob of the dropout machanism')
     induction_group.add_argument('--dropout_interval', type=int, default=50, help='increase keep_prob every m steps')
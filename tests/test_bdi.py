@@ -0,0 +1,153 @@
+import numpy as np
+import pytest
+
+from utils import bdi
+from utils.bdi import BDI, get_unsupervised_init_dict, similarity_sketch
+from utils.math import length_normalize
+
+
+def embedding_pair(n=1200, d=64, seed=1):
+    """
+    Source embeddings and a noisy rotation of them, so that word i translates to i.
+    """
+    rng = np.random.default_rng(seed)
+    src = rng.standard_normal((n, d)).astype(np.float32)
+    rotation = np.linalg.qr(rng.standard_normal((d, d)))[0]
+    trg = (src @ rotation + rng.standard_normal((n, d))).astype(np.float32)
+    return length_normalize(src), length_normalize(trg)
+
+
+def make_bdi(src, trg, cutoff_size, **kwargs):
+    val_ind = np.arange(0, cutoff_size, 7)
+    kwargs = dict(dict(batch_size=500, direction='union', csls=10), **kwargs)
+    return BDI(src, trg, cutoff_size=cutoff_size, src_val_ind=val_ind, trg_val_ind=val_ind, **kwargs)
+
+
+@pytest.fixture
+def half_gemm(monkeypatch):
+    """
+    Stand-in for the half precision GEMM of cupy, so that two-stage retrieval runs on numpy.
+    """
+    monkeypatch.setattr(bdi, 'half_dot', lambda X, Y: X.astype(np.float32).dot(Y.astype(np.float32).T))
+
+
+def test_coarse_storage_requires_half_gemm():
+    src, trg = embedding_pair(n=100)
+    with pytest.raises(ValueError):
+        make_bdi(src, trg, 50, coarse_storage='float16')
+
+
+def test_coarse_storage_rejects_int8(half_gemm):
+    src, trg = embedding_pair(n=100)
+    with pytest.raises(ValueError):
+        make_bdi(src, trg, 50, coarse_storage='int8')
+
+
+@pytest.mark.parametrize('scorer', ['dot', 'cos', 'euclidean'])
+@pytest.mark.parametrize('storage', ['float32', 'float16', 'int8'])
+def test_two_stage_matches_exact(half_gemm, scorer, storage):
+    src, trg = embedding_pair()
+    n = 1100
+    exact = make_bdi(src, trg, n, scorer=scorer, storage=storage)
+    coarse = make_bdi(src, trg, n, scorer=scorer, storage=storage, coarse_storage='float16')
+    W = np.identity(src.shape[1], dtype=np.float32) + 0.01 * np.random.default_rng(2).standard_normal(
+        (src.shape[1], src.shape[1])).astype(np.float32)
+    for b in (exact, coarse):
+        b.project(W, 'backward', full_trg=True)
+        b.project(W.T, 'forward')
+
+    # the first stage reads the float16 copies kept up to date by project
+    assert np.array_equal(coarse.trg_coarse, np.asarray(coarse.trg_proj_emb[:]).astype(np.float16))
+    assert np.array_equal(coarse.src_coarse, coarse.src_proj_emb[:coarse.bwd_src_size].astype(np.float16))
+    if storage == 'float16':
+        assert np.shares_memory(coarse.trg_coarse, coarse.trg_proj_emb.Q)
+
+    # half precision candidates may only miss near ties of the exact scores
+    exact_dict = exact.get_bilingual_dict_with_cutoff()
+    coarse_dict = coarse.get_bilingual_dict_with_cutoff()
+    assert exact_dict.shape == coarse_dict.shape
+    assert np.mean((exact_dict == coarse_dict).all(axis=1)) >= 0.99
+    val_ind = np.arange(0, n, 7)
+    assert np.mean(exact.get_target_indices(val_ind) == coarse.get_target_indices(val_ind)) >= 0.99
+
+
+def test_coarse_copy_follows_partial_projection(half_gemm):
+    src, trg = embedding_pair(n=300)
+    b = make_bdi(src, trg, 200, coarse_storage='float16')
+    W = np.linalg.qr(np.random.default_rng(3).standard_normal((src.shape[1], src.shape[1])))[0].astype(np.float32)
+    b.project(W, 'backward', unit_norm=True, scale=True)
+    rows = b.trg_val_ind
+    assert np.array_equal(b.trg_coarse[rows], b.trg_proj_emb[rows].astype(np.float16))
+
+
+@pytest.mark.parametrize('storage', ['float16', 'int8'])
+def test_quantized_full_projection_in_blocks(monkeypatch, storage):
+    monkeypatch.setattr(bdi, 'QUANT_BATCH_SIZE', 64)
+    src, trg = embedding_pair(n=300)
+    W = np.linalg.qr(np.random.default_rng(4).standard_normal((src.shape[1], src.shape[1])))[0].astype(np.float32)
+    exact = make_bdi(src, trg, 200).project(W, 'backward', unit_norm=True, scale=True, full_trg=True)
+    quantized = make_bdi(src, trg, 200, storage=storage).project(W, 'backward', unit_norm=True, scale=True,
+                                                                 full_trg=True)
+    assert np.allclose(quantized.trg_proj_emb[:], exact.trg_proj_emb, atol=0.02)
+
+
+def test_candidates_require_knn_refresh():
+    src, trg = embedding_pair(n=100)
+    with pytest.raises(ValueError):
+        make_bdi(src, trg, 50, candidates=5)
+
+
+def test_candidates_rerank_between_refreshes(monkeypatch):
+    src, trg = embedding_pair(n=600)
+    exact = make_bdi(src, trg, 500)
+    b = make_bdi(src, trg, 500, knn_refresh=3, knn_drift=1., candidates=5)
+    calls = []
+    rerank = b._rerank
+    monkeypatch.setattr(b, '_rerank', lambda *args: calls.append(1) or rerank(*args))
+    W = np.identity(src.shape[1], dtype=np.float32)
+    for step in range(3):
+        W = W + 0.001 * np.random.default_rng(step).standard_normal(W.shape).astype(np.float32)
+        for obj in (exact, b):
+            obj.project(W, 'backward')
+        assert np.array_equal(exact.get_bilingual_dict_with_cutoff(), b.get_bilingual_dict_with_cutoff())
+        # the first call is a full pass, the next two rerank both directions
+        assert len(calls) == (0, 2, 4)[step]
+
+
+@pytest.mark.parametrize('kwargs', [dict(ann_probes=4), dict(coarse_storage='float16'), dict(knn_refresh=3),
+                                    dict(knn_refresh=3, candidates=5)])
+def test_fused_rejects_other_retrieval_options(half_gemm, kwargs):
+    src, trg = embedding_pair(n=100)
+    with pytest.raises(ValueError):
+        make_bdi(src, trg, 50, fused=True, **kwargs)
+
+
+@pytest.mark.parametrize('kwargs', [dict(coarse_storage='float16'), dict(knn_refresh=3),
+                                    dict(knn_refresh=3, candidates=5)])
+def test_ann_rejects_other_retrieval_options(half_gemm, kwargs):
+    src, trg = embedding_pair(n=100)
+    with pytest.raises(ValueError):
+        make_bdi(src, trg, 50, ann_probes=4, **kwargs)
+
+
+def test_similarity_sketch_quantiles():
+    emb = np.random.default_rng(6).standard_normal((50, 8)).astype(np.float32)
+    u, s, _ = np.linalg.svd(emb, full_matrices=False)
+    profiles = np.sort((u * s) @ u.T, axis=1)
+    assert np.allclose(similarity_sketch(emb, 50), profiles)
+    cols = np.linspace(0, 49, 10).round().astype(np.int64)
+    assert np.allclose(similarity_sketch(emb, 10, block_size=7), profiles[:, cols])
+
+
+def test_sketch_init_recovers_exact_init():
+    rng = np.random.default_rng(5)
+    n, d = 800, 32
+    src = rng.standard_normal((n, d)).astype(np.float32) * np.linspace(3, .5, d).astype(np.float32)
+    rotation = np.linalg.qr(rng.standard_normal((d, d)))[0]
+    trg = (src @ rotation + 0.05 * rng.standard_normal((n, d))).astype(np.float32)
+    src, trg = length_normalize(src), length_normalize(trg)
+    args = (src, trg, 600, 10, ['unit', 'center', 'unit'], 'union')
+    exact = {tuple(p) for p in get_unsupervised_init_dict(*args, method='exact', cache_dir=None).tolist()}
+    sketch = {tuple(p) for p in get_unsupervised_init_dict(*args, method='sketch', sketch_size=64,
+                                                           cache_dir=None).tolist()}
+    assert len(exact & sketch) >= 0.9 * len(exact)
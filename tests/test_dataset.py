@@ -0,0 +1,16 @@
+import logging
+import pickle
+
+from utils.dataset import load_wordvecs
+
+
+def test_load_wordvecs_warns_when_pickle_ignores_filter(tmp_path, caplog):
+    path = str(tmp_path / 'en.bin')
+    with open(path, 'wb') as fout:
+        pickle.dump({'words': ['a', 'b']}, fout)
+    with caplog.at_level(logging.WARNING):
+        assert load_wordvecs(path) == {'words': ['a', 'b']}
+    assert not caplog.records
+    with caplog.at_level(logging.WARNING):
+        assert load_wordvecs(path, keep={'a'}) == {'words': ['a', 'b']}
+    assert 'loading all its words' in caplog.text
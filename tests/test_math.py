@@ -0,0 +1,15 @@
+import numpy as np
+
+from utils.math import top_k_mean
+
+
+def test_top_k_mean():
+    X = np.array([[1, 5, 3], [4, 2, 0]], dtype=np.float32)
+    assert np.allclose(top_k_mean(X, 2), [4, 3])
+    assert np.allclose(top_k_mean(X, 10), [3, 2])
+    assert np.array_equal(top_k_mean(X, 0), [0, 0])
+
+
+def test_top_k_mean_without_columns():
+    ans = top_k_mean(np.empty((3, 0), dtype=np.float32), 10)
+    assert np.array_equal(ans, np.zeros(3))
@@ -0,0 +1,31 @@
+import multiprocessing
+
+import numpy as np
+
+from utils.shm import share_array, attach_array, detach, release, _attached, _owned
+
+
+def _worker_rows(args):
+    name, rows = args
+    try:
+        return attach_array(name)[rows].copy(), name in _attached
+    finally:
+        detach(name)
+
+
+def test_workers_attach_and_detach():
+    name = 'test_shm_rows'
+    X = np.arange(20, dtype=np.float32).reshape(10, 2)
+    share_array(name, X)
+    try:
+        with multiprocessing.get_context('spawn').Pool(2) as pool:
+            results = pool.map(_worker_rows, [(name, [1, 3]), (name, [8])])
+        assert np.array_equal(results[0][0], X[[1, 3]])
+        assert np.array_equal(results[1][0], X[[8]])
+        assert all(attached for _, attached in results)
+        # detaching in the owner leaves the shared array in place
+        detach(name)
+        assert np.array_equal(attach_array(name), X)
+    finally:
+        release(name)
+    assert name not in _owned
@@ -4,6 +4,7 @@ import logging
 import sys
 import os
 import re
+import time
 import numpy as np
 from sklearn.model_selection import GridSearchCV, PredefinedSplit
 from sklearn.exceptions import UndefinedMetricWarning, ConvergenceWarning
@@ -95,19 +96,19 @@ def main(args):
 
     # load source and target embeddings
     if args.pickle:
-        with open(args.source_embedding, 'rb') as fin:
-            src_wv = pickle.load(fin)
-        with open(args.target_embedding, 'rb') as fin:
-            trg_wv = pickle.load(fin)
+        src_wv = load_wordvecs(args.source_embedding)
+        trg_wv = load_wordvecs(args.target_embedding)
     else:
-        src_wv = WordVecs(args.source_embedding, emb_format=args.format).normalize(args.normalize)
-        trg_wv = WordVecs(args.target_embedding, emb_format=args.format).normalize(args.normalize)
+        src_wv = WordVecs(args.source_embedding, emb_format=args.format, workers=args.workers).normalize(args.normalize)
+        trg_wv = WordVecs(args.target_embedding, emb_format=args.format, workers=args.workers).normalize(args.normalize)
 
     # sentiment array
     src_pad_id = src_wv.add_word('<pad>', np.zeros(args.vector_dim, dtype=np.float32))
-    src_ds = SentimentDataset(args.source_dataset).to_index(src_wv, binary=args.binary).pad(src_pad_id)
+    src_ds = SentimentDataset(args.source_dataset).to_index(src_wv, binary=args.binary, cache_dir=args.index_cache).pad(src_pad_id)
     trg_pad_id = trg_wv.add_word('<pad>', np.zeros(args.vector_dim, dtype=np.float32))
-    trg_ds = SentimentDataset(args.target_dataset).to_index(trg_wv, binary=args.binary).pad(trg_pad_id)
+    trg_ds = SentimentDataset(args.target_dataset).to_index(trg_wv, binary=args.binary, cache_dir=args.index_cache).pad(trg_pad_id)
+    src_wv.quantize(args.storage)
+    trg_wv.quantize(args.storage)
     train_x, train_y, train_l = src_ds.train[0], src_ds.train[1], src_ds.train[2]
     dev_x = np.concatenate((trg_ds.train[0], trg_ds.dev[0]), axis=0)
     dev_y = np.concatenate((trg_ds.train[1], trg_ds.dev[1]), axis=0)
@@ -147,10 +148,16 @@ def main(args):
 
     # prepare dictionaries
     gold_dict = xp.array(BilingualDict(args.gold_dictionary).get_indexed_dictionary(src_wv, trg_wv), dtype=xp.int32)
-    init_dict = get_unsupervised_init_dict(src_wv.embedding, trg_wv.embedding, args.vocab_cutoff, args.csls, args.normalize, args.direction)
+    t0 = time.time()
+    init_dict = get_unsupervised_init_dict(src_wv.embedding, trg_wv.embedding, args.vocab_cutoff, args.csls, args.normalize, args.direction,
+                                           block_size=args.init_block_size, method=args.init_unsupervised,
+                                           cache_dir=None if args.no_init_cache else INIT_CACHE_DIR)
     init_dict = xp.array(init_dict)
+    init_time = time.time() - t0
     curr_dict = init_dict
     print('gold dict shape' + str(gold_dict.shape))
+    print('init dict (%s): %d pairs  time: %.2fs  precision: %.4f' % (args.init_unsupervised, init_dict.shape[0],
+                                                                    init_time, dict_precision(init_dict, gold_dict)))
 
     # initialize hyper parameters
     keep_prob = args.dropout_init
@@ -161,7 +168,10 @@ def main(args):
     # construct BDI object
     bdi_obj = BDI(src_wv.embedding, trg_wv.embedding, batch_size=args.batch_size, cutoff_size=args.vocab_cutoff, cutoff_type='both',
                   direction=args.direction, csls=args.csls, batch_size_val=args.val_batch_size, scorer=args.scorer,
-                  src_val_ind=src_val_ind, trg_val_ind=gold_dict[:, 1])
+                  src_val_ind=src_val_ind, trg_val_ind=gold_dict[:, 1], storage=args.storage,
+                  ann_probes=args.ann_probes, num_threads=args.num_threads, fused=args.fused,
+                  knn_refresh=args.knn_refresh, knn_drift=args.knn_drift, candidates=args.candidates,
+                  coarse_storage=args.coarse_storage, coarse_candidates=args.coarse_candidates)
 
     # print alignment error
     if not args.no_proj_error:
@@ -410,10 +420,13 @@ if __name__ == '__main__':
     dataset_group.add_argument('--format', choices=['word2vec_bin', 'fasttext_text'], default='word2vec_bin', help='word embedding format')
     dataset_group.add_argument('-sd', '--source_dataset', default='./datasets/en/opener_sents/', help='source sentiment dataset')
     dataset_group.add_argument('-gd', '--gold_dictionary', default='./lexicons/apertium/en-es.txt', help='gold bilingual dictionary for evaluation(default: ./lexicons/apertium/en-es.txt)')
+    dataset_group.add_argument('--index_cache', default=INDEX_CACHE_DIR, help='directory of the cached indexed sentiment datasets (default: %s)' % INDEX_CACHE_DIR)
+    dataset_group.add_argument('--no_index_cache', action='store_const', const=None, dest='index_cache', help='index the sentiment datasets instead of loading them from the cache')
 
     io_group = parser.add_argument_group()
     io_group.add_argument('--load', help='restore W_src and W_trg from a file')
     io_group.add_argument('--pickle', action='store_true', help='load from pickled objects')
+    io_group.add_argument('--workers', type=int, default=1, help='number of processes used to parse fasttext embeddings')
     io_group.add_argument('--save_path', default='./checkpoints/senti.bin', help='file to save W_src and W_trg')
 
     mapping_group = parser.add_argument_group()
@@ -430,10 +443,22 @@ if __name__ == '__main__':
 
     induction_group = parser.add_argument_group()
     induction_group.add_argument('-vc', '--vocab_cutoff', default=10000, type=int, help='restrict the vocabulary to k most frequent words')
+    induction_group.add_argument('--init_block_size', type=int, default=0, help='compute the unsupervised init dictionary out of core in blocks of this many rows (0 = in memory)')
+    induction_group.add_argument('--no_init_cache', action='store_true', help='recompute the unsupervised init dictionary instead of loading it from %s' % INIT_CACHE_DIR)
+    induction_group.add_argument('--init_unsupervised', choices=['exact', 'sketch'], default='exact', help='compare the full sorted similarity profiles (exact) or quantile sketches of them (sketch) for the init dictionary')
     induction_group.add_argument('--csls', type=int, default=10, help='number of csls neighbours')
     induction_group.add_argument('--dropout_init', type=float, default=0.1, help='initial keep prob of the dropout machanism')
     induction_group.add_argument('--dropout_step', type=float, default=0.1, help='increase keep_prob by a small step')
     induction_group.add_argument('--direction', choices=['forward', 'backward', 'union'], default='union', help='direction of dictionary induction')
+    induction_group.add_argument('--storage', choices=['float32', 'float16', 'int8'], default='float32', help='precision of the stored embeddings')
+    induction_group.add_argument('--ann_probes', type=int, default=0, help='search IVF indices scanning this many lists per query instead of brute force (0 = exact search)')
+    induction_group.add_argument('--num_threads', type=int, default=1, help='threads running the batches of dictionary induction concurrently')
+    induction_group.add_argument('--fused', action='store_true', help='compute the cutoff x cutoff similarity matrix once for union induction (needs --direction union)')
+    induction_group.add_argument('--knn_refresh', type=int, default=1, help='recompute the CSLS neighbourhoods every this many inductions, rescoring the cached neighbours in between')
+    induction_group.add_argument('--knn_drift', type=float, default=0.05, help='recompute the CSLS neighbourhoods when W moved by more than this relative distance')
+    induction_group.add_argument('--candidates', type=int, default=0, help='between refreshes (see --knn_refresh, which must be above 1), only rescore this many candidates per word kept from the last full induction')
+    induction_group.add_argument('--coarse_storage', choices=['float16'], default=None, help='find candidates with a float16 copy of the projected embeddings and rescore them in float32 (two-stage retrieval, requires --cuda)')
+    induction_group.add_argument('--coarse_candidates', type=int, default=10, help='candidates per word of the two-stage retrieval')
 
     lang_group = parser.add_mutually_exclusive_group()
     lang_group.add_argument('--en_es', action='store_true', help='train english-spanish embedding')
@@ -0,0 +1,184 @@
+"""
+approximate nearest neighbour search
+
+An inverted file (IVF) index clusters the rows of a matrix with k-means. A query
+only scores the rows of the nprobe lists whose centroids are nearest to it, so a
+search costs about nprobe / nlist of a brute-force one.
+"""
+import numpy as np
+from .cupy_utils import *
+from .math import *
+
+
+ANN_TRAIN_SIZE = 256  # k-means training rows per list
+ANN_ITER = 10
+ANN_REFINE_ITER = 2
+ANN_PROBES = 8
+ANN_BATCH_SIZE = 5000
+
+
+def assign(X, centroids):
+    """
+    Index of the nearest centroid (in euclidean distance) of each row of X.
+
+    X: ndarray of rank 2 (or any object supporting shape and row slicing)
+    centroids: ndarray of shape (nlist, vec_dim)
+
+    Returns: ndarray of shape (X.shape[0],)
+    """
+    xp = get_array_module(centroids)
+    ind, _ = top_k_dot(X, centroids, 1, bias=xp.sum(centroids**2, axis=1) / 2)
+    return ind[:, 0]
+
+
+def kmeans(X, centroids, niter):
+    """
+    Lloyd iterations starting from the given centroids. Centroids of empty clusters
+    are kept.
+
+    X: ndarray of shape (n, vec_dim)
+    centroids: ndarray of shape (nlist, vec_dim)
+    niter: int
+
+    Returns: ndarray of shape (nlist, vec_dim)
+    """
+    xp = get_array_module(X, centroids)
+    centroids = centroids.copy()
+    nlist = centroids.shape[0]
+    for _ in range(niter):
+        labels = assign(X, centroids)
+        order = xp.argsort(labels, kind='stable')
+        counts = xp.bincount(labels, minlength=nlist)
+        offsets = xp.concatenate((xp.zeros(1, dtype=xp.int64), xp.cumsum(counts)))
+        sums = segment_sum(X[order], offsets)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, xp.newaxis]
+    return centroids
+
+
+class IVFIndex(object):
+    """
+    Inverted file index for approximate maximum inner product search with the same
+    scores as top_k_dot. The index keeps a reference to the indexed matrix, so it must
+    be updated when the rows change (e.g. after a new projection).
+
+    Parameters
+    ----------
+    nlist: int, optional (default square root of the number of rows)
+        number of k-means lists
+    nprobe: int
+        number of lists scanned per query, the recall knob (nprobe >= nlist is exact)
+    niter: int
+        k-means iterations of fit
+    refine_iter: int
+        k-means iterations of update, starting from the current centroids
+    seed: int
+    """
+
+    def __init__(self, nlist=None, nprobe=ANN_PROBES, niter=ANN_ITER, refine_iter=ANN_REFINE_ITER, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.niter = niter
+        self.refine_iter = refine_iter
+        self.rng = np.random.RandomState(seed)
+        self.centroids = None
+        self.X = None
+
+    def _sample(self, X, nlist):
+        xp = get_array_module(X[:1])
+        size = min(X.shape[0], nlist * ANN_TRAIN_SIZE)
+        sample = self.rng.choice(X.shape[0], size, replace=False)
+        return xp.array(X[xp.asarray(np.sort(sample))], dtype=xp.float32)
+
+    def fit(self, X):
+        """
+        Cluster the rows of X from scratch and index them.
+
+        X: ndarray of rank 2 (or QuantizedArray)
+
+        Returns: self
+        """
+        nlist = self.nlist or max(int(np.sqrt(X.shape[0])), 1)
+        nlist = min(nlist, X.shape[0])
+        T = self._sample(X, nlist)
+        init = self.rng.choice(T.shape[0], nlist, replace=False)
+        self.centroids = kmeans(T, T[get_array_module(T).asarray(init)], self.niter)
+        return self._build(X)
+
+    def update(self, X):
+        """
+        Index X again after its rows changed, with a few k-means iterations starting
+        from the current centroids instead of clustering from scratch.
+
+        X: ndarray of rank 2 (or QuantizedArray)
+
+        Returns: self
+        """
+        if self.centroids is None or self.centroids.shape[0] > X.shape[0]:
+            return self.fit(X)
+        T = self._sample(X, self.centroids.shape[0])
+        self.centroids = kmeans(T, self.centroids, self.refine_iter)
+        return self._build(X)
+
+    def _build(self, X):
+        xp = get_array_module(self.centroids)
+        labels = assign(X, self.centroids)
+        self.X = X
+        self.order = xp.argsort(labels, kind='stable')
+        counts = xp.bincount(labels, minlength=self.centroids.shape[0])
+        self.offsets = asnumpy(xp.concatenate((xp.zeros(1, dtype=xp.int64), xp.cumsum(counts))))
+        return self
+
+    def search(self, Q, k, scale=None, bias=None, exclude=None, nprobe=None, batch_size=ANN_BATCH_SIZE):
+        """
+        Approximate top_k_dot(Q, X, k, scale, bias, exclude) over the indexed X.
+
+        Q: ndarray of shape (nq, vec_dim)
+        k: int
+        scale: ndarray of shape (X.shape[0],), optional
+        bias: ndarray of shape (X.shape[0],), optional
+        exclude: ndarray of shape (nq,), optional
+        nprobe: int, optional (default self.nprobe)
+        batch_size: int
+
+        Returns: (ndarray, ndarray)
+            indices and scores of shape (nq, k), best first. Queries with fewer than k
+            candidates are completed with index -1 and score -inf.
+        """
+        if self.X is None:
+            raise ValueError('Index is not built')
+        xp = get_array_module(Q)
+        nlist = self.centroids.shape[0]
+        nprobe = min(nprobe or self.nprobe, nlist)
+        csqr = xp.sum(self.centroids**2, axis=1) / 2
+        nq = Q.shape[0]
+        ind = xp.full((nq, k), -1, dtype=xp.int64)
+        val = xp.full((nq, k), -xp.inf, dtype=xp.float32)
+        for i in range(0, nq, batch_size):
+            i2 = min(nq, i + batch_size)
+            probes, _ = top_k_dot(Q[i:i2], self.centroids, nprobe, bias=csqr)
+
+            # (query, list) pairs grouped by list
+            lists = probes.ravel()
+            order = xp.argsort(lists, kind='stable')
+            queries = asnumpy(xp.repeat(xp.arange(i, i2), nprobe)[order])
+            bounds = np.searchsorted(asnumpy(lists[order]), np.arange(nlist + 1))
+            for l in range(nlist):
+                if bounds[l] == bounds[l + 1] or self.offsets[l] == self.offsets[l + 1]:
+                    continue
+                qs = xp.asarray(queries[bounds[l]:bounds[l + 1]])
+                rows = self.order[self.offsets[l]:self.offsets[l + 1]]
+                S = xp.dot(Q[qs], xp.asarray(self.X[rows], dtype=xp.float32).T)
+                if scale is not None:
+                    S *= scale[rows]
+                if bias is not None:
+                    S -= bias[rows]
+                if exclude is not None:
+                    S[exclude[qs][:, xp.newaxis] == rows] = -xp.inf
+                cand_ind = xp.concatenate((ind[qs], xp.broadcast_to(rows, S.shape)), axis=1)
+                cand_val = xp.concatenate((val[qs], S), axis=1)
+                part = xp.argpartition(cand_val, cand_val.shape[1] - k, axis=1)[:, cand_val.shape[1] - k:]
+                ind[qs] = xp.take_along_axis(cand_ind, part, axis=1)
+                val[qs] = xp.take_along_axis(cand_val, part, axis=1)
+        order = xp.argsort(-val, axis=1)
+        return xp.take_along_axis(ind, order, axis=1), xp.take_along_axis(val, order, axis=1)
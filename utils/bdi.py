@@ -3,9 +3,28 @@ bilingual dictionary induction helpers
 
 author: fyl
 """
+import os
+import hashlib
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from .cupy_utils import *
 from .math import *
+from .ann import IVFIndex
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+ANN_CANDIDATES = 10
+COARSE_CANDIDATES = 10
+KNN_DRIFT = 0.05
+GATHER_SIZE = 50000  # rows gathered at once when rescoring cached neighbours or candidates
+SKETCH_SIZE = 512
+INIT_CACHE_DIR = 'cache/init_dict'
 
 
 def get_projection_matrix(X_src, X_trg, orthogonal, direction='forward', out=None):
@@ -32,7 +51,25 @@ def get_projection_matrix(X_src, X_trg, orthogonal, direction='forward', out=Non
     return W
 
 
-def get_unsupervised_init_dict(src_emb, trg_emb, cutoff_size, csls, norm_actions, direction, threshold=-float('inf')):
+def half_dot(X, Y):
+    """
+    X @ Y.T for float16 matrices X and Y (the first stage of the two-stage retrieval
+    of BDI). Only cupy has a half precision GEMM; numpy would multiply float16
+    matrices without BLAS, far slower than float32, so it is refused.
+
+    X: ndarray of type float16
+    Y: ndarray of type float16
+
+    Returns: ndarray
+    """
+    xp = get_array_module(X, Y)
+    if xp is np:
+        raise ValueError('coarse_storage requires cupy arrays (numpy has no half precision GEMM)')
+    return xp.dot(X, Y.T)
+
+
+def get_unsupervised_init_dict(src_emb, trg_emb, cutoff_size, csls, norm_actions, direction, threshold=-float('inf'),
+                               block_size=0, method='exact', sketch_size=SKETCH_SIZE, cache_dir=INIT_CACHE_DIR):
     """
     Given source embedding and target embedding, return a initial bilingual
     dictionary base on similarity distribution.
@@ -44,11 +81,68 @@ def get_unsupervised_init_dict(src_emb, trg_emb, cutoff_size, csls, norm_actions
     norm_actions: list[str]
     direction: str
     threshold: float
+    block_size: int
+        if positive, the similarity profiles are written to temporary memmaps and the
+        similarity matrix is streamed in block_size x block_size tiles, so that memory
+        is O(block_size * sim_size) instead of several dense sim_size x sim_size matrices
+    method: str
+        'exact' compares the full sorted similarity profiles, 'sketch' compares
+        sketch_size quantiles of them (see similarity_sketch), so that the profiles
+        are matched with a sim_size x sketch_size x sim_size product instead of a
+        cubic one
+    sketch_size: int
+    cache_dir: str, optional (default INIT_CACHE_DIR)
+        the dictionary is cached in cache_dir, keyed by the fingerprints of the
+        embeddings used and the other arguments (except block_size, which only changes
+        the result by rounding), so that later runs with the same embeddings and
+        settings load it instead of recomputing it. None disables the cache
 
     Returns: ndarray of shape (dict_size, 2)
     """
     xp = get_array_module(src_emb, trg_emb)
     sim_size = min(src_emb.shape[0], trg_emb.shape[0], cutoff_size) if cutoff_size > 0 else min(src_emb.shape[0], trg_emb.shape[0])
+    if method not in ('exact', 'sketch'):
+        raise ValueError('Invalid init method: %s' % method)
+    if cache_dir is None:
+        return _unsupervised_init_dict(src_emb, trg_emb, sim_size, csls, norm_actions, direction, threshold,
+                                       block_size, method, sketch_size)
+
+    key = json.dumps([_fingerprint(src_emb[:sim_size]), _fingerprint(trg_emb[:sim_size]), sim_size, csls,
+                      list(norm_actions), direction, threshold, method, sketch_size if method == 'sketch' else None])
+    cache_file = os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+    if os.path.exists(cache_file):
+        return xp.asarray(np.load(cache_file))
+    init_dict = _unsupervised_init_dict(src_emb, trg_emb, sim_size, csls, norm_actions, direction, threshold,
+                                        block_size, method, sketch_size)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = '%s.%d.tmp.npy' % (cache_file[:-4], os.getpid())
+    np.save(tmp_file, asnumpy(init_dict))
+    os.replace(tmp_file, cache_file)
+    return init_dict
+
+
+def _fingerprint(X):
+    """
+    Returns: str
+        sha1 digest of the values of X, to key caches derived from an embedding matrix
+    """
+    return hashlib.sha1(memoryview(np.ascontiguousarray(asnumpy(X)))).hexdigest()
+
+
+def _unsupervised_init_dict(src_emb, trg_emb, sim_size, csls, norm_actions, direction, threshold,
+                            block_size, method, sketch_size):
+    """
+    get_unsupervised_init_dict without the cache.
+    """
+    xp = get_array_module(src_emb, trg_emb)
+    if method == 'sketch':
+        src_sim = normalize(similarity_sketch(src_emb[:sim_size], sketch_size, block_size), norm_actions)
+        trg_sim = normalize(similarity_sketch(trg_emb[:sim_size], sketch_size, block_size), norm_actions)
+        if block_size > 0:
+            return _match_profiles_tiled(src_sim, trg_sim, csls, direction, threshold, block_size)
+        return _match_profiles(src_sim, trg_sim, csls, direction, threshold)
+    if block_size > 0:
+        return _streaming_init_dict(src_emb, trg_emb, sim_size, csls, norm_actions, direction, threshold, block_size)
     u, s, vt = xp.linalg.svd(src_emb[:sim_size], full_matrices=False)
     src_sim = (u * s) @ u.T
     u, s, vt = xp.linalg.svd(trg_emb[:sim_size], full_matrices=False)
@@ -59,6 +153,18 @@ def get_unsupervised_init_dict(src_emb, trg_emb, cutoff_size, csls, norm_actions
     trg_sim.sort(axis=1)
     normalize(src_sim, norm_actions)
     normalize(trg_sim, norm_actions)
+    return _match_profiles(src_sim, trg_sim, csls, direction, threshold)
+
+
+def _match_profiles(src_sim, trg_sim, csls, direction, threshold):
+    """
+    Match the words of two languages by CSLS over the products of their similarity
+    profiles.
+
+    Returns: ndarray of shape (dict_size, 2)
+    """
+    xp = get_array_module(src_sim, trg_sim)
+    sim_size = src_sim.shape[0]
     sim = xp.dot(src_sim, trg_sim.T)
     del src_sim, trg_sim
     src_knn_sim = top_k_mean(sim, csls, inplace=False)
@@ -78,6 +184,166 @@ def get_unsupervised_init_dict(src_emb, trg_emb, cutoff_size, csls, norm_actions
     return init_dict
 
 
+def similarity_sketch(emb, sketch_size=SKETCH_SIZE, block_size=0):
+    """
+    Fixed-size summary of the sorted similarity profile of each word (a row of the
+    similarity matrix of get_unsupervised_init_dict): sketch_size evenly spaced
+    quantiles of it. The profiles are computed block_size rows at a time and only
+    partitioned at the quantiles, never fully sorted.
+
+    emb: ndarray of shape (n, vec_dim)
+    sketch_size: int
+    block_size: int (default all rows at once)
+
+    Returns: ndarray of shape (n, min(sketch_size, n))
+    """
+    xp = get_array_module(emb)
+    n = emb.shape[0]
+    block_size = block_size if block_size > 0 else n
+    u, s, vt = xp.linalg.svd(emb, full_matrices=False)
+    us = u * s
+    kth = np.linspace(0, n - 1, min(sketch_size, n)).round().astype(np.int64)
+    cols = xp.asarray(kth)
+    sketch = xp.empty((n, cols.shape[0]), dtype=emb.dtype)
+    for i in range(0, n, block_size):
+        j = min(n, i + block_size)
+        block = xp.partition(us[i:j] @ u.T, kth.tolist(), axis=1)
+        sketch[i:j] = block[:, cols]
+    return sketch
+
+
+def dict_precision(pred_dict, gold_dict):
+    """
+    Fraction of the predicted pairs whose source word is in the gold dictionary that
+    are gold pairs.
+
+    pred_dict: ndarray of shape (dict_size, 2)
+    gold_dict: ndarray of shape (gold_size, 2)
+
+    Returns: float
+    """
+    pred = {tuple(p) for p in asnumpy(pred_dict).tolist()}
+    gold = {tuple(p) for p in asnumpy(gold_dict).tolist()}
+    gold_src = {p[0] for p in gold}
+    covered = [p for p in pred if p[0] in gold_src]
+    return sum(p in gold for p in covered) / len(covered) if covered else 0.
+
+
+def _sorted_profiles(emb, sim_size, norm_actions, block_size, path):
+    """
+    Write the sorted and normalized rows of the similarity matrix of emb[:sim_size] to
+    a memmap at path, block_size rows at a time.
+
+    Returns: np.memmap of shape (sim_size, sim_size)
+    """
+    xp = get_array_module(emb)
+    u, s, vt = xp.linalg.svd(emb[:sim_size], full_matrices=False)
+    us = u * s
+    P = np.memmap(path, dtype=np.float32, mode='w+', shape=(sim_size, sim_size))
+    for i in range(0, sim_size, block_size):
+        j = min(sim_size, i + block_size)
+        block = us[i:j] @ u.T
+        block.sort(axis=1)
+        P[i:j] = asnumpy(block)
+    for action in norm_actions:
+        if action == 'unit':
+            for i in range(0, sim_size, block_size):
+                j = min(sim_size, i + block_size)
+                P[i:j] = asnumpy(length_normalize(xp.asarray(P[i:j]), inplace=True))
+        elif action == 'center':
+            total = np.zeros(sim_size, dtype=np.float64)
+            for i in range(0, sim_size, block_size):
+                total += P[i:min(sim_size, i + block_size)].sum(axis=0, dtype=np.float64)
+            mean = (total / sim_size).astype(np.float32)
+            for i in range(0, sim_size, block_size):
+                P[i:min(sim_size, i + block_size)] -= mean
+    return P
+
+
+def _merge_top_k(best, S, k, axis):
+    """
+    The k largest values of best and S concatenated along axis.
+    """
+    xp = get_array_module(S)
+    cand = xp.concatenate((best, S), axis=axis)
+    size = cand.shape[axis]
+    return xp.take(xp.partition(cand, size - k, axis=axis), xp.arange(size - k, size), axis=axis)
+
+
+def _streaming_init_dict(src_emb, trg_emb, sim_size, csls, norm_actions, direction, threshold, block_size):
+    """
+    get_unsupervised_init_dict with the similarity profiles on disk, matched by
+    _match_profiles_tiled.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        P_src = _sorted_profiles(src_emb, sim_size, norm_actions, block_size, os.path.join(tmp, 'src.dat'))
+        P_trg = _sorted_profiles(trg_emb, sim_size, norm_actions, block_size, os.path.join(tmp, 'trg.dat'))
+        init_dict = _match_profiles_tiled(P_src, P_trg, csls, direction, threshold, block_size)
+        del P_src, P_trg
+    return init_dict
+
+
+def _match_profiles_tiled(P_src, P_trg, csls, direction, threshold, block_size):
+    """
+    _match_profiles computing the similarity matrix tile by tile twice: once to
+    accumulate the row and column top-k (CSLS) averages, once to accumulate the row
+    and column maxima and argmaxes of the CSLS scores. The profiles may be memmaps.
+
+    Returns: ndarray of shape (dict_size, 2)
+    """
+    xp = get_array_module(P_src[:1])
+    n = P_src.shape[0]
+    k = min(csls, n)
+
+    def tiles():
+        for i in range(0, n, block_size):
+            i2 = min(n, i + block_size)
+            A = xp.asarray(P_src[i:i2])
+            for l in range(0, n, block_size):
+                l2 = min(n, l + block_size)
+                yield i, i2, l, l2, A.dot(xp.asarray(P_trg[l:l2]).T)
+
+    src_knn_sim = xp.zeros(n, dtype=xp.float32)
+    trg_knn_sim = xp.zeros(n, dtype=xp.float32)
+    if k > 0:
+        row_top = xp.full((n, k), -xp.inf, dtype=xp.float32)
+        col_top = xp.full((k, n), -xp.inf, dtype=xp.float32)
+        for i, i2, l, l2, S in tiles():
+            row_top[i:i2] = _merge_top_k(row_top[i:i2], S, k, axis=1)
+            col_top[:, l:l2] = _merge_top_k(col_top[:, l:l2], S, k, axis=0)
+        src_knn_sim = xp.sum(row_top, axis=1) / k
+        trg_knn_sim = xp.sum(col_top, axis=0) / k
+        del row_top, col_top
+
+    fwd_best = xp.full(n, -xp.inf, dtype=xp.float32)
+    bwd_best = xp.full(n, -xp.inf, dtype=xp.float32)
+    fwd_arg = xp.zeros(n, dtype=xp.int64)
+    bwd_arg = xp.zeros(n, dtype=xp.int64)
+    for i, i2, l, l2, S in tiles():
+        S -= src_knn_sim[i:i2, xp.newaxis] / 2 + trg_knn_sim[l:l2] / 2
+        rows = xp.arange(i2 - i)
+        arg = xp.argmax(S, axis=1)
+        better = S[rows, arg] > fwd_best[i:i2]
+        fwd_best[i:i2][better] = S[rows, arg][better]
+        fwd_arg[i:i2][better] = arg[better] + l
+        cols = xp.arange(l2 - l)
+        arg = xp.argmax(S, axis=0)
+        better = S[arg, cols] > bwd_best[l:l2]
+        bwd_best[l:l2][better] = S[arg, cols][better]
+        bwd_arg[l:l2][better] = arg[better] + i
+
+    fwd_valid = fwd_best > threshold
+    bwd_valid = bwd_best > threshold
+    if direction == 'forward':
+        init_dict = xp.stack([xp.arange(n), fwd_arg], axis=1)[fwd_valid]
+    elif direction == 'backward':
+        init_dict = xp.stack([bwd_arg, xp.arange(n)], axis=1)[bwd_valid]
+    elif direction == 'union':
+        init_dict = xp.stack([xp.concatenate((xp.arange(n)[fwd_valid], bwd_arg[bwd_valid])),
+                              xp.concatenate((fwd_arg[fwd_valid], xp.arange(n)[bwd_valid]))], axis=1)
+    return init_dict
+
+
 class VIArray(object):
 
     def __init__(self, X, vocab):
@@ -104,19 +370,85 @@ class BDI(object):
     trg_emb: np.ndarray of shape (trg_emb_size, vec_dim)
     batch_size: int
     scorer: str, (dot / cos / euclidean)
+    storage: str, (float32 / float16 / int8)
+        precision of the target embeddings and their projection. float16 and int8
+        rows are dequantized batch by batch in the similarity loops.
+    ann_probes: int
+        if positive, dictionary induction, CSLS neighbourhoods and validation search
+        IVF indices of the projected embeddings (see utils.ann) scanning ann_probes
+        lists per query, instead of brute force. Indices are updated lazily after
+        each projection. Cannot be combined with coarse_storage, knn_refresh > 1 or
+        candidates.
+    num_threads: int
+        number of threads running the batches of dictionary induction concurrently
+        (numpy only). Each thread works on its own rows of the similarity buffers, so
+        batches are batch_size / num_threads rows. If threadpoolctl is installed,
+        BLAS is limited to cpu_count / num_threads threads meanwhile.
+    fused: bool
+        with direction='union' and cutoff_type='both', compute the cutoff x cutoff
+        similarity matrix once and read both directions (CSLS neighbourhoods, maxima
+        and argmaxes) from it, instead of four batched products. The matrix replaces
+        bwd_sim, so this takes cutoff * (cutoff - batch_size) more floats. Cannot be
+        combined with ann_probes, coarse_storage, knn_refresh > 1 or candidates.
+    knn_refresh: int
+        recompute the CSLS neighbourhoods from scratch every knn_refresh calls of
+        get_bilingual_dict_with_cutoff. In between, the indices of the csls nearest
+        neighbours of each word are kept and only their similarities are recomputed
+        under the current projections. 1 recomputes on every call.
+    knn_drift: float
+        also recompute the neighbourhoods as soon as W_src or W_trg moved by more than
+        this relative (Frobenius) distance from the projections of the last refresh
+    candidates: int
+        if positive, each full pass (on the knn_refresh / knn_drift schedule) also keeps
+        the best candidates targets of each source word and vice versa, and the calls
+        in between only rescore these, costing cutoff * candidates instead of cutoff ** 2.
+        Requires knn_refresh > 1.
+    coarse_storage: str, optional (float16)
+        two-stage retrieval (cupy only, see half_dot): project keeps a float16 copy of
+        the projected embeddings (trg_coarse and src_coarse, shared with trg_proj_emb
+        when storage is float16), full passes score all pairs from it to find the
+        coarse_candidates best targets of each word (and its CSLS neighbourhood), and
+        only these are rescored in float32 to take the decisions. The dictionaries
+        match the exact path only with keep_prob=1: under dropout the choice is drawn
+        by _dropout_choice, which follows the distribution of dropout on the full row
+        except that dropped entries never beat negative scores.
+    coarse_candidates: int
     """
 
     def __init__(self, src_emb, trg_emb, batch_size=5000, cutoff_size=10000, cutoff_type='both',
                  direction=None, csls=10, batch_size_val=1000, scorer='dot',
-                 src_val_ind=None, trg_val_ind=None):
+                 src_val_ind=None, trg_val_ind=None, storage='float32', ann_probes=0, num_threads=1, fused=False,
+                 knn_refresh=1, knn_drift=KNN_DRIFT, candidates=0, coarse_storage=None,
+                 coarse_candidates=COARSE_CANDIDATES):
         if cutoff_type == 'oneway' and csls > 0:
             raise ValueEror("cutoff_type='both' and csls > 0 not supported")  # TODO
         if scorer not in ('dot', 'cos', 'euclidean'):
             raise ValueError('Invalid scorer: %s' % scorer)
+        if fused and (direction != 'union' or cutoff_type != 'both'):
+            raise ValueError("fused induction requires direction='union' and cutoff_type='both'")
+        if fused and (ann_probes > 0 or coarse_storage is not None or knn_refresh > 1 or candidates > 0):
+            raise ValueError('fused induction does not support ann_probes, coarse_storage, knn_refresh or candidates')
+        if candidates > 0 and knn_refresh <= 1:
+            raise ValueError('candidates > 0 requires knn_refresh > 1 (candidates are reused between refreshes)')
+        if ann_probes > 0 and (coarse_storage is not None or knn_refresh > 1 or candidates > 0):
+            raise ValueError('ann_probes does not support coarse_storage, knn_refresh or candidates')
+        if coarse_storage not in (None, 'float16'):
+            raise ValueError('Invalid storage type: %s' % coarse_storage)
+        if coarse_storage is not None:
+            xp = get_array_module(src_emb[:1], trg_emb[:1])
+            half_dot(xp.zeros((1, 1), dtype=xp.float16), xp.zeros((1, 1), dtype=xp.float16))
 
-        xp = get_array_module(src_emb, trg_emb, src_val_ind, trg_val_ind)
+        xp = get_array_module(src_emb[:1], trg_emb[:1], src_val_ind, trg_val_ind)
         self.xp = xp
-        self.trg_emb = xp.array(trg_emb, dtype=xp.float32)
+        self.storage = storage
+        if storage == 'float32':
+            self.trg_emb = xp.array(trg_emb, dtype=xp.float32)
+        else:
+            if not (isinstance(trg_emb, QuantizedArray) and trg_emb.storage == storage):
+                trg_emb = QuantizedArray(trg_emb, storage)
+            # the quantized rows may come from numpy (e.g. WordVecs.quantize)
+            self.trg_emb = QuantizedArray.from_quantized(
+                xp.asarray(trg_emb.Q), None if trg_emb.scale is None else xp.asarray(trg_emb.scale))
         self.batch_size = batch_size
         self.cutoff_size = cutoff_size
         self.cutoff_type = cutoff_type
@@ -124,6 +456,21 @@ class BDI(object):
         self.csls = csls
         self.batch_size_val = batch_size_val
         self.scorer = scorer
+        self.ann_probes = ann_probes
+        self.indices = {name: IVFIndex(nprobe=ann_probes) for name in ('src', 'trg', 'val')} if ann_probes > 0 else {}
+        self.stale = set(self.indices)
+        self.num_threads = num_threads if xp is np else 1
+        self.pool = ThreadPoolExecutor(self.num_threads) if self.num_threads > 1 else None
+        self.coarse_storage = coarse_storage
+        self.coarse_candidates = coarse_candidates
+        self.fused = fused
+        self.knn_refresh = knn_refresh
+        self.knn_drift = knn_drift
+        self.knn_age = 0
+        self.knn_W = None
+        self.fwd_knn_ind = self.bwd_knn_ind = None
+        self.candidates = candidates
+        self.fwd_cand = self.bwd_cand = None
 
         self.src_size = src_emb.shape[0]
         self.trg_size = trg_emb.shape[0]
@@ -140,7 +487,11 @@ class BDI(object):
 
         self.src_emb = VIArray(xp.array(src_emb[src_val_ind], dtype=xp.float32), xp.array(src_val_ind, dtype=xp.int32))
         self.src_proj_emb = VIArray(xp.array(src_emb[src_val_ind], dtype=xp.float32), xp.array(src_val_ind, dtype=xp.int32))
-        self.trg_proj_emb = self.trg_emb.copy()
+        if storage == 'float32':
+            self.trg_proj_emb = self.trg_emb.copy()
+        else:
+            self.trg_proj_emb = QuantizedArray.from_quantized(
+                self.trg_emb.Q.copy(), None if self.trg_emb.scale is None else self.trg_emb.scale.copy())
 
         if direction in ('forward', 'union') or csls > 0:
             self.fwd_src_size = cutoff_size
@@ -154,15 +505,28 @@ class BDI(object):
             self.bwd_src_size = cutoff_size if cutoff_type == 'both' else src_size
             self.bwd_ind = xp.arange(self.bwd_trg_size, dtype=xp.int32)
             self.bwd_src = xp.arange(self.bwd_trg_size, dtype=xp.int32)
-            self.bwd_sim = xp.empty((batch_size, self.bwd_src_size), dtype=xp.float32)
+            if self.fused:
+                self.bwd_sim = None
+                self.sim = xp.empty((cutoff_size, cutoff_size), dtype=xp.float32)
+            else:
+                self.bwd_sim = xp.empty((batch_size, self.bwd_src_size), dtype=xp.float32)
             self.best_bwd_sim = xp.empty(self.bwd_trg_size)
-        self.sim_val = xp.empty((batch_size_val, self.trg_size), dtype=xp.float32)
+        self.sim_val = xp.empty((batch_size_val, self.trg_size), dtype=xp.float32) if ann_probes == 0 else None
         self.dict_size = cutoff_size * 2 if direction == 'union' else cutoff_size
         self.dict = xp.empty((self.dict_size, 2), dtype=xp.int32)
 
         self.trg_sqr_norm = xp.ones(self.trg_size, dtype=xp.float32)
         self.src_sqr_norm = xp.ones(self.bwd_src_size, dtype=xp.float32)
 
+        if self.coarse_storage is not None:
+            # float16 copies of the projected embeddings read by the first stage of the
+            # two-stage retrieval, refreshed by project
+            if storage == 'float16':
+                self.trg_coarse = self.trg_proj_emb.Q
+            else:
+                self.trg_coarse = xp.empty((self.trg_size, trg_emb.shape[1]), dtype=xp.float16)
+            self.src_coarse = xp.empty((self.bwd_src_size, src_emb.shape[1]), dtype=xp.float16)
+
         self.src_avr_norm = xp.mean(l2norm(self.src_emb[:self.cutoff_size]))
         self.trg_avr_norm = xp.mean(l2norm(self.trg_emb[:self.cutoff_size]))
         self.src_factor = 1
@@ -184,6 +548,7 @@ class BDI(object):
         Returns: self
         """
         xp = self.xp
+        self.stale.update(('src',) if direction == 'forward' else ('trg', 'val'))
         if direction == 'forward':
             xp.dot(self.src_emb.X, W, out=self.src_proj_emb.X)
 
@@ -194,24 +559,45 @@ class BDI(object):
                 avr_norm = xp.mean(l2norm(self.src_proj_emb[:self.cutoff_size]))
                 self.src_factor = self.src_avr_norm / avr_norm
                 self.src_proj_emb.X *= self.src_factor
+            if self.coarse_storage is not None:
+                self.src_coarse[:] = self.src_proj_emb[:self.bwd_src_size]
         else:
             # proj_size = self.trg_size if full_trg else self.cutoff_size
             proj_ind = xp.arange(self.trg_size) if full_trg else self.trg_val_ind
-            if full_trg:
+            if full_trg and self.storage != 'float32':
+                for i in range(0, self.trg_size, QUANT_BATCH_SIZE):
+                    j = min(self.trg_size, i + QUANT_BATCH_SIZE)
+                    proj = xp.dot(self.trg_emb[i:j], W)
+                    if unit_norm:
+                        length_normalize(proj, inplace=True)
+                    self.trg_proj_emb[i:j] = proj
+            elif full_trg:
                 # matmul(self.trg_emb[proj_ind], W, out=self.trg_proj_emb[proj_ind])
                 xp.dot(self.trg_emb, W, out=self.trg_proj_emb)
             else:
                 self.trg_proj_emb[proj_ind] = xp.dot(self.trg_emb[proj_ind], W)
             self.W_trg = W.copy()
             if unit_norm:
-                if full_trg:
+                if full_trg and self.storage == 'float32':
                     length_normalize(self.trg_proj_emb, inplace=True)
-                else:
+                elif not full_trg:
                     self.trg_proj_emb[proj_ind] = length_normalize(self.trg_proj_emb[proj_ind], inplace=False)
             if scale:
                 avr_norm = xp.mean(l2norm(self.trg_proj_emb[:self.cutoff_size]))
                 self.trg_factor = self.trg_avr_norm / avr_norm
-                self.trg_proj_emb[proj_ind] *= self.trg_factor
+                if full_trg and self.storage != 'float32':
+                    for i in range(0, self.trg_size, QUANT_BATCH_SIZE):
+                        j = min(self.trg_size, i + QUANT_BATCH_SIZE)
+                        self.trg_proj_emb[i:j] *= self.trg_factor
+                else:
+                    self.trg_proj_emb[proj_ind] *= self.trg_factor
+            if self.coarse_storage is not None and self.storage != 'float16':
+                if full_trg:
+                    for i in range(0, self.trg_size, QUANT_BATCH_SIZE):
+                        j = min(self.trg_size, i + QUANT_BATCH_SIZE)
+                        self.trg_coarse[i:j] = self.trg_proj_emb[i:j]
+                else:
+                    self.trg_coarse[proj_ind] = self.trg_proj_emb[proj_ind]
         return self
 
     def get_bilingual_dict_with_cutoff(self, keep_prob=1.):
@@ -221,53 +607,338 @@ class BDI(object):
         Returns: ndarray of shape (dict_size, 2)
         """
         xp = self.xp
+        if self.ann_probes > 0:
+            return self._get_bilingual_dict_ann(keep_prob)
+        if self.fused:
+            return self._get_bilingual_dict_fused(keep_prob)
+        refresh = self._knn_refresh_due()
         if self.direction in ('forward', 'union'):
             if self.scorer in ('cos', 'euclidean'):
                 xp.sum(self.trg_proj_emb[:self.fwd_trg_size]**2, axis=1, out=self.trg_sqr_norm[:self.fwd_trg_size])
                 self.trg_sqr_norm[:self.fwd_trg_size][self.trg_sqr_norm[:self.fwd_trg_size] == 0] = 1
+            src = self.src_proj_emb[:self.fwd_src_size]
+            trg = self.trg_proj_emb[:self.fwd_trg_size]
 
-            if self.csls > 0:
-                for i in range(0, self.fwd_trg_size, self.batch_size):
-                    j = min(self.fwd_trg_size, i + self.batch_size)
-                    xp.dot(self.trg_proj_emb[i:j], self.src_proj_emb[:self.fwd_src_size].T, out=self.bwd_sim[:j - i])
-                    self.fwd_knn_sim[i:j] = top_k_mean(self.bwd_sim[:j - i], self.csls, inplace=True)
+            if self.csls > 0 and not refresh:
+                self._cached_knn_mean(trg, src, self.fwd_knn_ind, self.fwd_knn_sim)
+            elif self.csls > 0 and self.coarse_storage is not None:
+                self.fwd_knn_ind = self._knn_buffer(self.fwd_trg_size)
+                self._coarse_knn(self.trg_coarse, self.src_coarse, trg, src, self.fwd_knn_ind, self.fwd_knn_sim, self.bwd_sim)
+            elif self.csls > 0:
+                def fwd_knn(i, j, sim):
+                    xp.dot(trg[i:j], src[:self.fwd_src_size].T, out=sim)
+                    self.fwd_knn_sim[i:j] = self._knn_stats(sim, self.fwd_knn_ind, i, j)
+                self.fwd_knn_ind = self._knn_buffer(self.fwd_trg_size)
+                self._map_batches(self.fwd_trg_size, fwd_knn, self.bwd_sim)
 
-            for i in range(0, self.fwd_src_size, self.batch_size):
-                j = min(self.fwd_src_size, i + self.batch_size)
-                xp.dot(self.src_proj_emb[i:j], self.trg_proj_emb[:self.fwd_trg_size].T, out=self.fwd_sim[:j - i])
+            def fwd_dict(i, j, sim):
+                xp.dot(src[i:j], trg.T, out=sim)
 
-                self.fwd_sim[:j - i].max(axis=1, out=self.best_fwd_sim[i:j])
+                sim.max(axis=1, out=self.best_fwd_sim[i:j])
 
-                self.fwd_sim[:j - i] -= self.fwd_knn_sim / 2
+                sim -= self.fwd_knn_sim / 2
                 if self.scorer == 'cos':
-                    self.fwd_sim[:j - i] /= xp.sqrt(self.trg_sqr_norm[:self.fwd_trg_size])
+                    sim /= xp.sqrt(self.trg_sqr_norm[:self.fwd_trg_size])
                 elif self.scorer == 'euclidean':
-                    self.fwd_sim[:j - i] -= self.trg_sqr_norm[:self.fwd_trg_size]
-                dropout(self.fwd_sim[:j - i], keep_prob, inplace=True).argmax(axis=1, out=self.fwd_trg[i:j])
+                    sim -= self.trg_sqr_norm[:self.fwd_trg_size]
+                if self.fwd_cand is not None:
+                    self.fwd_cand[i:j] = self._top_columns(sim)
+                dropout(sim, keep_prob, inplace=True).argmax(axis=1, out=self.fwd_trg[i:j])
+
+            if self.candidates > 0 and not refresh:
+                self._rerank(src, trg, self.fwd_cand, self.fwd_knn_sim, self.trg_sqr_norm[:self.fwd_trg_size], 1,
+                             keep_prob, self.best_fwd_sim, self.fwd_trg)
+            elif self.coarse_storage is not None:
+                cand = self._coarse_dict(self.src_coarse, self.trg_coarse, src, trg, self.fwd_knn_sim,
+                                         self.trg_sqr_norm[:self.fwd_trg_size], 1, keep_prob, self.best_fwd_sim,
+                                         self.fwd_trg, self.fwd_sim)
+                self.fwd_cand = cand if self.candidates > 0 else None
+            else:
+                self.fwd_cand = self._candidate_buffer(self.fwd_src_size)
+                self._map_batches(self.fwd_src_size, fwd_dict, self.fwd_sim)
 
         if self.direction in ('backward', 'union'):
             if self.scorer in ('cos', 'euclidean'):
                 xp.sum(self.src_proj_emb[:self.bwd_src_size]**2, axis=1, out=self.src_sqr_norm[:self.bwd_src_size])
                 self.src_sqr_norm[:self.bwd_src_size][self.src_sqr_norm[:self.bwd_src_size] == 0] = 1
+            src = self.src_proj_emb[:self.bwd_src_size]
+            trg = self.trg_proj_emb[:self.bwd_trg_size]
 
-            if self.csls > 0:
-                for i in range(0, self.bwd_src_size, self.batch_size):
-                    j = min(self.bwd_src_size, i + self.batch_size)
-                    xp.dot(self.src_proj_emb[i:j], self.trg_proj_emb[:self.bwd_trg_size].T, out=self.fwd_sim[:j - i])
-                    self.bwd_knn_sim[i:j] = top_k_mean(self.fwd_sim[:j - i], self.csls, inplace=True)
+            if self.csls > 0 and not refresh:
+                self._cached_knn_mean(src, trg, self.bwd_knn_ind, self.bwd_knn_sim)
+            elif self.csls > 0 and self.coarse_storage is not None:
+                self.bwd_knn_ind = self._knn_buffer(self.bwd_src_size)
+                self._coarse_knn(self.src_coarse, self.trg_coarse, src, trg, self.bwd_knn_ind, self.bwd_knn_sim, self.fwd_sim)
+            elif self.csls > 0:
+                def bwd_knn(i, j, sim):
+                    xp.dot(src[i:j], trg.T, out=sim)
+                    self.bwd_knn_sim[i:j] = self._knn_stats(sim, self.bwd_knn_ind, i, j)
+                self.bwd_knn_ind = self._knn_buffer(self.bwd_src_size)
+                self._map_batches(self.bwd_src_size, bwd_knn, self.fwd_sim)
 
-            for i in range(0, self.bwd_trg_size, self.batch_size):
-                j = min(self.bwd_trg_size, i + self.batch_size)
-                xp.dot(self.trg_proj_emb[i:j], self.src_proj_emb[:self.bwd_src_size].T, out=self.bwd_sim[:j - i])
+            def bwd_dict(i, j, sim):
+                xp.dot(trg[i:j], src.T, out=sim)
 
-                self.bwd_sim[:j - i].max(axis=1, out=self.best_bwd_sim[i:j])
+                sim.max(axis=1, out=self.best_bwd_sim[i:j])
 
-                self.bwd_sim[:j - i] -= self.bwd_knn_sim / 2
+                sim -= self.bwd_knn_sim / 2
                 if self.scorer == 'cos':
-                    self.bwd_sim[:j - i] /= xp.sqrt(self.src_sqr_norm[:self.bwd_src_size])
+                    sim /= xp.sqrt(self.src_sqr_norm[:self.bwd_src_size])
                 elif self.scorer == 'euclidean':
-                    self.bwd_sim[:j - i] -= self.src_sqr_norm[:self.bwd_src_size] / 2
-                dropout(self.bwd_sim[:j - i], keep_prob, inplace=True).argmax(axis=1, out=self.bwd_src[i:j])
+                    sim -= self.src_sqr_norm[:self.bwd_src_size] / 2
+                if self.bwd_cand is not None:
+                    self.bwd_cand[i:j] = self._top_columns(sim)
+                dropout(sim, keep_prob, inplace=True).argmax(axis=1, out=self.bwd_src[i:j])
+
+            if self.candidates > 0 and not refresh:
+                self._rerank(trg, src, self.bwd_cand, self.bwd_knn_sim, self.src_sqr_norm[:self.bwd_src_size], 0.5,
+                             keep_prob, self.best_bwd_sim, self.bwd_src)
+            elif self.coarse_storage is not None:
+                cand = self._coarse_dict(self.trg_coarse, self.src_coarse, trg, src, self.bwd_knn_sim,
+                                         self.src_sqr_norm[:self.bwd_src_size], 0.5, keep_prob, self.best_bwd_sim,
+                                         self.bwd_src, self.bwd_sim)
+                self.bwd_cand = cand if self.candidates > 0 else None
+            else:
+                self.bwd_cand = self._candidate_buffer(self.bwd_trg_size)
+                self._map_batches(self.bwd_trg_size, bwd_dict, self.bwd_sim)
+        return self._collect_dict()
+
+    def _knn_refresh_due(self):
+        """
+        Whether the CSLS neighbourhoods must be recomputed from scratch in this call.
+        Updates the bookkeeping of the knn cache.
+        """
+        xp = self.xp
+        refresh = self.knn_refresh <= 1 or self.knn_W is None or self.knn_age + 1 >= self.knn_refresh
+        if not refresh:
+            drift = max(float(xp.linalg.norm(W - W0) / max(float(xp.linalg.norm(W0)), 1e-12))
+                        for W, W0 in zip((self.W_src, self.W_trg), self.knn_W))
+            refresh = drift > self.knn_drift
+        if refresh:
+            self.knn_age = 0
+            self.knn_W = (self.W_src.copy(), self.W_trg.copy())
+        else:
+            self.knn_age += 1
+        return refresh
+
+    def _knn_buffer(self, size):
+        if self.knn_refresh <= 1:
+            return None
+        return self.xp.empty((size, self.csls), dtype=self.xp.int64)
+
+    def _knn_stats(self, sim, knn_ind, i, j):
+        """
+        Average of the csls largest entries of each row of sim (destroyed), also
+        storing their columns in knn_ind[i:j] if the neighbourhoods are cached.
+        """
+        xp = self.xp
+        if knn_ind is None:
+            return top_k_mean(sim, self.csls, inplace=True)
+        k = min(self.csls, sim.shape[1])
+        part = xp.argpartition(sim, sim.shape[1] - k, axis=1)[:, sim.shape[1] - k:]
+        knn_ind[i:j] = part
+        return xp.take_along_axis(sim, part, axis=1).mean(axis=1)
+
+    def _cached_knn_mean(self, X, Y, knn_ind, out):
+        """
+        Average similarity of each row of X to its cached neighbours among the rows of Y.
+        This is a lower bound of the exact top-k average.
+        """
+        xp = self.xp
+        step = max(GATHER_SIZE // knn_ind.shape[1], 1)
+        for i in range(0, X.shape[0], step):
+            j = min(X.shape[0], i + step)
+            out[i:j] = xp.einsum('nd,nkd->n', X[i:j], Y[knn_ind[i:j]]) / knn_ind.shape[1]
+
+    def _candidate_buffer(self, size):
+        if self.candidates <= 0:
+            return None
+        return self.xp.empty((size, self.candidates), dtype=self.xp.int64)
+
+    def _top_columns(self, sim):
+        """
+        Columns of the self.candidates largest entries of each row of sim.
+        """
+        k = min(self.candidates, sim.shape[1])
+        return self.xp.argpartition(sim, sim.shape[1] - k, axis=1)[:, sim.shape[1] - k:]
+
+    def _rerank(self, X, Y, cand, knn_sim, sqr_norm, norm_weight, keep_prob, best_sim, out):
+        """
+        The similarity loop of get_bilingual_dict_with_cutoff restricted to the cached
+        candidates cand[i] (rows of Y) of each row i of X, with the choice under dropout
+        made by _dropout_choice. best_sim receives the best raw similarity among the
+        candidates.
+        """
+        xp = self.xp
+        step = max(GATHER_SIZE // cand.shape[1], 1)
+        for i in range(0, X.shape[0], step):
+            j = min(X.shape[0], i + step)
+            c = cand[i:j]
+            sim = xp.einsum('nd,nmd->nm', X[i:j], Y[c])
+            sim.max(axis=1, out=best_sim[i:j])
+            self._csls_scores(sim, knn_sim[c], sqr_norm[c], norm_weight)
+
+            def full_scores(rows):
+                return self._csls_scores(xp.dot(X[i + rows], Y.T), knn_sim, sqr_norm, norm_weight)
+            out[i:j] = self._dropout_choice(sim, c, keep_prob, full_scores)
+
+    def _coarse_scores(self, X, Y, out, scale=None, bias=None):
+        """
+        (X @ Y[:out.shape[1]].T) * scale - bias multiplied in half precision from
+        float16 rows (see half_dot).
+
+        Returns: out
+        """
+        out[:] = half_dot(X, Y[:out.shape[1]])
+        if scale is not None:
+            out *= scale
+        if bias is not None:
+            out -= bias
+        return out
+
+    def _coarse_candidates(self, X, Y, size, k, buf, scale=None, bias=None):
+        """
+        First stage of the two-stage retrieval: columns of the k largest entries of
+        each row of the coarse scores of X[:size] and Y[:buf.shape[1]], both float16
+        (see _coarse_scores).
+
+        Returns: ndarray of shape (size, k)
+        """
+        xp = self.xp
+        k = min(k, buf.shape[1])
+        cand = xp.empty((size, k), dtype=xp.int64)
+
+        def func(i, j, sim):
+            self._coarse_scores(X[i:j], Y, sim, scale, bias)
+            cand[i:j] = xp.argpartition(sim, sim.shape[1] - k, axis=1)[:, sim.shape[1] - k:]
+        self._map_batches(size, func, buf)
+        return cand
+
+    def _coarse_knn(self, Xq, Yq, X, Y, knn_ind, out, buf):
+        """
+        Two-stage CSLS neighbourhoods: csls + coarse_candidates neighbours of each row
+        of X among the rows of Y are found in half precision from Xq and Yq (their
+        float16 copies), rescored exactly and the csls best ones averaged into out
+        (their columns are stored in knn_ind if the neighbourhoods are cached).
+        """
+        xp = self.xp
+        cand = self._coarse_candidates(Xq, Yq, X.shape[0], self.csls + self.coarse_candidates, buf)
+        k = min(self.csls, cand.shape[1])
+        step = max(GATHER_SIZE // cand.shape[1], 1)
+        for i in range(0, X.shape[0], step):
+            j = min(X.shape[0], i + step)
+            c = cand[i:j]
+            sim = xp.einsum('nd,nmd->nm', X[i:j], Y[c])
+            part = xp.argpartition(sim, sim.shape[1] - k, axis=1)[:, sim.shape[1] - k:]
+            if knn_ind is not None:
+                knn_ind[i:j] = xp.take_along_axis(c, part, axis=1)
+            out[i:j] = xp.take_along_axis(sim, part, axis=1).mean(axis=1)
+
+    def _coarse_dict(self, Xq, Yq, X, Y, knn_sim, sqr_norm, norm_weight, keep_prob, best_sim, out, buf):
+        """
+        Two-stage version of the similarity loops of get_bilingual_dict_with_cutoff:
+        the best candidates of each row of X under the CSLS score are found in half
+        precision from Xq and Yq (the float16 copies of X and Y) and rescored exactly by
+        _rerank (rows losing all their candidates to dropout are rescored in full there).
+
+        Returns: ndarray of shape (X.shape[0], k), the candidates
+        """
+        xp = self.xp
+        scale = 1 / xp.sqrt(sqr_norm) if self.scorer == 'cos' else None
+        bias = knn_sim / 2 if scale is None else knn_sim / 2 * scale
+        if self.scorer == 'euclidean':
+            bias = bias + sqr_norm * norm_weight
+        cand = self._coarse_candidates(Xq, Yq, X.shape[0], max(self.coarse_candidates, self.candidates), buf,
+                                       scale, bias)
+        self._rerank(X, Y, cand, knn_sim, sqr_norm, norm_weight, keep_prob, best_sim, out)
+        return cand
+
+    def _get_bilingual_dict_fused(self, keep_prob):
+        """
+        Union induction from one similarity matrix sim[s, t] = src[s] . trg[t]. The
+        forward quantities are read from its rows and the backward ones from its
+        columns, with separate dropout masks for the two directions.
+        """
+        xp = self.xp
+        n = self.cutoff_size
+        src = self.src_proj_emb[:n]
+        trg = self.trg_proj_emb[:n]
+        sim = self.sim
+        if self.scorer in ('cos', 'euclidean'):
+            xp.sum(trg**2, axis=1, out=self.trg_sqr_norm[:n])
+            self.trg_sqr_norm[:n][self.trg_sqr_norm[:n] == 0] = 1
+            xp.sum(src**2, axis=1, out=self.src_sqr_norm[:n])
+            self.src_sqr_norm[:n][self.src_sqr_norm[:n] == 0] = 1
+
+        def product(i, j, _):
+            xp.dot(src[i:j], trg.T, out=sim[i:j])
+            sim[i:j].max(axis=1, out=self.best_fwd_sim[i:j])
+            if self.csls > 0:
+                self.bwd_knn_sim[i:j] = top_k_mean(sim[i:j], self.csls)
+        self._map_batches(n, product, self.fwd_sim)
+        sim.max(axis=0, out=self.best_bwd_sim)
+        if self.csls > 0:
+            def column_knn(i, j, _):
+                self.fwd_knn_sim[i:j] = top_k_mean(sim[:, i:j].T, self.csls)
+            self._map_batches(n, column_knn, self.fwd_sim)
+
+        # best source of each target within each batch of source rows, merged below
+        bwd_best = {}
+
+        def induce(i, j, scratch):
+            xp.subtract(sim[i:j], self.fwd_knn_sim / 2, out=scratch)
+            if self.scorer == 'cos':
+                scratch /= xp.sqrt(self.trg_sqr_norm[:n])
+            elif self.scorer == 'euclidean':
+                scratch -= self.trg_sqr_norm[:n]
+            dropout(scratch, keep_prob, inplace=True).argmax(axis=1, out=self.fwd_trg[i:j])
+
+            xp.subtract(sim[i:j], self.bwd_knn_sim[i:j, xp.newaxis] / 2, out=scratch)
+            if self.scorer == 'cos':
+                scratch /= xp.sqrt(self.src_sqr_norm[i:j, xp.newaxis])
+            elif self.scorer == 'euclidean':
+                scratch -= self.src_sqr_norm[i:j, xp.newaxis] / 2
+            dropout(scratch, keep_prob, inplace=True)
+            rows = scratch.argmax(axis=0)
+            bwd_best[i] = (rows + i, scratch[rows, xp.arange(n)])
+        self._map_batches(n, induce, self.fwd_sim)
+
+        best = xp.full(n, -xp.inf, dtype=xp.float32)
+        for i in sorted(bwd_best):
+            rows, val = bwd_best[i]
+            better = val > best
+            self.bwd_src[better] = rows[better]
+            best[better] = val[better]
+        return self._collect_dict()
+
+    def _map_batches(self, size, func, buf):
+        """
+        Call func(i, j, buf[:j - i]) for consecutive batches [i, j) of range(size). With
+        several threads, thread t takes every num_threads-th batch and the rows
+        t * step:(t + 1) * step of buf as scratch space.
+        """
+        if self.pool is None:
+            for i in range(0, size, self.batch_size):
+                j = min(size, i + self.batch_size)
+                func(i, j, buf[:j - i])
+            return
+
+        step = max(self.batch_size // self.num_threads, 1)
+
+        def worker(t):
+            scratch = buf[t * step:(t + 1) * step]
+            for i in range(t * step, size, step * self.num_threads):
+                j = min(size, i + step)
+                func(i, j, scratch[:j - i])
+
+        if threadpool_limits is not None:
+            with threadpool_limits(max(1, (os.cpu_count() or 1) // self.num_threads), user_api='blas'):
+                list(self.pool.map(worker, range(self.num_threads)))
+        else:
+            list(self.pool.map(worker, range(self.num_threads)))
+
+    def _collect_dict(self):
+        xp = self.xp
         if self.direction == 'forward':
             xp.stack([self.fwd_ind, self.fwd_trg], axis=1, out=self.dict)
             self.objective = self.best_fwd_sim.mean()
@@ -280,6 +951,125 @@ class BDI(object):
             self.objective = (self.best_fwd_sim.mean() + self.best_bwd_sim.mean()) / 2
         return self.dict.copy()
 
+    def _index(self, name):
+        """
+        The IVF index of src_proj_emb[:bwd_src_size] ('src'), trg_proj_emb[:fwd_trg_size]
+        ('trg') or the whole trg_proj_emb ('val'), updated if a projection changed it.
+        """
+        index = self.indices[name]
+        if name in self.stale:
+            if name == 'src':
+                index.update(self.src_proj_emb[:self.bwd_src_size])
+            elif name == 'trg':
+                index.update(self.trg_proj_emb[:self.fwd_trg_size])
+            else:
+                index.update(self.trg_proj_emb)
+            self.stale.discard(name)
+        return index
+
+    def _knn_mean(self, index, X):
+        """
+        Average similarity of the rows of X to their csls nearest neighbours in index.
+        """
+        xp = self.xp
+        ind, val = index.search(X, self.csls)
+        found = ind >= 0
+        return xp.where(found, val, 0).sum(axis=1) / xp.maximum(found.sum(axis=1), 1)
+
+    def _ann_retrieve(self, index, X, knn_sim, sqr_norm, norm_weight, keep_prob, best_sim, out):
+        """
+        Approximate version of the similarity loops of get_bilingual_dict_with_cutoff.
+        The ANN_CANDIDATES best targets of each row of X under the CSLS score are
+        retrieved and the choice under dropout is made by _dropout_choice. best_sim
+        receives the best raw similarity among the candidates.
+        """
+        xp = self.xp
+        scale = 1 / xp.sqrt(sqr_norm) if self.scorer == 'cos' else xp.ones_like(sqr_norm)
+        bias = knn_sim / 2 * scale
+        if self.scorer == 'euclidean':
+            bias = bias + sqr_norm * norm_weight
+        ind, val = index.search(X, ANN_CANDIDATES, scale=scale, bias=bias)
+        found = ind >= 0
+        raw = (val + bias[ind]) / scale[ind]
+        best_sim[:] = xp.where(found, raw, -xp.inf).max(axis=1)
+
+        def full_scores(rows):
+            return self._csls_scores(xp.dot(X[rows], index.X.T), knn_sim, sqr_norm, norm_weight)
+        out[:] = self._dropout_choice(val, ind, keep_prob, full_scores)
+
+    def _csls_scores(self, sim, knn_sim, sqr_norm, norm_weight):
+        """
+        Turn raw similarities into the scores of the similarity loops of
+        get_bilingual_dict_with_cutoff, in place. knn_sim and sqr_norm are those of the
+        columns of sim.
+        """
+        xp = self.xp
+        sim -= knn_sim / 2
+        if self.scorer == 'cos':
+            sim /= xp.sqrt(sqr_norm)
+        elif self.scorer == 'euclidean':
+            sim -= sqr_norm * norm_weight
+        return sim
+
+    def _dropout_choice(self, score, cand, keep_prob, full_scores):
+        """
+        Best column of each row under dropout on the full row, when only the scores of
+        its best candidates are known. Each candidate survives with probability
+        keep_prob and the best survivor is chosen. Rows that lose all their candidates
+        are rescored in full (full_scores(rows) returns their score rows) and take the
+        best surviving column outside of the candidates, so that the choice follows
+        the best of a random keep_prob fraction of the row, as in the exact loops
+        (except that there dropped entries become zeros, which beat negative scores).
+
+        score: ndarray of shape (n, k)
+            scores of the candidates, best first, -inf for missing ones
+        cand: ndarray of shape (n, k)
+            columns of the candidates, negative for missing ones
+        keep_prob: float
+        full_scores: callable
+
+        Returns: ndarray of shape (n,)
+        """
+        xp = self.xp
+        rows = xp.arange(score.shape[0])
+        if keep_prob >= 1.:
+            return cand[rows, score.argmax(axis=1)]
+        score = xp.where(dropout(xp.ones_like(score), keep_prob) > 0, score, -xp.inf)
+        choice = cand[rows, score.argmax(axis=1)]
+        lost = xp.nonzero(xp.all(score == -xp.inf, axis=1))[0]
+        for i in range(0, lost.shape[0], self.batch_size):
+            r = lost[i:i + self.batch_size]
+            full = full_scores(r)
+            c = cand[r]
+            hit = xp.nonzero(c >= 0)
+            full[hit[0], c[hit]] = -xp.inf
+            full = xp.where(dropout(xp.ones_like(full), keep_prob) > 0, full, -xp.inf)
+            choice[r] = full.argmax(axis=1)
+        return choice
+
+    def _get_bilingual_dict_ann(self, keep_prob):
+        xp = self.xp
+        if self.direction in ('forward', 'union'):
+            trg = self.trg_proj_emb[:self.fwd_trg_size]
+            src = self.src_proj_emb[:self.fwd_src_size]
+            xp.sum(trg**2, axis=1, out=self.trg_sqr_norm[:self.fwd_trg_size])
+            self.trg_sqr_norm[:self.fwd_trg_size][self.trg_sqr_norm[:self.fwd_trg_size] == 0] = 1
+            if self.csls > 0:
+                self.fwd_knn_sim[:] = self._knn_mean(self._index('src'), trg)
+            self._ann_retrieve(self._index('trg'), src, self.fwd_knn_sim, self.trg_sqr_norm[:self.fwd_trg_size],
+                               1, keep_prob, self.best_fwd_sim, self.fwd_trg)
+
+        if self.direction in ('backward', 'union'):
+            src = self.src_proj_emb[:self.bwd_src_size]
+            trg = self.trg_proj_emb[:self.bwd_trg_size]
+            xp.sum(src**2, axis=1, out=self.src_sqr_norm[:self.bwd_src_size])
+            self.src_sqr_norm[:self.bwd_src_size][self.src_sqr_norm[:self.bwd_src_size] == 0] = 1
+            if self.csls > 0:
+                self.bwd_knn_sim[:] = self._knn_mean(self._index('trg'), src)
+            self._ann_retrieve(self._index('src'), trg, self.bwd_knn_sim, self.src_sqr_norm[:self.bwd_src_size],
+                               0.5, keep_prob, self.best_bwd_sim, self.bwd_src)
+        return self._collect_dict()
+
     def get_target_indices(self, src_ind):
         """
         src_ind: np.ndarray of shape (dict_size,)
@@ -291,11 +1081,40 @@ class BDI(object):
         trg_ind = xp.empty(size, dtype=xp.int32)
         xsrc = self.src_proj_emb[src_ind]
         if self.scorer in ('cos', 'euclidean'):
-            xp.sum(self.trg_proj_emb**2, axis=1, out=self.trg_sqr_norm)
+            if self.storage == 'float32':
+                xp.sum(self.trg_proj_emb**2, axis=1, out=self.trg_sqr_norm)
+            else:
+                self.trg_sqr_norm[:] = self.trg_proj_emb.sqr_norm()
             self.trg_sqr_norm[self.trg_sqr_norm == 0] = 1
+        if self.ann_probes > 0:
+            scale = 1 / self.trg_sqr_norm if self.scorer == 'cos' else None
+            bias = self.trg_sqr_norm / 2 if self.scorer == 'euclidean' else None
+            ind, _ = self._index('val').search(xsrc, 1, scale=scale, bias=bias)
+            trg_ind[:] = ind[:, 0]
+            return trg_ind
+        if self.coarse_storage is not None:
+            k = min(self.coarse_candidates, self.trg_size)
+            for i in range(0, size, self.batch_size_val):
+                j = min(i + self.batch_size_val, size)
+                sim = self._coarse_scores(xsrc[i:j].astype(xp.float16), self.trg_coarse, self.sim_val[:j - i])
+                if self.scorer == 'cos':
+                    sim /= self.trg_sqr_norm
+                elif self.scorer == 'euclidean':
+                    sim -= self.trg_sqr_norm / 2
+                cand = xp.argpartition(sim, sim.shape[1] - k, axis=1)[:, sim.shape[1] - k:]
+                sim = xp.einsum('nd,nkd->nk', xsrc[i:j], self.trg_proj_emb[cand])
+                if self.scorer == 'cos':
+                    sim /= self.trg_sqr_norm[cand]
+                elif self.scorer == 'euclidean':
+                    sim -= self.trg_sqr_norm[cand] / 2
+                trg_ind[i:j] = cand[xp.arange(j - i), sim.argmax(axis=1)]
+            return trg_ind
         for i in range(0, size, self.batch_size_val):
             j = min(i + self.batch_size_val, size)
-            xp.dot(xsrc[i:j], self.trg_proj_emb.T, out=self.sim_val[: j - i])
+            if self.storage == 'float32':
+                xp.dot(xsrc[i:j], self.trg_proj_emb.T, out=self.sim_val[: j - i])
+            else:
+                self.trg_proj_emb.tdot(xsrc[i:j], out=self.sim_val[: j - i])
             if self.scorer == 'cos':
                 self.sim_val[: j - i] /= self.trg_sqr_norm
             elif self.scorer == 'euclidean':
@@ -5,13 +5,110 @@ author: fyl
 """
 
 import numpy as np
-from scipy.spatial.distance import cosine
 import csv
 import collections
+import glob
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import pickle
+import re
 import sys
 import os
+from multiprocessing.shared_memory import SharedMemory
 from .cupy_utils import *
 from .math import *
+from .vocab import Vocabulary
+from .shm import share_arrays, attach_arrays
+
+
+MMAP_HEADER_EXT = '.hdr'
+MMAP_MATRIX_EXT = '.mat'
+CHUNKS_PER_WORKER = 4
+READ_BUFFER_SIZE = 1 << 26
+RESERVED_ROWS = 16
+GROWTH_FACTOR = 1.5
+INDEX_CACHE_DIR = 'cache/index'
+
+
+def _iter_fasttext_chunk(file, start, end, encoding):
+    """
+    Yield the decoded lines of the byte range [start, end) of a fasttext file, reading
+    one line at a time. Both ends must lie on line boundaries.
+    """
+    with open(file, 'rb') as fin:
+        fin.seek(start)
+        while start < end:
+            line = fin.readline()
+            if not line:
+                break
+            start += len(line)
+            yield line.decode(encoding)
+
+
+def _count_fasttext_chunk(task):
+    """
+    Count the lines in a byte range that will be stored in the matrix.
+    """
+    file, start, end, encoding, vocab = task
+    if vocab is None:
+        count, last = 0, b'\n'
+        with open(file, 'rb') as fin:
+            fin.seek(start)
+            while start < end:
+                block = fin.read(min(READ_BUFFER_SIZE, end - start))
+                if not block:
+                    break
+                start += len(block)
+                count += block.count(b'\n')
+                last = block[-1:]
+        return count + (last != b'\n')
+    return sum(1 for line in _iter_fasttext_chunk(file, start, end, encoding)
+               if line.split(' ', 1)[0] in vocab)
+
+
+def _parse_fasttext_chunk(task):
+    """
+    Parse a byte range into the rows [row, row + nlines) of the shared matrix.
+
+    Returns: list[str]
+        words of the parsed rows in file order
+    """
+    file, start, end, encoding, vocab, shm_name, shape, row = task
+    shm = SharedMemory(name=shm_name)
+    try:
+        emb_matrix = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        words = []
+        for line in _iter_fasttext_chunk(file, start, end, encoding):
+            word, vec = line.split(' ', 1)
+            if vocab is not None and word not in vocab:
+                continue
+            emb_matrix[row] = np.fromstring(vec, sep=' ', dtype=np.float32)
+            words.append(word)
+            row += 1
+        del emb_matrix
+    finally:
+        shm.close()
+    return words
+
+
+def _scan_fasttext_words(fin, words, encoding):
+    """
+    Yield (word, vector string) for the remaining lines of a fasttext file whose first
+    token is in words. Only the token before the first space of each line is compared;
+    other lines are neither decoded nor parsed. Stops as soon as all of words have been
+    found.
+    """
+    words = {w.encode(encoding) for w in words}
+    for line in fin:
+        if not words:
+            return
+        word = line[:line.find(b' ')]
+        if word in words:
+            words.discard(word)
+            yield word.decode(encoding), line[len(word) + 1:].decode(encoding)
 
 
 class WordVecs(object):
@@ -29,24 +126,108 @@ class WordVecs(object):
     normalize: bool
         mean center the word vectors and normalize to unit length
     emb_format: str
+        'word2vec_bin', 'fasttext_text' or 'mmap' (the store written by WordVecs.save,
+        in which case file is the path prefix of the store)
+    workers: int, optional (default 1)
+        number of processes used to parse fasttext files (ignored if max_vocab is given)
+    max_vocab: int, optional (default None)
+        if specified, only the first max_vocab words of the file are loaded, plus the
+        words in keep. Past the first max_vocab words only the words themselves are
+        scanned, until all of keep has been found.
+    keep: list[str] / set[str], optional (default None)
+        words to load in addition to the first max_vocab words
     """
 
-    def __init__(self, file, vocab=None, encoding='utf-8', normalize=False, emb_format='word2vec_bin'):
+    def __init__(self, file, vocab=None, encoding='utf-8', normalize=False, emb_format='word2vec_bin', workers=1,
+                 max_vocab=None, keep=None):
         self.vocab = set(vocab) if vocab else None
         self.encoding = encoding
         self.emb_format = emb_format
         if emb_format == 'word2vec_bin':
-            self.vocab_size, self.vec_dim, self._matrix, self._w2idx, self._idx2w = self._read_word2vec_vecs(
-                file)
+            self.vocab_size, self.vec_dim, self._matrix, words = self._read_word2vec_vecs(
+                file, max_vocab=max_vocab, keep=keep)
+        elif emb_format == 'fasttext_text' and workers > 1 and max_vocab is None:
+            self.vocab_size, self.vec_dim, self._matrix, words = self._read_fasttext_vecs_parallel(
+                file, encoding=encoding, vocab=vocab, workers=workers)
         elif emb_format == 'fasttext_text':
-            self.vocab_size, self.vec_dim, self._matrix, self._w2idx, self._idx2w = self._read_fasttext_vecs(
-                file, encoding=encoding, vocab=vocab)
+            self.vocab_size, self.vec_dim, self._matrix, words = self._read_fasttext_vecs(
+                file, encoding=encoding, vocab=vocab, max_vocab=max_vocab, keep=keep)
+        elif emb_format == 'mmap':
+            self.vocab_size, self.vec_dim, self._matrix, words = self._read_mmap_vecs(
+                file, vocab=vocab, max_vocab=max_vocab, keep=keep)
         else:
             raise ValueError('Invalid embedding format: {0}'.format(emb_format))
-        self.vocab = set(self._w2idx.keys())
+        self._vocab = words if isinstance(words, Vocabulary) else Vocabulary(words, encoding=encoding)
+        self._size = len(self._vocab)
+        self.vocab = self._vocab
+        self._sim_cache = {}
         if normalize:
             self.mean_center().normalize()
 
+    def __setstate__(self, state):
+        if '_size' not in state:
+            # objects pickled before the matrix kept spare capacity
+            state['_size'] = len(state['_w2idx'])
+        if '_vocab' not in state:
+            # objects pickled with a dict vocabulary
+            state['_vocab'] = Vocabulary(list(state.pop('_idx2w')[:state['_size']]),
+                                         encoding=state.get('encoding', 'utf-8'))
+            del state['_w2idx']
+            state['vocab'] = state['_vocab']
+        state.setdefault('_sim_cache', {})
+        self.__dict__.update(state)
+
+    def share(self, name):
+        """
+        Copy the embedding matrix and the vocabulary to shared memory blocks (see
+        utils.shm), so that other processes open them with WordVecs.attach(name)
+        without copying. The blocks are freed by utils.shm.release(name) or when this
+        process exits. This object keeps its own arrays; call WordVecs.attach(name)
+        here as well to keep a single copy.
+
+        name: str
+
+        Returns: self
+        """
+        arrays = {'vocab_' + key: X for key, X in self._vocab.to_arrays().items()}
+        if isinstance(self._matrix, QuantizedArray):
+            storage = self._matrix.storage
+            arrays['Q'] = self._matrix.Q[:self._size]
+            if self._matrix.scale is not None:
+                arrays['scale'] = self._matrix.scale[:self._size]
+        else:
+            storage = 'float32'
+            arrays['matrix'] = self.embedding
+        meta = {'vocab_size': self.vocab_size, 'vec_dim': self.vec_dim, 'encoding': self.encoding,
+                'emb_format': self.emb_format, 'storage': storage}
+        share_arrays(name, arrays, meta)
+        return self
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Open the embeddings shared by WordVecs.share(name), possibly in another process,
+        without copying them. The matrix is read-only; adding words copies it.
+
+        name: str
+
+        Returns: WordVecs
+        """
+        arrays, meta = attach_arrays(name)
+        self = cls.__new__(cls)
+        self.vocab_size, self.vec_dim = meta['vocab_size'], meta['vec_dim']
+        self.encoding, self.emb_format = meta['encoding'], meta['emb_format']
+        if meta['storage'] == 'float32':
+            self._matrix = arrays['matrix']
+        else:
+            self._matrix = QuantizedArray.from_quantized(arrays['Q'], arrays.get('scale'))
+        vocab_arrays = {key[len('vocab_'):]: X for key, X in arrays.items() if key.startswith('vocab_')}
+        self._vocab = Vocabulary.from_arrays(encoding=self.encoding, **vocab_arrays)
+        self._size = len(self._vocab)
+        self.vocab = self._vocab
+        self._sim_cache = {}
+        return self
+
     def __getitem__(self, word):
         """
         Returns the vector representation of a word.
@@ -55,82 +236,228 @@ class WordVecs(object):
 
         Returns: np.array
         """
-        try:
-            return self._matrix[self._w2idx[word]]
-        except KeyError:
-            raise KeyError('Word not in vocabulary')
+        return self._matrix[self._vocab.index(word)]
 
-    def _read_word2vec_vecs(self, file):
+    def _read_word2vec_vecs(self, file, max_vocab=None, keep=None):
         """
-        Load word embeddings from the binary embedding file.
+        Load word embeddings from the binary embedding file. The file is read in large
+        buffers; words are located by scanning for the separating space and the vectors
+        are copied into the matrix with np.frombuffer.
 
         file: str
+        max_vocab: int
+        keep: list[str] / set[str]
         """
         with open(file, 'rb') as fin:
             header = fin.readline()
 
             vocab_size, vec_dim = map(int, header.split())
             bytes_each_word = np.dtype('float32').itemsize * vec_dim
+            nwords = vocab_size
 
             if self.vocab:
                 vocab_size = len(self.vocab)
+                vocab = {w.encode(self.encoding) for w in self.vocab}
+            else:
+                vocab = None
+            if max_vocab is not None:
+                keep = {w.encode(self.encoding) for w in keep} if keep else set()
+                if vocab is not None:
+                    keep &= vocab
+                vocab_size = min(vocab_size, max_vocab + len(keep))
+
+            emb_matrix = np.zeros((vocab_size + RESERVED_ROWS, vec_dim), dtype='float32')
+            idx2w = []
 
-            emb_matrix = np.zeros((vocab_size, vec_dim), dtype='float32')
-            w2idx = {}
-
-            for _ in range(vocab_size):
-                word = b''
-                while True:
-                    ch = fin.read(1)
-                    if ch == b' ':
+            buf, pos = b'', 0
+            for i in range(nwords):
+                sp = buf.find(b' ', pos)
+                while sp < 0 or sp + 1 + bytes_each_word > len(buf):
+                    chunk = fin.read(READ_BUFFER_SIZE)
+                    if not chunk:
                         break
-                    if ch != b'\n':
-                        word += ch
-                word = word.decode(self.encoding)
+                    buf, pos = buf[pos:] + chunk, 0
+                    sp = buf.find(b' ')
+                if sp < 0 or sp + 1 + bytes_each_word > len(buf):
+                    break
+                word = buf[pos:sp].replace(b'\n', b'')
+                pos = sp + 1 + bytes_each_word
 
-                vec = np.fromstring(fin.read(bytes_each_word), dtype='float32')
-
-                if self.vocab and word not in self.vocab:
+                if vocab is not None and word not in vocab:
                     continue
-                else:
-                    w2idx[word] = len(w2idx)
-                    emb_matrix[w2idx[word]] = vec
+                if max_vocab is not None:
+                    if i >= max_vocab and not keep:
+                        break
+                    if i >= max_vocab and word not in keep:
+                        continue
+                    keep.discard(word)
+                emb_matrix[len(idx2w)] = np.frombuffer(buf, dtype='float32', count=vec_dim, offset=sp + 1)
+                idx2w.append(word.decode(self.encoding))
 
-        idx2w = [None] * len(w2idx)
-        for w, i in w2idx.items():
-            idx2w[i] = w
-        idx2w = np.array(idx2w)
-        return vocab_size, vec_dim, emb_matrix, w2idx, idx2w
+        if max_vocab is not None:
+            vocab_size = len(idx2w)
+        return vocab_size, vec_dim, emb_matrix, idx2w
 
-    def _read_fasttext_vecs(self, file, encoding, vocab=None):
+    def _read_fasttext_vecs(self, file, encoding, vocab=None, max_vocab=None, keep=None):
         """
-        Load word embeddings from the binary embedding file.
+        Load word embeddings from the text embedding file. With max_vocab, only the
+        first max_vocab lines are parsed; the rest of the file is searched for the
+        words of keep by their first token (see _scan_fasttext_words).
 
         file: str
+        max_vocab: int
+        keep: list[str] / set[str]
         """
-        with open(file, 'r', encoding=encoding) as fin:
+        with open(file, 'rb') as fin:
             vocab_size, vec_dim = map(int, fin.readline().split())
 
             if vocab is not None:
                 vocab_size = len(self.vocab)
+            if max_vocab is not None:
+                keep = set(keep) if keep else set()
+                if vocab is not None:
+                    keep &= self.vocab
+                vocab_size = min(vocab_size, max_vocab + len(keep))
 
-            emb_matrix = np.zeros((vocab_size, vec_dim), dtype=np.float32)
+            emb_matrix = np.zeros((vocab_size + RESERVED_ROWS, vec_dim), dtype=np.float32)
             idx2w = []
-            w2idx = {}
 
-            for line in fin:
-                word, vec = line.split(' ', 1)
-                vec = np.fromstring(vec, sep=' ', dtype=np.float32)
+            lines = fin if max_vocab is None else itertools.islice(fin, max_vocab)
+            for line in lines:
+                word, vec = line.decode(encoding).split(' ', 1)
                 if vocab is not None and word not in vocab:
                     continue
+                if max_vocab is not None:
+                    keep.discard(word)
 
-                word_id = len(idx2w)
-                w2idx[word] = word_id
+                emb_matrix[len(idx2w)] = np.fromstring(vec, sep=' ', dtype=np.float32)
                 idx2w.append(word)
-                emb_matrix[word_id] = vec
 
-            idx2w = np.array(idx2w)
-        return vocab_size, vec_dim, emb_matrix, w2idx, idx2w
+            if max_vocab is not None:
+                for word, vec in _scan_fasttext_words(fin, keep, encoding):
+                    emb_matrix[len(idx2w)] = np.fromstring(vec, sep=' ', dtype=np.float32)
+                    idx2w.append(word)
+                vocab_size = len(idx2w)
+        return vocab_size, vec_dim, emb_matrix, idx2w
+
+    def _read_fasttext_vecs_parallel(self, file, encoding, vocab=None, workers=2):
+        """
+        Load word embeddings from a fasttext file with multiple processes. The file is
+        split into byte ranges on line boundaries, the ranges are parsed in parallel
+        into a shared matrix and the vocabulary is stitched back in file order. The
+        result is identical to _read_fasttext_vecs.
+
+        file: str
+        workers: int
+        """
+        with open(file, 'rb') as fin:
+            vocab_size, vec_dim = map(int, fin.readline().split())
+            data_start = fin.tell()
+            data_end = fin.seek(0, os.SEEK_END)
+
+            nchunks = workers * CHUNKS_PER_WORKER
+            bounds = [data_start]
+            for k in range(1, nchunks):
+                fin.seek(max(data_start + (data_end - data_start) * k // nchunks, bounds[-1]))
+                fin.readline()
+                bounds.append(min(fin.tell(), data_end))
+            bounds.append(data_end)
+        ranges = [(i, j) for i, j in zip(bounds[:-1], bounds[1:]) if i < j]
+
+        if vocab is not None:
+            vocab_size = len(self.vocab)
+        shape = (vocab_size, vec_dim)
+
+        shm = SharedMemory(create=True, size=max(vocab_size * vec_dim * np.dtype(np.float32).itemsize, 1))
+        try:
+            with multiprocessing.Pool(workers) as pool:
+                counts = pool.map(_count_fasttext_chunk, [(file, i, j, encoding, self.vocab) for i, j in ranges])
+                rows = np.cumsum([0] + counts[:-1])
+                words = pool.map(_parse_fasttext_chunk, [(file, i, j, encoding, self.vocab, shm.name, shape, int(r))
+                                                         for (i, j), r in zip(ranges, rows)])
+            emb_matrix = np.zeros((vocab_size + RESERVED_ROWS, vec_dim), dtype=np.float32)
+            emb_matrix[:vocab_size] = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        finally:
+            shm.close()
+            shm.unlink()
+
+        idx2w = [w for chunk in words for w in chunk]
+        return vocab_size, vec_dim, emb_matrix, idx2w
+
+    def _read_mmap_vecs(self, prefix, vocab=None, max_vocab=None, keep=None):
+        """
+        Open the binary store written by WordVecs.save. The matrix is memory-mapped
+        copy-on-write, so rows are paged in on demand and shared between processes
+        until they are modified.
+
+        prefix: str
+        max_vocab: int
+        keep: list[str] / set[str]
+        """
+        with open(prefix + MMAP_HEADER_EXT, 'r', encoding='utf-8') as fin:
+            header = fin.readline().split()
+            vocab_size, vec_dim, dtype = int(header[0]), int(header[1]), header[2]
+            capacity = int(header[3]) if len(header) > 3 else vocab_size
+
+        emb_matrix = np.memmap(prefix + MMAP_MATRIX_EXT, dtype=dtype, mode='c', shape=(capacity, vec_dim))
+        words = Vocabulary.load(prefix, vocab_size, encoding=self.encoding)
+
+        if vocab is not None or max_vocab is not None:
+            rows = np.arange(len(words))
+            if vocab is not None:
+                rows = np.unique(words.lookup(list(vocab)))
+                rows = rows[rows >= 0]
+            if max_vocab is not None:
+                keep = words.lookup(list(keep)) if keep else []
+                rows = rows[(rows < max_vocab) | np.isin(rows, keep)]
+            if np.array_equal(rows, np.arange(len(rows))):
+                emb_matrix = emb_matrix[:min(len(rows) + RESERVED_ROWS, capacity)]
+            else:
+                selected = np.zeros((len(rows) + RESERVED_ROWS, vec_dim), dtype=emb_matrix.dtype)
+                selected[:len(rows)] = emb_matrix[rows]
+                emb_matrix = selected
+            words = words.subset(rows)
+            vocab_size = len(rows)
+
+        return vocab_size, vec_dim, emb_matrix, words
+
+    def save(self, prefix):
+        """
+        Save the embeddings as a raw float32 matrix (<prefix>.mat), a vocabulary file with
+        one word per line (<prefix>.vocab), its hash index (<prefix>.vidx.npz, see
+        Vocabulary) and a header (<prefix>.hdr). The result can be
+        opened with WordVecs(prefix, emb_format='mmap'). RESERVED_ROWS zero rows are
+        appended to the matrix, so that a few words can be added to the mapped matrix
+        without copying it.
+
+        prefix: str
+
+        Returns: self
+        """
+        size = self._size
+        with open(prefix + MMAP_HEADER_EXT, 'w', encoding='utf-8') as fout:
+            fout.write('{0} {1} float32 {2}\n'.format(size, self.vec_dim, size + RESERVED_ROWS))
+        with open(prefix + MMAP_MATRIX_EXT, 'wb') as fout:
+            np.ascontiguousarray(self._matrix[:size], dtype=np.float32).tofile(fout)
+            np.zeros((RESERVED_ROWS, self.vec_dim), dtype=np.float32).tofile(fout)
+        self._vocab.save(prefix)
+        return self
+
+    def _reserve(self, size):
+        """
+        Make room for at least size rows. The capacity grows geometrically, so that
+        adding words one by one costs amortized O(1) copies per word.
+        """
+        capacity = self._matrix.shape[0]
+        if size <= capacity:
+            return
+        capacity = max(size, int(capacity * GROWTH_FACTOR))
+        if isinstance(self._matrix, QuantizedArray):
+            self._matrix.resize(capacity)
+        else:
+            matrix = np.zeros((capacity, self.vec_dim), dtype=self._matrix.dtype)
+            matrix[:self._size] = self._matrix[:self._size]
+            self._matrix = matrix
 
     def add_word(self, word, vec):
         """
@@ -143,29 +470,43 @@ class WordVecs(object):
         Returns: int
             index of the new word
         """
-        if word in self._w2idx:
-            raise ValueError('Word already in vocabulary')
+        return int(self.add_words([word], np.reshape(vec, (1, self.vec_dim)))[0])
 
-        new_id = len(self._w2idx)
+    def add_words(self, words, vecs):
+        """
+        Add new words and their vector representations to the embedding matrix.
 
-        if self._matrix.shape[0] == new_id:
-            self._matrix = np.concatenate(
-                (self._matrix, vec.reshape(1, self.vec_dim)), axis=0)
-        else:
-            self._matrix[new_id] = vec
+        words: list[str]
+        vecs: np.array of shape (len(words), vec_dim)
 
-        self._w2idx[word] = new_id
-        self._idx2w = np.append(self._idx2w, word)
-        return new_id
+        Returns: np.ndarray
+            indices of the new words
+        """
+        if len(set(words)) != len(words) or np.any(self._vocab.lookup(words) >= 0):
+            raise ValueError('Word already in vocabulary')
+        if len(words) == 0:
+            return np.arange(self._size, self._size)
+
+        start, end = self._size, self._size + len(words)
+        self._reserve(end)
+        self._matrix[start:end] = vecs
+        self._vocab.append(words)
+        self._size = end
+        self._sim_cache.clear()
+        return np.arange(start, end)
 
     def word2index(self, word):
         """
-        Lookup the index of the word in the vocabulary.
+        Lookup the index of the word in the vocabulary. A list of words is looked up
+        at once, with -1 for out-of-vocabulary words.
+
+        word: str / list[str]
+
+        Returns: int / np.ndarray of type int64
         """
-        try:
-            return self._w2idx[word]
-        except KeyError:
-            raise KeyError('Word not in vocabulary')
+        if isinstance(word, str):
+            return self._vocab.index(word)
+        return self._vocab.lookup(word)
 
     def index2word(self, index):
         """
@@ -173,14 +514,77 @@ class WordVecs(object):
 
         Returns: str / np.ndarray
         """
-        try:
-            return self._idx2w[index]
-        except IndexError:
-            raise IndexError('Invalid index')
+        return self._vocab[index]
 
     @property
     def embedding(self):
-        return self._matrix
+        if self._matrix.shape[0] == self._size:
+            return self._matrix
+        return self._matrix[:self._size]
+
+    def _inv_norms(self):
+        """
+        Returns the cached inverse l2 norm of each row (1 for zero rows).
+        """
+        if 'inv_norms' not in self._sim_cache:
+            norms = l2norm(self.embedding)
+            norms[norms == 0.] = 1.
+            self._sim_cache['inv_norms'] = 1. / norms
+        return self._sim_cache['inv_norms']
+
+    def _csls_penalty(self, csls):
+        """
+        Returns the cached mean cosine similarity of each word to its csls nearest
+        neighbours (itself excluded).
+        """
+        key = ('csls', csls)
+        if key not in self._sim_cache:
+            emb, inv_norms = self.embedding, self._inv_norms()
+            penalty = np.empty(self._size, dtype=np.float32)
+            for i in range(0, self._size, KNN_BLOCK_SIZE):
+                j = min(self._size, i + KNN_BLOCK_SIZE)
+                X = emb[i:j] * inv_norms[i:j, np.newaxis]
+                _, sim = top_k_dot(X, emb, csls, scale=inv_norms, exclude=np.arange(i, j))
+                penalty[i:j] = sim.mean(axis=1)
+            self._sim_cache[key] = penalty
+        return self._sim_cache[key]
+
+    def knn(self, queries, k=10, csls=0, batch_size=KNN_BATCH_SIZE):
+        """
+        Find the k nearest neighbours of many words or vectors at once by cosine
+        similarity, using blocked matrix products against the embedding matrix. Row
+        norms are cached until the embeddings are modified through this object.
+
+        queries: list[str] / np.ndarray of shape (n, vec_dim)
+            query words are not returned as their own neighbours
+        k: int
+        csls: int, optional (default 0)
+            if positive, rank by CSLS with csls neighbours instead. The first call
+            computes the penalty of every word, which is a full pass over the vocabulary.
+        batch_size: int
+            number of queries scored at a time
+
+        Returns: (np.ndarray, np.ndarray, np.ndarray)
+            indices, scores and words of shape (n, k), best first
+        """
+        emb, inv_norms = self.embedding, self._inv_norms()
+        if len(queries) > 0 and isinstance(queries[0], str):
+            exclude = self.word2index(list(queries))
+            if np.any(exclude < 0):
+                raise KeyError('Word not in vocabulary')
+            X = emb[exclude] * inv_norms[exclude, np.newaxis]
+        else:
+            exclude = None
+            X = length_normalize(np.array(queries, dtype=np.float32).reshape(-1, self.vec_dim))
+
+        if csls > 0:
+            bias = self._csls_penalty(csls) / 2
+            ind, sim = top_k_dot(X, emb, k, scale=inv_norms, bias=bias, exclude=exclude, batch_size=batch_size)
+            _, knn_sim = top_k_dot(X, emb, csls, scale=inv_norms, exclude=exclude, batch_size=batch_size)
+            sim = 2 * sim - knn_sim.mean(axis=1, keepdims=True)
+        else:
+            ind, sim = top_k_dot(X, emb, k, scale=inv_norms, exclude=exclude, batch_size=batch_size)
+        return ind, sim, self.index2word(ind)
 
     def most_similar(self, word, num_similar=5):
         """
@@ -194,34 +598,64 @@ class WordVecs(object):
         Returns: list[[int, str]]
             [[dist1, word1], [dist2, word2], ..., [dist_k, word_k]]
         """
-        idx = self.word2index[word]
-        vec = self._matrix[idx]
-        most_similar = [(1, 0)] * num_similar
-        for i, cur_vec in enumerate(self._matrix):
-            if i == idx:
-                continue
-            dist = cosine(vec, cur_vec)
-            if dist < most_similar[-1][0]:
-                most_similar.pop()
-                most_similar.append((dist, i))
-                most_similar = sorted(most_similar)
-
-        return [[dist, self._idx2w[i]] for dist, i in most_similar]
+        _, sim, words = self.knn([word], num_similar)
+        return [[float(1 - s), str(w)] for s, w in zip(sim[0], words[0])]
 
     def normalize(self, actions=None):
+        matrix = self.embedding
         if actions is None:
-            norms = np.linalg.norm(self._matrix, axis=1)
+            norms = np.linalg.norm(matrix, axis=1)
             norms[norms == .0] = 1
-            self._matrix /= norms[:, np.newaxis]
+            matrix /= norms[:, np.newaxis]
         else:
-            normalize(self._matrix, actions, inplace=True)
+            normalize(matrix, actions, inplace=True)
+        self._sim_cache.clear()
         return self
 
     def mean_center(self):
-        avg = np.mean(self._matrix, axis=0)
-        self._matrix -= avg
+        matrix = self.embedding
+        avg = np.mean(matrix, axis=0)
+        matrix -= avg
+        self._sim_cache.clear()
         return self
 
+    def quantize(self, storage='int8'):
+        """
+        Store the embedding matrix in reduced precision (see QuantizedArray). Rows
+        are dequantized to float32 when they are indexed. Normalize before quantizing.
+
+        storage: str (float32 / float16 / int8)
+
+        Returns: self
+        """
+        if storage != 'float32':
+            self._matrix = QuantizedArray(self.embedding, storage)
+            self._sim_cache.clear()
+        return self
+
+
+def load_wordvecs(path, max_vocab=None, keep=None):
+    """
+    Load the WordVecs object dumped by dump.py. If a memory-mapped store with the same
+    root (e.g. pickle/en.hdr for pickle/en.bin) exists, it is opened instead of
+    unpickling the whole object.
+
+    path: str
+    max_vocab: int, optional (default None)
+        only load the first max_vocab words plus the words in keep (memory-mapped
+        stores only, pickled objects are always loaded whole with a warning)
+    keep: list[str] / set[str], optional (default None)
+
+    Returns: WordVecs
+    """
+    root = os.path.splitext(path)[0]
+    if os.path.exists(root + MMAP_HEADER_EXT):
+        return WordVecs(root, emb_format='mmap', max_vocab=max_vocab, keep=keep)
+    if max_vocab or keep is not None:
+        logging.warning('%s is not a memory-mapped store (no %s), loading all its words' % (path, root + MMAP_HEADER_EXT))
+    with open(path, 'rb') as fin:
+        return pickle.load(fin)
+
 
 class BilingualDict(object):
     """
@@ -265,20 +699,32 @@ class BilingualDict(object):
 
         Returns: numpy.ndarray of shape (dicsize, 2)
         """
-        dic_in_index = []
-        for src_word, tgt_word in self.dictionary:
-            try:
-                src_id = source_wordvec.word2index(src_word)
-                tgt_id = target_wordvec.word2index(tgt_word)
-            except KeyError:
-                continue
-            dic_in_index.append([src_id, tgt_id])
-        return np.array(dic_in_index)
+        src_ind = source_wordvec.word2index([src_word for src_word, _ in self.dictionary])
+        tgt_ind = target_wordvec.word2index([tgt_word for _, tgt_word in self.dictionary])
+        found = (src_ind >= 0) & (tgt_ind >= 0)
+        return np.column_stack((src_ind[found], tgt_ind[found]))
+
+
+def _split_property(name):
+    """
+    Attribute for a train/dev/test split of SentimentDataset, read from disk on first access.
+    """
+    def getter(self):
+        if name not in self._splits:
+            for split, data in self._load_dataset(self.directory).items():
+                self._splits.setdefault(split, data)
+        return self._splits[name]
+
+    def setter(self, value):
+        self._splits[name] = value
+
+    return property(getter, setter)
 
 
 class SentimentDataset(object):
     """
-    Helper class for loading OpeNER datasets.
+    Helper class for loading OpeNER datasets. The sentences are read when a split is
+    first accessed.
 
     Parameters
     ----------
@@ -287,8 +733,16 @@ class SentimentDataset(object):
         <directory> --> train|dev|test --> pos|strpos|neg|strneg
     """
 
+    SPLITS = ('train', 'dev', 'test')
+    CATEGORIES = ('pos.txt', 'strpos.txt', 'neg.txt', 'strneg.txt')
+
+    train = _split_property('train')
+    dev = _split_property('dev')
+    test = _split_property('test')
+
     def __init__(self, directory):
-        self._load_dataset(directory)
+        self.directory = directory
+        self._splits = {}
 
     def _load_dataset(self, directory):
         """
@@ -303,40 +757,75 @@ class SentimentDataset(object):
                     return []
                 return [row.split() for row in sents]
 
-            ans = [load_category(cate)
-                   for cate in ['pos.txt', 'strpos.txt', 'neg.txt', 'strneg.txt']]
+            ans = [load_category(cate) for cate in self.CATEGORIES]
             X = sum(ans, [])
             y = np.concatenate([np.full(len(t), i)
                                 for i, t in enumerate(ans)], axis=0)
             return X, y
 
-        self.train = load(os.path.join(directory, 'train'))
-        self.dev = load(os.path.join(directory, 'dev'))
-        self.test = load(os.path.join(directory, 'test'))
+        return {split: load(os.path.join(directory, split)) for split in self.SPLITS}
 
-    def to_index(self, wordvecs, binary=False):
+    def _cache_file(self, wordvecs, binary, cache_dir):
+        """
+        Cache location of the dataset indexed with wordvecs, keyed by the dataset files
+        (path, size and modification time), the vocabulary and binary.
+        """
+        files = []
+        for split in self.SPLITS:
+            for cate in self.CATEGORIES:
+                path = os.path.join(self.directory, split, cate)
+                if os.path.exists(path):
+                    stat = os.stat(path)
+                    files.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+        key = json.dumps([files, wordvecs.vocab.fingerprint(), bool(binary)])
+        return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npz')
+
+    def to_index(self, wordvecs, binary=False, cache_dir=INDEX_CACHE_DIR):
         """
+        Convert sentences to lists of word indices, dropping out-of-vocabulary words.
+        Each distinct (lowercased) token is looked up once. The result is cached in
+        cache_dir, so that later runs with the same dataset and vocabulary skip reading
+        and indexing the sentences.
+
         wordvecs: WordVecs object
+        binary: bool
+        cache_dir: str, optional (default INDEX_CACHE_DIR)
+            None disables the cache
 
         Returns: self
         """
+        cache_file = None if cache_dir is None else self._cache_file(wordvecs, binary, cache_dir)
+        if cache_file is not None and os.path.exists(cache_file):
+            with np.load(cache_file) as cache:
+                for split in self.SPLITS:
+                    ind, lengths, y = (cache[split + suffix] for suffix in ('_ind', '_len', '_y'))
+                    X = [row.tolist() for row in np.split(ind, np.cumsum(lengths)[:-1])] if len(lengths) else []
+                    setattr(self, split, (X, y))
+            return self
+
         def sents2index(X, y, binary):
-            X_new = []
-            for sent in X:
-                sent_new = []
-                for word in sent:
-                    try:
-                        sent_new.append(wordvecs.word2index(word.lower()))
-                    except KeyError:
-                        continue
-                X_new.append(sent_new)
+            uniq = {}
+            inverse = np.array([uniq.setdefault(word.lower(), len(uniq)) for sent in X for word in sent],
+                               dtype=np.int64)
+            ind = wordvecs.word2index(list(uniq))[inverse]
+            X_new = [row[row >= 0] for row in np.split(ind, np.cumsum([len(sent) for sent in X])[:-1])] if X else []
             if binary:
                 y = (y >= 2).astype(np.int32)
             return X_new, y
 
-        self.train = sents2index(*self.train, binary=binary)
-        self.dev = sents2index(*self.dev, binary=binary)
-        self.test = sents2index(*self.test, binary=binary)
+        arrays = {}
+        for split in self.SPLITS:
+            X, y = sents2index(*getattr(self, split), binary=binary)
+            lengths = np.array([len(row) for row in X], dtype=np.int64)
+            arrays[split + '_ind'] = np.concatenate(X) if X else np.empty(0, dtype=np.int64)
+            arrays[split + '_len'], arrays[split + '_y'] = lengths, y
+            setattr(self, split, ([row.tolist() for row in X], y))
+
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = '%s.%d.tmp.npz' % (cache_file[:-4], os.getpid())
+            np.savez(tmp_file, **arrays)
+            os.replace(tmp_file, cache_file)
         return self
 
     def pad(self, value, maxlen=64):
@@ -357,22 +846,42 @@ class SentimentDataset(object):
         self.test = pad_sents(*self.test)
         return self
 
-    def to_vecs(self, emb, shuffle=False):
+    def to_ragged(self, maxlen=None):
         """
+        Store the indexed sentences of each split as a RaggedArray (CSR offsets and
+        word indices) instead of lists, without padding.
+
+        maxlen: int, optional
+            truncate sentences to maxlen words
+
+        Returns: self
+        """
+        self.train = (RaggedArray.from_lists(self.train[0], maxlen), self.train[1])
+        self.dev = (RaggedArray.from_lists(self.dev[0], maxlen), self.dev[1])
+        self.test = (RaggedArray.from_lists(self.test[0], maxlen), self.test[1])
+        return self
+
+    def to_vecs(self, emb, shuffle=False, W=None, pooling='mean'):
+        """
+        Replace word indices by vectors: the pooled word vectors of each sentence for
+        indexed or ragged datasets (see utils.math.pool), and the word vectors of each
+        position for padded ones.
+
         emb: ndarray of shape (vocab_size, vec_dim)
+        shuffle: bool
+        W: ndarray of shape (vec_dim, k), optional
+            projection applied to the word vectors, without projecting the whole emb
+        pooling: str
+            'mean', 'sum' or 'sqrt'
 
         Returns: self
         """
         def ind2vec(X, y, shuffle, mean):
             if mean:
-                size = len(X)
-                vec_dim = emb.shape[1]
-                X_new = np.zeros((size, vec_dim), dtype=np.float32)
-                for i, row in enumerate(X):
-                    if len(row) > 0:
-                        X_new[i] = np.mean(emb[row], axis=0)
+                S = pooling_matrix(X, emb.shape[0], pooling)
+                X_new = np.asarray(pool(S, emb, W), dtype=np.float32)
             else:
-                X_new = emb[X]
+                X_new = emb[X] if W is None else emb[X].dot(W)
             if shuffle:
                 perm = np.random.permutation(X_new.shape[0])
                 X_new, y = X_new[perm], y[perm]
@@ -420,11 +929,53 @@ class SentiWordSet(object):
         Returns: self
         """
         for i, words in enumerate(self.wordsets):
-            indices = []
-            for w in words:
-                try:
-                    indices.append(wordvecs.word2index(w))
-                except KeyError:
-                    pass
-            self.wordsets[i] = indices
+            indices = wordvecs.word2index(list(words))
+            self.wordsets[i] = indices[indices >= 0].tolist()
         return self
+
+
+def required_words(lang, root='.'):
+    """
+    Collect the words of a language used by the experiments: the (lowercased) tokens
+    of the sentiment datasets, the words on the lang side of every bilingual dictionary
+    under lexicons/ and the words of the sentiment categories.
+
+    lang: str
+    root: str
+        directory containing datasets/, lexicons/ and categories/
+
+    Returns: set[str]
+    """
+    words = set()
+    dataset_dirs = [os.path.join(root, 'datasets', lang, 'opener_sents'),
+                    os.path.join(root, 'datasets', 'trans', lang, 'opener_sents')]
+    dataset_dirs += glob.glob(os.path.join(root, 'datasets', 'cls10', 'jp' if lang == 'ja' else lang, '*'))
+    for directory in dataset_dirs:
+        if not os.path.isdir(directory):
+            continue
+        ds = SentimentDataset(directory)
+        for X, _ in (ds.train, ds.dev, ds.test):
+            words.update(w.lower() for sent in X for w in sent)
+
+    for lexicon in glob.glob(os.path.join(root, 'lexicons', '*', '*.txt')):
+        match = re.match(r'([a-z]+)-([a-z]+)\b', os.path.basename(lexicon))
+        if match is None or lang not in match.groups():
+            continue
+        side = match.groups().index(lang)
+        words.update(row[side] for row in BilingualDict(lexicon).dictionary)
+
+    category_file = os.path.join(root, 'categories', 'categories.%s' % lang)
+    if os.path.exists(category_file):
+        for wordset in SentiWordSet(category_file).wordsets:
+            words.update(wordset)
+    return words
+
+
+def load_word_list(path):
+    """
+    Read a file with one word per line (e.g. written by required_words.py).
+
+    Returns: list[str]
+    """
+    with open(path, 'r', encoding='utf-8', newline='\n') as fin:
+        return [w for w in fin.read().split('\n') if w]
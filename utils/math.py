@@ -4,12 +4,19 @@ math helpers
 author: fyl
 """
 
+import scipy.sparse
 from .cupy_utils import *
 
 
 NORM_BATCH_SIZE = 200000
 SORT_BATCH_SIZE = 10000
+TOP_K_BATCH_SIZE = 200
 DOT_BATCH_SIZE = 100000
+QUANT_BATCH_SIZE = 100000
+KNN_BATCH_SIZE = 1000
+KNN_BLOCK_SIZE = 50000
+BUCKET_WIDTH = 8
+DROPOUT_BATCH_SIZE = 1 << 20
 
 
 def spectral_norm(X):
@@ -97,6 +104,10 @@ def top_k_mean(X, k, inplace=False):
     """
     Average of top-k similarites.
 
+    The k largest entries of each row are selected with a partition over blocks of
+    TOP_K_BATCH_SIZE rows. With inplace=True a C-contiguous X is partitioned in place
+    (the order within rows is lost), otherwise one block is copied at a time.
+
     X: np.ndarray (or cupy.ndarray)
     k: int
     inplace: bool
@@ -104,26 +115,80 @@ def top_k_mean(X, k, inplace=False):
     Returns: np.ndarray (or cupy.ndarray)
     """
     xp = get_array_module(X)
-    size = X.shape[0]
+    size, ncols = X.shape
     ans = xp.zeros(size, dtype=xp.float32)
-    if k == 0:
+    k = min(k, ncols)
+    if k <= 0:
         return ans
-    if not inplace:
-        X = X.copy()
-    min_val = X.min()
-    ind0 = xp.arange(size)
-    ind1 = xp.zeros(size, dtype=xp.int32)
-    for i in range(k):
-        xp.argmax(X, axis=1, out=ind1)
-        ans += X[ind0, ind1]
-        X[ind0, ind1] = min_val
+    for i in range(0, size, TOP_K_BATCH_SIZE):
+        j = min(size, i + TOP_K_BATCH_SIZE)
+        # rows of a transposed matrix are strided, a C-ordered copy partitions faster
+        block = X[i:j] if inplace and X.flags.c_contiguous else xp.array(X[i:j], order='C')
+        block.partition(ncols - k, axis=1)
+        xp.sum(block[:, ncols - k:], axis=1, dtype=xp.float32, out=ans[i:j])
     ans /= k
     return ans
 
 
+def top_k_dot(X, Y, k, scale=None, bias=None, exclude=None, batch_size=KNN_BATCH_SIZE):
+    """
+    For each row x of X, the k rows y of Y with the largest score
+    (x . y) * scale[y] - bias[y]. Scores are computed in blocks of batch_size rows
+    of X by KNN_BLOCK_SIZE rows of Y, keeping a running top-k per row with argpartition.
+
+    X: ndarray of rank 2
+    Y: ndarray of rank 2 (or any object supporting shape and row slicing)
+    k: int
+    scale: ndarray of shape (Y.shape[0],), optional
+    bias: ndarray of shape (Y.shape[0],), optional
+    exclude: ndarray of shape (X.shape[0],), optional
+        index of a row of Y to skip for each row of X (-1 for none)
+    batch_size: int
+
+    Returns: (ndarray, ndarray)
+        indices and scores of shape (X.shape[0], k), best first
+    """
+    xp = get_array_module(X)
+    xsize, ysize = X.shape[0], Y.shape[0]
+    k = min(k, ysize)
+    ind = xp.empty((xsize, k), dtype=xp.int64)
+    val = xp.empty((xsize, k), dtype=xp.float32)
+    for i in range(0, xsize, batch_size):
+        i2 = min(xsize, i + batch_size)
+        best_ind = xp.empty((i2 - i, 0), dtype=xp.int64)
+        best_val = xp.empty((i2 - i, 0), dtype=xp.float32)
+        for j in range(0, ysize, KNN_BLOCK_SIZE):
+            j2 = min(ysize, j + KNN_BLOCK_SIZE)
+            S = xp.dot(X[i:i2], Y[j:j2].T)
+            if scale is not None:
+                S *= scale[j:j2]
+            if bias is not None:
+                S -= bias[j:j2]
+            if exclude is not None:
+                rows = xp.flatnonzero((exclude[i:i2] >= j) & (exclude[i:i2] < j2))
+                S[rows, exclude[i:i2][rows] - j] = -xp.inf
+            kk = min(k, j2 - j)
+            part = xp.argpartition(S, j2 - j - kk, axis=1)[:, j2 - j - kk:]
+            best_ind = xp.concatenate((best_ind, part + j), axis=1)
+            best_val = xp.concatenate((best_val, xp.take_along_axis(S, part, axis=1)), axis=1)
+            if best_ind.shape[1] > k:
+                part = xp.argpartition(best_val, best_val.shape[1] - k, axis=1)[:, best_val.shape[1] - k:]
+                best_ind = xp.take_along_axis(best_ind, part, axis=1)
+                best_val = xp.take_along_axis(best_val, part, axis=1)
+        order = xp.argsort(-best_val, axis=1)
+        ind[i:i2] = xp.take_along_axis(best_ind, order, axis=1)
+        val[i:i2] = xp.take_along_axis(best_val, order, axis=1)
+    return ind, val
+
+
 def dropout(X, keep_prob, inplace=True):
     """
-    Randomly set entries of X to zeros.
+    Randomly set entries of X to zeros, keeping each with probability keep_prob.
+
+    The mask is drawn from float32 uniforms DROPOUT_BATCH_SIZE entries (whole rows)
+    at a time, so the temporaries stay small whatever the size of X. With numpy they
+    come from a Generator seeded from the global RandomState, so numpy.random.seed
+    keeps runs reproducible.
 
     X: np.ndarray (or cupy.ndarray)
     keep_prob: float
@@ -134,14 +199,409 @@ def dropout(X, keep_prob, inplace=True):
     xp = get_array_module(X)
     if keep_prob >= 1.:
         return X if inplace else X.copy()
-    mask = xp.random.rand(*X.shape) < keep_prob
-    if inplace:
-        X *= mask
+    if not inplace:
+        X = X.copy()
+    if X.size == 0:
+        return X
+    if xp is numpy:
+        rng = numpy.random.default_rng(numpy.random.randint(2**31))
+    step = max(DROPOUT_BATCH_SIZE * X.shape[0] // X.size, 1)
+    for i in range(0, X.shape[0], step):
+        j = min(X.shape[0], i + step)
+        if xp is numpy:
+            mask = rng.random(X[i:j].shape, dtype=numpy.float32) < keep_prob
+        else:
+            mask = xp.random.random_sample(X[i:j].shape, dtype=xp.float32) < keep_prob
+        X[i:j] *= mask
+    return X
+
+
+def quantize(X, storage):
+    """
+    Quantize rows of X to reduced precision.
+
+    X: ndarray of rank 2
+    storage: str
+        'float16', or 'int8' with a float32 scale per row
+
+    Returns: (ndarray, ndarray or None)
+        quantized matrix and row scales (None for float16)
+    """
+    xp = get_array_module(X)
+    if storage == 'float16':
+        return X.astype(xp.float16), None
+    elif storage == 'int8':
+        scale = (xp.abs(X).max(axis=1) / 127).astype(xp.float32)
+        scale[scale == 0] = 1
+        return xp.rint(X / scale[:, xp.newaxis]).astype(xp.int8), scale
     else:
-        X = X * mask
+        raise ValueError('Invalid storage type: %s' % storage)
+
+
+def dequantize(Q, scale):
+    """
+    Inverse of quantize.
+
+    Q: ndarray
+    scale: ndarray or None
+
+    Returns: ndarray of type float32
+    """
+    xp = get_array_module(Q)
+    X = Q.astype(xp.float32)
+    if scale is not None:
+        X *= xp.expand_dims(scale, -1)
     return X
 
 
+class QuantizedArray(object):
+    """
+    Row-major float16 / int8 storage of a float32 matrix. Indexing returns dequantized
+    float32 rows and assignment quantizes them, so the array can stand in for an
+    embedding matrix wherever rows are accessed batch by batch.
+
+    Parameters
+    ----------
+    X: ndarray of rank 2 (or any object supporting shape and row slicing)
+    storage: str
+        'float16' or 'int8'
+    """
+
+    def __init__(self, X, storage='int8'):
+        if storage not in ('float16', 'int8'):
+            raise ValueError('Invalid storage type: %s' % storage)
+        xp = get_array_module(X[:1])
+        self.storage = storage
+        self.shape = tuple(X.shape)
+        self.Q = xp.empty(self.shape, dtype=xp.float16 if storage == 'float16' else xp.int8)
+        self.scale = xp.ones(self.shape[0], dtype=xp.float32) if storage == 'int8' else None
+        for i in range(0, self.shape[0], QUANT_BATCH_SIZE):
+            j = min(self.shape[0], i + QUANT_BATCH_SIZE)
+            self[i:j] = X[i:j]
+
+    @classmethod
+    def from_quantized(cls, Q, scale=None):
+        """
+        Wrap quantized data (e.g. arrays in shared memory) without copying it.
+
+        Q: ndarray of type float16 or int8
+        scale: ndarray of type float32, required for int8
+        """
+        self = cls.__new__(cls)
+        self.storage = 'int8' if scale is not None else 'float16'
+        self.shape = tuple(Q.shape)
+        self.Q, self.scale = Q, scale
+        return self
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return dequantize(self.Q[key], None if self.scale is None else self.scale[key])
+
+    def __setitem__(self, key, value):
+        xp = get_array_module(self.Q)
+        value = xp.asarray(value, dtype=xp.float32)
+        q, s = quantize(value.reshape(-1, self.shape[1]), self.storage)
+        self.Q[key] = q.reshape(value.shape)
+        if s is not None:
+            self.scale[key] = s.reshape(value.shape[:-1])
+
+    def resize(self, rows):
+        """
+        Grow (or shrink) the array to the given number of rows. New rows are zero.
+        """
+        xp = get_array_module(self.Q)
+        Q = xp.zeros((rows, self.shape[1]), dtype=self.Q.dtype)
+        n = min(rows, self.shape[0])
+        Q[:n] = self.Q[:n]
+        self.Q = Q
+        if self.scale is not None:
+            scale = xp.ones(rows, dtype=xp.float32)
+            scale[:n] = self.scale[:n]
+            self.scale = scale
+        self.shape = (rows, self.shape[1])
+
+    @property
+    def nbytes(self):
+        return self.Q.nbytes + (0 if self.scale is None else self.scale.nbytes)
+
+    def dot(self, W, out=None):
+        """
+        Returns self @ W, dequantizing QUANT_BATCH_SIZE rows at a time.
+        """
+        xp = get_array_module(self.Q, W)
+        if out is None:
+            out = xp.empty((self.shape[0], W.shape[1]), dtype=xp.float32)
+        for i in range(0, self.shape[0], QUANT_BATCH_SIZE):
+            j = min(self.shape[0], i + QUANT_BATCH_SIZE)
+            xp.dot(self[i:j], W, out=out[i:j])
+        return out
+
+    def tdot(self, X, out=None):
+        """
+        Returns X @ self.T, dequantizing QUANT_BATCH_SIZE rows at a time.
+        """
+        xp = get_array_module(self.Q, X)
+        if out is None:
+            out = xp.empty((X.shape[0], self.shape[0]), dtype=xp.float32)
+        for i in range(0, self.shape[0], QUANT_BATCH_SIZE):
+            j = min(self.shape[0], i + QUANT_BATCH_SIZE)
+            out[:, i:j] = xp.dot(X, self[i:j].T)
+        return out
+
+    def sqr_norm(self):
+        """
+        Returns the squared l2 norm of each row.
+        """
+        xp = get_array_module(self.Q)
+        norms = xp.empty(self.shape[0], dtype=xp.float32)
+        for i in range(0, self.shape[0], QUANT_BATCH_SIZE):
+            j = min(self.shape[0], i + QUANT_BATCH_SIZE)
+            norms[i:j] = xp.sum(self[i:j]**2, axis=1)
+        return norms
+
+
+def segment_ids(offsets):
+    """
+    Segment of each element of a ragged array.
+
+    offsets: ndarray of shape (n + 1,)
+
+    Returns: ndarray of shape (offsets[-1],)
+    """
+    xp = get_array_module(offsets)
+    return xp.searchsorted(offsets[1:], xp.arange(int(offsets[-1])), side='right')
+
+
+def segment_sum(X, offsets):
+    """
+    Sums of the consecutive segments X[offsets[i]:offsets[i + 1]] along the first axis.
+    Empty segments sum to zero.
+
+    X: ndarray with offsets[-1] rows
+    offsets: ndarray of shape (n + 1,)
+
+    Returns: ndarray of shape (n,) + X.shape[1:]
+    """
+    xp = get_array_module(X, offsets)
+    n = offsets.shape[0] - 1
+    out = xp.zeros((n,) + X.shape[1:], dtype=X.dtype)
+    if xp is numpy:
+        nonempty = xp.flatnonzero(offsets[1:] > offsets[:-1])
+        if nonempty.size > 0:
+            # empty segments in between have zero length, so they do not cut the sums short
+            out[nonempty] = xp.add.reduceat(X, offsets[:-1][nonempty], axis=0)
+    else:
+        import cupyx
+        cupyx.scatter_add(out, segment_ids(offsets), X)
+    return out
+
+
+def segment_mean(X, offsets):
+    """
+    Means of the consecutive segments of X, zero for empty segments.
+
+    Returns: ndarray of shape (n,) + X.shape[1:]
+    """
+    xp = get_array_module(X, offsets)
+    lengths = xp.maximum(offsets[1:] - offsets[:-1], 1).astype(X.dtype)
+    return segment_sum(X, offsets) / lengths.reshape((-1,) + (1,) * (X.ndim - 1))
+
+
+class RaggedArray(object):
+    """
+    Rows of varying length stored in CSR form: row i is indices[offsets[i]:offsets[i + 1]].
+    Used for sentences as lists of word indices, so that pooling costs memory
+    proportional to the number of tokens instead of a padded (n, maxlen) layout.
+
+    Parameters
+    ----------
+    indices: ndarray of shape (nnz,)
+    offsets: ndarray of shape (n + 1,)
+    """
+
+    def __init__(self, indices, offsets):
+        self.indices = indices
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, rows, maxlen=None):
+        """
+        rows: list[list[int]]
+        maxlen: int, optional
+            truncate rows to maxlen elements
+
+        Returns: RaggedArray
+        """
+        if maxlen is not None:
+            rows = [row[:maxlen] for row in rows]
+        lengths = numpy.array([len(row) for row in rows], dtype=numpy.int64)
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths))).astype(numpy.int64)
+        indices = numpy.fromiter((i for row in rows for i in row), dtype=numpy.int64, count=int(offsets[-1]))
+        return cls(indices, offsets)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    @property
+    def lengths(self):
+        return self.offsets[1:] - self.offsets[:-1]
+
+    def __getitem__(self, key):
+        """
+        key: int / slice / ndarray of indices or booleans
+
+        Returns: ndarray (for an int) or RaggedArray
+        """
+        xp = get_array_module(self.indices)
+        if isinstance(key, (int, numpy.integer)):
+            return self.indices[self.offsets[key]:self.offsets[key + 1]]
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(len(self))
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop + 1]
+            return RaggedArray(self.indices[offsets[0]:offsets[-1]], offsets - offsets[0])
+        if isinstance(key, slice):
+            key = xp.arange(*key.indices(len(self)))
+        key = xp.asarray(key)
+        key = xp.flatnonzero(key) if key.dtype == bool else key.astype(xp.int64, copy=False)
+        starts = self.offsets[key]
+        lengths = self.offsets[key + 1] - starts
+        offsets = xp.concatenate((xp.zeros(1, dtype=self.offsets.dtype), xp.cumsum(lengths)))
+        seg = segment_ids(offsets)
+        return RaggedArray(self.indices[starts[seg] + xp.arange(seg.shape[0]) - offsets[seg]], offsets)
+
+    def sum(self, emb):
+        """
+        Returns: ndarray of shape (len(self), emb.shape[1])
+            sum of the rows of emb selected by each row
+        """
+        return segment_sum(emb[self.indices], self.offsets)
+
+    def mean(self, emb):
+        """
+        Returns: ndarray of shape (len(self), emb.shape[1])
+            mean of the rows of emb selected by each row (zero for empty rows)
+        """
+        return segment_mean(emb[self.indices], self.offsets)
+
+    def to_dense(self, emb, length=None):
+        """
+        Padded tensor of the rows of emb selected by each row. Rows are truncated to
+        length and padding positions are zero vectors.
+
+        emb: ndarray of rank 2
+        length: int, optional (default the length of the longest row)
+
+        Returns: ndarray of shape (len(self), length, emb.shape[1])
+        """
+        xp = get_array_module(self.indices)
+        if length is None:
+            length = int(self.lengths.max()) if len(self) > 0 else 0
+        seg = segment_ids(self.offsets)
+        pos = xp.arange(self.indices.shape[0]) - self.offsets[seg]
+        keep = pos < length
+        X = xp.zeros((len(self), length, emb.shape[1]), dtype=emb.dtype)
+        X[seg[keep], pos[keep]] = emb[self.indices[keep]]
+        return X
+
+
+def bucket_length(length, maxlen=None, width=BUCKET_WIDTH):
+    """
+    Round length up to a multiple of width, at most maxlen.
+
+    Returns: int
+    """
+    length = -(-max(length, 1) // width) * width
+    return length if maxlen is None else min(length, maxlen)
+
+
+def length_batches(rows, batch_size, maxlen=None, extra=0, sort=False, width=BUCKET_WIDTH):
+    """
+    Split rows into batches, each padded only to the length bucket of its longest row
+    instead of maxlen.
+
+    rows: RaggedArray
+    batch_size: int
+    maxlen: int, optional
+        padding size of the fixed-length layout, rows longer than that are truncated
+    extra: int
+        number of padding positions needed after the longest row for the batch to give
+        the same results as with maxlen (e.g. the widest convolution)
+    sort: bool
+        group rows of similar length together. The batches then differ from the
+        consecutive ones, so this is meant for inference only.
+
+    Yields: (ndarray, int)
+        indices of the rows in the batch and the padding length
+    """
+    lengths = asnumpy(rows.lengths)
+    order = numpy.argsort(lengths, kind='stable') if sort else numpy.arange(len(rows))
+    for offset in range(0, len(rows), batch_size):
+        idx = order[offset:offset + batch_size]
+        yield idx, bucket_length(int(lengths[idx].max()) + extra, maxlen, width)
+
+
+def pooling_matrix(rows, vocab_size=None, mode='mean'):
+    """
+    Sparse matrix S such that S @ E pools the rows of E indexed by each row of rows.
+    Repeated indices are counted repeatedly. Empty rows pool to zero.
+
+    rows: RaggedArray or list[list[int]]
+    vocab_size: int, optional (default max index + 1)
+    mode: str
+        'sum', 'mean', or 'sqrt' (the sum divided by the square root of the length)
+
+    Returns: scipy.sparse.csr_matrix (or cupyx.scipy.sparse.csr_matrix) of shape (len(rows), vocab_size)
+    """
+    if not isinstance(rows, RaggedArray):
+        rows = RaggedArray.from_lists(rows)
+    xp = get_array_module(rows.indices)
+    lengths = xp.maximum(rows.lengths, 1).astype(xp.float32)
+    if mode == 'sum':
+        weights = xp.ones_like(lengths)
+    elif mode == 'mean':
+        weights = 1 / lengths
+    elif mode == 'sqrt':
+        weights = 1 / xp.sqrt(lengths)
+    else:
+        raise ValueError('Invalid pooling mode: %s' % mode)
+    if vocab_size is None:
+        vocab_size = int(rows.indices.max()) + 1 if rows.indices.shape[0] > 0 else 0
+    if xp is numpy:
+        csr_matrix = scipy.sparse.csr_matrix
+    else:
+        import cupyx.scipy.sparse
+        csr_matrix = cupyx.scipy.sparse.csr_matrix
+    data = weights[segment_ids(rows.offsets)]
+    return csr_matrix((data, rows.indices, rows.offsets), shape=(len(rows), vocab_size))
+
+
+def pool(S, E, W=None):
+    """
+    Pooled (and projected) vectors S @ E @ W in one sparse-dense product. Only the
+    rows of E used by S are read, and the product is ordered as (S @ E) @ W or
+    S @ (E @ W), whichever takes fewer operations.
+
+    S: sparse matrix returned by pooling_matrix
+    E: ndarray of rank 2 (or any object supporting fancy row indexing)
+    W: ndarray of rank 2, optional
+
+    Returns: ndarray of shape (S.shape[0], W.shape[1] or E.shape[1])
+    """
+    xp = get_array_module(S.indices)
+    used = xp.unique(S.indices)
+    S = S.__class__((S.data, xp.searchsorted(used, S.indices), S.indptr), shape=(S.shape[0], used.shape[0]))
+    E = E[used]
+    if W is None:
+        return S @ E
+    n, d, k = S.shape[0], E.shape[1], W.shape[1]
+    if S.nnz * d + n * d * k <= used.shape[0] * d * k + S.nnz * k:
+        return (S @ E).dot(W)
+    return S @ E.dot(W)
+
+
 def sample(X, Y, num_sample):
     """
     X: ndarray
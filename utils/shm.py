@@ -0,0 +1,175 @@
+"""
+registry of numpy arrays in named shared memory blocks
+
+A group of arrays is shared under a name: each array goes to the block
+<name>_<key> and the shapes and dtypes, together with any JSON-serializable
+metadata, go to the block <name>_meta. Other processes attach to the group by
+name without copying. Attached arrays are read-only.
+"""
+import atexit
+import json
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+
+META_KEY = 'meta'
+
+_owned = {}
+_attached = {}
+_shared_tracker = None
+
+
+def _block_name(name, key):
+    return '%s_%s' % (name, key)
+
+
+def _open(block_name):
+    """
+    Attach to an existing block without taking ownership of it.
+    """
+    global _shared_tracker
+    try:
+        return SharedMemory(name=block_name, track=False)
+    except TypeError:
+        pass
+    # before python 3.13 attaching registers the block with the resource tracker. A
+    # tracker inherited from the parent (multiprocessing workers) is the one of the
+    # owner, but a tracker started by this process would unlink the block on exit.
+    if _shared_tracker is None:
+        _shared_tracker = getattr(resource_tracker._resource_tracker, '_fd', None) is not None
+    shm = SharedMemory(name=block_name)
+    if not _shared_tracker:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _read_meta(shm):
+    # the block may be rounded up to a page, so strip the padding
+    return json.loads(bytes(shm.buf).rstrip(b'\x00').decode('utf-8'))
+
+
+def share_arrays(name, arrays, meta=None):
+    """
+    Copy arrays into shared memory blocks. The blocks live until release(name) is
+    called or this process exits.
+
+    name: str
+    arrays: dict[str, np.ndarray]
+    meta: dict, optional
+
+    Returns: dict[str, np.ndarray]
+        the arrays backed by the shared blocks
+    """
+    if name in _owned or name in _attached:
+        raise ValueError('Name already in use: %s' % name)
+    blocks, shared, layout = [], {}, {}
+    try:
+        for key, X in arrays.items():
+            X = np.ascontiguousarray(X)
+            shm = SharedMemory(name=_block_name(name, key), create=True, size=max(X.nbytes, 1))
+            blocks.append(shm)
+            shared[key] = np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)
+            shared[key][...] = X
+            layout[key] = [list(X.shape), X.dtype.str]
+        data = json.dumps({'arrays': layout, 'meta': meta or {}}).encode('utf-8')
+        shm = SharedMemory(name=_block_name(name, META_KEY), create=True, size=len(data))
+        blocks.append(shm)
+        shm.buf[:len(data)] = data
+    except Exception:
+        for shm in blocks:
+            _close(shm)
+            shm.unlink()
+        raise
+    _owned[name] = (blocks, shared)
+    return shared
+
+
+def attach_arrays(name):
+    """
+    Attach to arrays shared by share_arrays, possibly in another process.
+
+    name: str
+
+    Returns: (dict[str, np.ndarray], dict)
+        read-only arrays and the metadata
+    """
+    if name in _owned:
+        blocks, shared = _owned[name]
+        arrays = {}
+        for key, X in shared.items():
+            arrays[key] = X.view()
+            arrays[key].flags.writeable = False
+        return arrays, _read_meta(blocks[-1])['meta']
+    if name not in _attached:
+        shm = _open(_block_name(name, META_KEY))
+        info = _read_meta(shm)
+        blocks, arrays = [shm], {}
+        for key, (shape, dtype) in info['arrays'].items():
+            shm = _open(_block_name(name, key))
+            blocks.append(shm)
+            arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            arrays[key].flags.writeable = False
+        _attached[name] = (blocks, arrays, info['meta'])
+    _, arrays, meta = _attached[name]
+    return arrays, meta
+
+
+def share_array(name, X):
+    """
+    Share a single array, e.g. a projected embedding matrix.
+
+    Returns: np.ndarray
+    """
+    return share_arrays(name, {'array': X})['array']
+
+
+def attach_array(name):
+    """
+    Attach to an array shared by share_array.
+
+    Returns: np.ndarray
+    """
+    return attach_arrays(name)[0]['array']
+
+
+def release(name):
+    """
+    Detach from the arrays shared under name, and free them if they were shared by
+    this process. Arrays obtained from the registry must not be used afterwards.
+    """
+    if name in _owned:
+        blocks, _ = _owned.pop(name)
+        for shm in blocks:
+            _close(shm)
+            shm.unlink()
+    else:
+        detach(name)
+
+
+def detach(name):
+    """
+    Detach from the arrays attached under name by attach_arrays, e.g. in a worker done
+    with them. Arrays shared by this process are left in place.
+    """
+    if name in _attached:
+        blocks, _, _ = _attached.pop(name)
+        for shm in blocks:
+            _close(shm)
+
+
+def _close(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # arrays still reference the block, it is unmapped when they are freed
+        pass
+
+
+@atexit.register
+def _release_all():
+    for name in list(_owned) + list(_attached):
+        try:
+            release(name)
+        except Exception:
+            pass
@@ -0,0 +1,67 @@
+"""
+scikit-learn helpers.
+"""
+import itertools
+import os
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
+from sklearn.model_selection import GridSearchCV
+from .shm import share_array, attach_array, detach, release
+
+_names = itertools.count()
+
+
+class SharedRowsClassifier(ClassifierMixin, BaseEstimator):
+    """
+    Classifier trained on rows of an array shared by utils.shm.share_array. X holds
+    row indices, so that the workers of GridSearchCV(n_jobs=...) receive the indices
+    and attach to the shared array instead of each unpickling a copy of the features.
+
+    Parameters
+    ----------
+    estimator: classifier
+    name: str
+        name of the shared array
+    """
+
+    def __init__(self, estimator=None, name=None):
+        self.estimator = estimator
+        self.name = name
+
+    def fit(self, X, y):
+        self.estimator_ = clone(self.estimator).fit(self._rows(X), y)
+        self.classes_ = self.estimator_.classes_
+        return self
+
+    def predict(self, X):
+        return self.estimator_.predict(self._rows(X))
+
+    def _rows(self, X):
+        try:
+            return attach_array(self.name)[np.asarray(X)[:, 0]]
+        finally:
+            detach(self.name)
+
+
+def shared_grid_search(estimator, param_grid, X, y, **kwargs):
+    """
+    GridSearchCV(estimator, param_grid, **kwargs).fit(X, y) with X in shared memory
+    (see SharedRowsClassifier). The shared array is released once the search is done,
+    so only best_estimator_.estimator_ (the refitted estimator) predicts afterwards.
+
+    estimator: classifier
+    param_grid: dict
+        parameters of estimator. best_params_ prefixes them with 'estimator__'
+    X: ndarray of shape (n, dim)
+    y: ndarray of shape (n,)
+
+    Returns: GridSearchCV
+    """
+    name = 'grid_search_%d_%d' % (os.getpid(), next(_names))
+    share_array(name, X)
+    try:
+        grid = {'estimator__' + key: values for key, values in param_grid.items()}
+        clf = GridSearchCV(SharedRowsClassifier(estimator, name), grid, **kwargs)
+        return clf.fit(np.arange(X.shape[0]).reshape(-1, 1), y)
+    finally:
+        release(name)
@@ -0,0 +1,376 @@
+"""
+compact vocabulary for word embeddings
+
+Words are stored in one encoded blob (each word followed by a newline) with an
+array of offsets, and looked up through an open-addressing hash table of
+word indices. Lookups of many words at once are vectorized; single words go
+through a scalar path that does not allocate arrays.
+"""
+import hashlib
+import os
+import numpy as np
+
+
+FNV_OFFSET = np.uint64(14695981039346656037)
+FNV_PRIME = np.uint64(1099511628211)
+FNV_MASK = (1 << 64) - 1
+MAX_LOAD_FACTOR = 0.5
+MIN_TABLE_SIZE = 16
+GROWTH_FACTOR = 1.5
+SEP = ord('\n')
+VOCAB_EXT = '.vocab'
+INDEX_EXT = '.vidx.npz'
+
+
+def fnv1a(data, starts, lengths):
+    """
+    64-bit FNV-1a hashes of the byte strings data[starts[i]:starts[i] + lengths[i]].
+    Words are processed in order of decreasing length, so each byte is visited once.
+
+    data: np.ndarray of type uint8
+    starts: np.ndarray of type int
+    lengths: np.ndarray of type int
+
+    Returns: np.ndarray of type uint64
+    """
+    n = lengths.shape[0]
+    hashes = np.full(n, FNV_OFFSET, dtype=np.uint64)
+    if n == 0:
+        return hashes
+    order = np.argsort(-lengths, kind='stable')
+    starts, lengths = starts[order], lengths[order]
+    maxlen = int(lengths[0])
+    active = np.searchsorted(-lengths, -np.arange(maxlen), side='left')
+    h = hashes.copy()
+    for pos in range(maxlen):
+        k = active[pos]
+        h[:k] ^= data[starts[:k] + pos]
+        h[:k] *= FNV_PRIME
+    hashes[order] = h
+    return hashes
+
+
+def fnv1a_bytes(word):
+    """
+    64-bit FNV-1a hash of a single byte string, equal to the corresponding fnv1a hash.
+
+    word: bytes
+
+    Returns: int
+    """
+    h, prime = int(FNV_OFFSET), int(FNV_PRIME)
+    for byte in word:
+        h = ((h ^ byte) * prime) & FNV_MASK
+    return h
+
+
+def _ragged_range(starts, lengths):
+    """
+    Concatenation of arange(starts[i], starts[i] + lengths[i]) for all i.
+    """
+    total = int(lengths.sum())
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - (ends - lengths), lengths) + np.arange(total)
+
+
+def _encode(words, encoding='utf-8'):
+    """
+    Returns: (np.ndarray, np.ndarray, np.ndarray)
+        newline-separated bytes, start offsets and byte lengths of the words
+    """
+    encoded = [w.encode(encoding) for w in words]
+    lengths = np.array([len(w) for w in encoded], dtype=np.int64)
+    data = np.frombuffer(b'\n'.join(encoded) + b'\n', dtype=np.uint8) if encoded else np.empty(0, dtype=np.uint8)
+    starts = np.cumsum(lengths + 1) - (lengths + 1)
+    return data, starts, lengths
+
+
+def _grow(array, size, fill=0):
+    """
+    Returns array if it can hold size elements, otherwise a geometrically larger copy.
+    """
+    if size <= array.shape[0]:
+        return array
+    grown = np.full(max(size, int(array.shape[0] * GROWTH_FACTOR)), fill, dtype=array.dtype)
+    grown[:array.shape[0]] = array
+    return grown
+
+
+class Vocabulary(object):
+    """
+    Mapping between words and indices 0..n-1 in insertion order. If a word is
+    inserted more than once, lookups return its first index.
+
+    Parameters
+    ----------
+    words: list[str], optional
+    encoding: str, optional (default 'utf-8')
+        encoding of the stored words
+    """
+
+    def __init__(self, words=(), encoding='utf-8'):
+        self.encoding = encoding
+        self._size = 0
+        self._nbytes = 0
+        self._blob = np.empty(0, dtype=np.uint8)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._table = np.full(MIN_TABLE_SIZE, -1, dtype=np.int32)
+        self.append(words)
+
+    def __setstate__(self, state):
+        # objects pickled before the encoding was stored
+        state.setdefault('encoding', 'utf-8')
+        self.__dict__.update(state)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, word):
+        return self._find(word.encode(self.encoding)) >= 0
+
+    def __iter__(self):
+        return iter(self.words())
+
+    def __getitem__(self, index):
+        """
+        index: int / List[int] / np.ndarray of type int
+
+        Returns: str / np.ndarray
+        """
+        if np.isscalar(index):
+            index = int(index)
+            if index < -self._size or index >= self._size:
+                raise IndexError('Invalid index')
+            index %= self._size
+            start, end = self._offsets.item(index), self._offsets.item(index + 1) - 1
+            return self._blob[start:end].tobytes().decode(self.encoding)
+        index = np.asarray(index, dtype=np.int64)
+        if np.any((index < -self._size) | (index >= self._size)):
+            raise IndexError('Invalid index')
+        flat = index.ravel() % max(self._size, 1)
+        starts = self._offsets[flat]
+        lengths = self._offsets[flat + 1] - starts
+        data = bytes(self._blob[_ragged_range(starts, lengths)]).decode(self.encoding)
+        return np.array(data.split('\n')[:-1] if index.size else [], dtype=str).reshape(index.shape)
+
+    def words(self):
+        """
+        Returns: list[str]
+        """
+        if self._size == 0:
+            return []
+        return bytes(self._blob[:self._nbytes - 1]).decode(self.encoding).split('\n')
+
+    def index(self, word):
+        """
+        Returns: int
+        """
+        idx = self._find(word.encode(self.encoding))
+        if idx < 0:
+            raise KeyError('Word not in vocabulary')
+        return idx
+
+    def _find(self, word):
+        """
+        Scalar lookup of one encoded word, probing the hash table like lookup.
+
+        word: bytes
+
+        Returns: int
+            index of the word, -1 if it is out of vocabulary
+        """
+        h = fnv1a_bytes(word)
+        table, offsets = self._table, self._offsets
+        mask = table.shape[0] - 1
+        pos = h & mask
+        while True:
+            idx = table.item(pos)
+            if idx < 0:
+                return -1
+            if self._hashes.item(idx) == h:
+                start = offsets.item(idx)
+                if self._blob[start:offsets.item(idx + 1) - 1].tobytes() == word:
+                    return idx
+            pos = (pos + 1) & mask
+
+    def lookup(self, words):
+        """
+        Vectorized lookup of many words.
+
+        words: list[str]
+
+        Returns: np.ndarray of type int64
+            indices of the words, -1 for out-of-vocabulary words
+        """
+        data, starts, lengths = _encode(words, self.encoding)
+        hashes = fnv1a(data, starts, lengths)
+        result = np.full(len(lengths), -1, dtype=np.int64)
+        mask = self._table.shape[0] - 1
+        pos = (hashes & np.uint64(mask)).astype(np.int64)
+        pending = np.arange(len(lengths))
+        while pending.size > 0:
+            idx = self._table[pos[pending]]
+            occupied = idx >= 0
+            match = np.zeros(pending.size, dtype=bool)
+            cand = np.flatnonzero(occupied)
+            cand = cand[self._hashes[idx[cand]] == hashes[pending[cand]]]
+            if cand.size > 0:
+                equal = self._equal(idx[cand], data, starts[pending[cand]], lengths[pending[cand]])
+                match[cand[equal]] = True
+            result[pending[match]] = idx[match]
+            pending = pending[occupied & ~match]
+            pos[pending] = (pos[pending] + 1) & mask
+        return result
+
+    def _equal(self, ids, data, starts, lengths):
+        """
+        Compare stored words ids with the byte strings data[starts:starts + lengths].
+        """
+        own_starts = self._offsets[ids]
+        equal = self._offsets[ids + 1] - own_starts - 1 == lengths
+        same_len = np.flatnonzero(equal)
+        seg_lengths = lengths[same_len]
+        diff = (self._blob[_ragged_range(own_starts[same_len], seg_lengths)] !=
+                data[_ragged_range(starts[same_len], seg_lengths)])
+        seg = np.repeat(np.arange(same_len.size), seg_lengths)
+        equal[same_len] = np.bincount(seg, weights=diff, minlength=same_len.size) == 0
+        return equal
+
+    def append(self, words):
+        """
+        Append words to the vocabulary. Words already in the vocabulary are not checked.
+
+        words: list[str]
+
+        Returns: np.ndarray
+            indices of the new words
+        """
+        data, starts, lengths = _encode(words, self.encoding)
+        return self._append_bytes(data, lengths, fnv1a(data, starts, lengths))
+
+    def _append_bytes(self, data, lengths, hashes):
+        n, nbytes = lengths.shape[0], data.shape[0]
+        start = self._size
+        if n == 0:
+            return np.arange(start, start)
+        if not self._table.flags.writeable:
+            # attached read-only (e.g. shared memory)
+            self._table = self._table.copy()
+        self._blob = _grow(self._blob, self._nbytes + nbytes)
+        self._blob[self._nbytes:self._nbytes + nbytes] = data
+        self._offsets = _grow(self._offsets, start + n + 1)
+        self._offsets[start + 1:start + n + 1] = self._nbytes + np.cumsum(lengths + 1)
+        self._hashes = _grow(self._hashes, start + n)
+        self._hashes[start:start + n] = hashes
+        self._size += n
+        self._nbytes += nbytes
+
+        if self._size > self._table.shape[0] * MAX_LOAD_FACTOR:
+            size = MIN_TABLE_SIZE
+            while self._size > size * MAX_LOAD_FACTOR:
+                size *= 2
+            self._table = np.full(size, -1, dtype=np.int32)
+            self._insert(np.arange(self._size))
+        else:
+            self._insert(np.arange(start, self._size))
+        return np.arange(start, self._size)
+
+    def _insert(self, ids):
+        """
+        Insert word ids into the hash table with linear probing. Colliding ids are
+        resolved in increasing order, so the first occurrence of a word wins.
+        """
+        mask = self._table.shape[0] - 1
+        pos = (self._hashes[ids] & np.uint64(mask)).astype(np.int64)
+        while ids.size > 0:
+            free = np.flatnonzero(self._table[pos] < 0)
+            slots, first = np.unique(pos[free], return_index=True)
+            self._table[slots] = ids[free[first]]
+            rest = np.ones(ids.size, dtype=bool)
+            rest[free[first]] = False
+            ids, pos = ids[rest], (pos[rest] + 1) & mask
+
+    def fingerprint(self):
+        """
+        Returns: str
+            sha1 digest of the words in order, to key caches derived from the vocabulary
+        """
+        if getattr(self, '_fingerprint', (None, None))[0] != self._size:
+            digest = hashlib.sha1(memoryview(np.ascontiguousarray(self._blob[:self._nbytes]))).hexdigest()
+            self._fingerprint = (self._size, digest)
+        return self._fingerprint[1]
+
+    def to_arrays(self):
+        """
+        Returns: dict[str, np.ndarray]
+            the arrays backing the vocabulary, see from_arrays
+        """
+        return {'blob': self._blob[:self._nbytes], 'offsets': self._offsets[:self._size + 1],
+                'hashes': self._hashes[:self._size], 'table': self._table}
+
+    @classmethod
+    def from_arrays(cls, blob, offsets, hashes, table, encoding='utf-8'):
+        """
+        Wrap the arrays returned by to_arrays without copying them. Read-only arrays
+        are copied before the vocabulary is modified.
+
+        Returns: Vocabulary
+        """
+        vocab = cls(encoding=encoding)
+        vocab._blob, vocab._offsets, vocab._hashes, vocab._table = blob, offsets, hashes, table
+        vocab._size, vocab._nbytes = hashes.shape[0], blob.shape[0]
+        return vocab
+
+    def subset(self, rows):
+        """
+        Returns: Vocabulary
+            a new vocabulary containing the words rows, in that order
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self._offsets[rows]
+        lengths = self._offsets[rows + 1] - starts
+        vocab = Vocabulary(encoding=self.encoding)
+        vocab._append_bytes(self._blob[_ragged_range(starts, lengths)], lengths - 1, self._hashes[rows])
+        return vocab
+
+    def save(self, prefix):
+        """
+        Write the words, one per line, to <prefix>.vocab and the hash index to
+        <prefix>.vidx.npz.
+        """
+        with open(prefix + VOCAB_EXT, 'wb') as fout:
+            fout.write(bytes(self._blob[:max(self._nbytes - 1, 0)]))
+        np.savez(prefix + INDEX_EXT, hashes=self._hashes[:self._size], table=self._table)
+
+    @classmethod
+    def load(cls, prefix, size=None, encoding='utf-8'):
+        """
+        Read a vocabulary written by save. If the hash index is missing, it is rebuilt.
+
+        prefix: str
+        size: int, optional
+            number of words to read
+        encoding: str, optional (default 'utf-8')
+
+        Returns: Vocabulary
+        """
+        data = np.fromfile(prefix + VOCAB_EXT, dtype=np.uint8)
+        if data.shape[0] > 0:
+            data = np.append(data, np.uint8(SEP))
+        ends = np.flatnonzero(data == SEP)[:size]
+        data = data[:ends[-1] + 1] if ends.shape[0] > 0 else data[:0]
+        lengths = np.diff(np.concatenate(([-1], ends))) - 1
+
+        vocab = cls(encoding=encoding)
+        if os.path.exists(prefix + INDEX_EXT):
+            with np.load(prefix + INDEX_EXT) as index:
+                hashes, table = index['hashes'], index['table']
+            if hashes.shape[0] == lengths.shape[0]:
+                vocab._blob, vocab._nbytes = data, data.shape[0]
+                vocab._offsets = np.concatenate(([0], ends + 1))
+                vocab._hashes, vocab._table = hashes, table
+                vocab._size = lengths.shape[0]
+                return vocab
+        vocab._append_bytes(data, lengths, fnv1a(data, ends - lengths, lengths))
+        return vocab